@@ -0,0 +1,136 @@
+import os
+import json
+import shutil
+import asyncio
+import hashlib
+from datetime import datetime, timedelta
+from .conversion import STREAM_COPY_CODECS
+from .profiles import DEFAULT_ENCODE_PROFILE, get_profile, describe_profile
+
+# Load environment variables
+STORAGE_PATH = os.getenv("STORAGE_PATH", "/tmp/uploads")
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 10737418240))  # 10GB default
+CACHE_RETENTION_HOURS = int(os.getenv("CACHE_RETENTION_HOURS", 72))
+
+CACHE_DIR = os.path.join(STORAGE_PATH, "cache")
+
+# Redis keys
+CACHE_LRU_KEY = "cache_lru"      # sorted set: cache key -> last access timestamp
+CACHE_BYTES_KEY = "cache_bytes"  # total size of cached outputs
+
+def get_encode_settings(profile_name=None, clip_ranges=None):
+    """Describe the encode parameters that determine the output for a given input."""
+    profile_name = profile_name or DEFAULT_ENCODE_PROFILE
+    settings = f"profile={profile_name};{describe_profile(profile_name)}"
+    if get_profile(profile_name)["stream_copy"]:
+        settings += f";copy={','.join(sorted(STREAM_COPY_CODECS))}"
+    if clip_ranges:
+        settings += f";clip={json.dumps(clip_ranges)}"
+    return settings
+
+def make_cache_key(content_hash, encode_settings=None):
+    """Build the cache key for an upload hash and a set of encode parameters."""
+    settings = encode_settings if encode_settings is not None else get_encode_settings()
+    settings_digest = hashlib.sha256(settings.encode("utf-8")).hexdigest()[:16]
+    return f"{content_hash}-{settings_digest}"
+
+def _link_or_copy(src, dst):
+    """Hard-link src to dst (same volume), falling back to a copy."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def _touch(redis_client, cache_key, cache_path):
+    """Mark a cache entry as recently used and push back its expiry.
+
+    Returns the pipeline result, which the API's asyncio client needs awaited.
+    """
+    now = datetime.now()
+    expiry_time = now + timedelta(hours=CACHE_RETENTION_HOURS)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zadd(CACHE_LRU_KEY, {cache_key: now.timestamp()})
+    pipe.zadd("file_expiry", {cache_path: expiry_time.timestamp()})
+    return pipe.execute()
+
+def _forget(redis_client, cache_key, cache_path=None, size=0):
+    """Drop a cache entry's records (the result needs awaiting with the asyncio client)."""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.delete(f"cache:{cache_key}")
+    pipe.zrem(CACHE_LRU_KEY, cache_key)
+    if cache_path:
+        pipe.zrem("file_expiry", cache_path)
+    if size:
+        pipe.decrby(CACHE_BYTES_KEY, size)
+    return pipe.execute()
+
+def _drop(redis_client, cache_key, cache_path=None, size=0):
+    """Forget a cache entry and delete its file."""
+    _forget(redis_client, cache_key, cache_path, size)
+    if cache_path and os.path.exists(cache_path):
+        os.remove(cache_path)
+
+async def lookup(redis_client, cache_key, output_base):
+    """Materialise a cached output for a new job (takes the API's asyncio Redis client).
+
+    Returns a dict with the new job's output path and the cached conversion metadata,
+    or None on a cache miss. The output is linked at ``output_base`` + cached extension,
+    so the delete-after-download of the job never touches the cached copy.
+    """
+    entry = await redis_client.hgetall(f"cache:{cache_key}")
+    if not entry:
+        return None
+
+    entry = {k.decode('utf-8'): v.decode('utf-8') for k, v in entry.items()}
+    cache_path = entry["path"]
+    if not os.path.exists(cache_path):
+        # Reaped by the expiry cleanup; the index entry is stale
+        print(f"DEBUG: [cache.lookup] Cached file {cache_path} is gone, dropping entry {cache_key}")
+        await _forget(redis_client, cache_key, cache_path, int(entry.get("size", 0)))
+        return None
+
+    output_path = output_base + os.path.splitext(cache_path)[1]
+    await asyncio.to_thread(_link_or_copy, cache_path, output_path)
+    await _touch(redis_client, cache_key, cache_path)
+    print(f"INFO: [cache.lookup] Cache hit for {cache_key} -> {output_path}")
+
+    result = {k: v for k, v in entry.items() if k not in ("path", "size")}
+    result["output_path"] = output_path
+    return result
+
+def store(redis_client, cache_key, output_path, metadata=None):
+    """Add a finished output to the cache, then evict down to CACHE_MAX_BYTES."""
+    if redis_client.exists(f"cache:{cache_key}"):
+        return
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cache_path = os.path.join(CACHE_DIR, cache_key + os.path.splitext(output_path)[1])
+    _link_or_copy(output_path, cache_path)
+    size = os.path.getsize(cache_path)
+
+    entry = {"path": cache_path, "size": size}
+    entry.update(metadata or {})
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hset(f"cache:{cache_key}", mapping={k: str(v) for k, v in entry.items()})
+    pipe.incrby(CACHE_BYTES_KEY, size)
+    pipe.execute()
+    _touch(redis_client, cache_key, cache_path)
+    print(f"INFO: [cache.store] Cached {output_path} as {cache_key} ({size} bytes)")
+
+    evict(redis_client)
+
+def evict(redis_client, max_bytes=None):
+    """Drop least recently used entries until the cache fits in max_bytes."""
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    while int(redis_client.get(CACHE_BYTES_KEY) or 0) > max_bytes:
+        oldest = redis_client.zrange(CACHE_LRU_KEY, 0, 0)
+        if not oldest:
+            # Counter drifted (e.g. entries reaped by expiry); resynchronise
+            redis_client.set(CACHE_BYTES_KEY, 0)
+            break
+        cache_key = oldest[0].decode('utf-8')
+        entry = redis_client.hgetall(f"cache:{cache_key}")
+        cache_path = entry.get(b"path", b"").decode('utf-8') or None
+        size = int(entry.get(b"size", 0))
+        print(f"INFO: [cache.evict] Evicting {cache_key} ({size} bytes)")
+        _drop(redis_client, cache_key, cache_path, size)
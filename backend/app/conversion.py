@@ -1,16 +1,36 @@
 import os
 import json
+import time
+import struct
 import redis
 from datetime import datetime, timedelta
 import ffmpeg
 import asyncio
-from .websocket import manager
+from . import jobqueue, peaks, supervisor
+from .profiles import DEFAULT_ENCODE_PROFILE, get_profile, encode_args
+from .segmented import SPLIT_SAMPLE_RATES, plan_segments, join_mp3_segments, remove_segment_files
 
 # Load environment variables
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 FFMPEG_PATH = os.getenv("FFMPEG_PATH", "/usr/bin/ffmpeg")
 FILE_RETENTION_HOURS = int(os.getenv("FILE_RETENTION_HOURS", 24))
+PROGRESS_CHANNEL = os.getenv("PROGRESS_CHANNEL", "job_progress")
+# Progress updates are coalesced: at most one per interval, and only when progress moved by at least the delta
+PROGRESS_MIN_INTERVAL_SECONDS = float(os.getenv("PROGRESS_MIN_INTERVAL_SECONDS", 1.0))
+PROGRESS_MIN_DELTA = float(os.getenv("PROGRESS_MIN_DELTA", 1.0))
+# Source audio codecs that are remuxed with stream copy instead of re-encoded
+STREAM_COPY_CODECS = [c.strip() for c in os.getenv("STREAM_COPY_CODECS", "mp3,aac").split(",") if c.strip()]
+
+# Long inputs are encoded as parallel time segments (libmp3lame itself is single-threaded)
+SPLIT_MIN_DURATION_SECONDS = float(os.getenv("SPLIT_MIN_DURATION_SECONDS", 1800))
+SPLIT_SEGMENTS = int(os.getenv("SPLIT_SEGMENTS", 4))
+
+# Container used when stream-copying a given audio codec: codec -> (ffmpeg format, extension)
+STREAM_COPY_CONTAINERS = {
+    "mp3": ("mp3", ".mp3"),
+    "aac": ("ipod", ".m4a"),
+}
 
 # Initialize Redis client
 redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
@@ -22,11 +42,16 @@ def add_conversion_job(job_data):
     
     # Store job data in Redis hash
     print(f"DEBUG: [add_conversion_job] Setting hash job:{file_id}")
-    redis_client.hset(f"job:{file_id}", mapping={k: str(v) for k, v in job_data.items()})
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(f"job:{file_id}", mapping={k: str(v) for k, v in job_data.items()})
+    pipe.hincrby(f"job:{file_id}", "version", 1)
+    pipe.publish(PROGRESS_CHANNEL, json.dumps({"file_id": file_id, "status": job_data.get("status"), "progress": 0, "message": None}))
+    pipe.execute()
     
     # Add job to conversion queue
-    print(f"DEBUG: [add_conversion_job] Pushing job {file_id} to list conversion_queue")
-    redis_client.lpush("conversion_queue", json.dumps({"file_id": file_id}))
+    print(f"DEBUG: [add_conversion_job] Adding job {file_id} to sorted set conversion_queue")
+    duration = float(job_data["duration"]) if job_data.get("duration") else None
+    jobqueue.enqueue_job(redis_client, file_id, duration, job_data.get("client_id"))
     
     print(f"DEBUG: [add_conversion_job] Job {file_id} added.")
     return file_id
@@ -45,8 +70,12 @@ def get_job_status(file_id):
     print(f"DEBUG: [get_job_status] Returning status for job {file_id}: {result}")
     return result
 
-def update_job_status(file_id, status, progress=None, message=None):
-    """Update the status of a conversion job."""
+def update_job_status(file_id, status, progress=None, message=None, extra=None, client=None):
+    """Update the status of a conversion job.
+
+    ``client`` defaults to the worker's Redis client; with the API's asyncio client
+    the returned pipeline result must be awaited.
+    """
     updates = {"status": status}
     
     if progress is not None:
@@ -55,19 +84,91 @@ def update_job_status(file_id, status, progress=None, message=None):
     if message is not None:
         updates["message"] = message
     
-    print(f"DEBUG: [update_job_status] Updating job {file_id} with: {updates}")
-    redis_client.hset(f"job:{file_id}", mapping=updates)
-    print(f"DEBUG: [update_job_status] Job {file_id} updated in Redis.")
+    if extra:
+        updates.update({k: str(v) for k, v in extra.items()})
     
-    # Send WebSocket update if client_id matches file_id
+    # Progress event relayed by the API process to WebSocket clients
     ws_data = {
         "file_id": file_id,
         "status": status,
         "progress": float(progress) if progress is not None else 0,
         "message": message
     }
-    print(f"DEBUG: [update_job_status] Creating WebSocket task for job {file_id} with data: {ws_data}")
-    asyncio.create_task(manager.send_progress(file_id, ws_data))
+    
+    print(f"DEBUG: [update_job_status] Updating job {file_id} with: {updates}")
+    pipe = (client or redis_client).pipeline(transaction=False)
+    pipe.hset(f"job:{file_id}", mapping=updates)
+    # Every visible change bumps the version clients poll against (see GET /api/status)
+    pipe.hincrby(f"job:{file_id}", "version", 1)
+    pipe.publish(PROGRESS_CHANNEL, json.dumps(ws_data))
+    return pipe.execute()
+
+class ProgressCoalescer:
+    """Rate-limit the progress updates of a single job.
+
+    ffmpeg reports progress several times per second. Intermediate updates are only
+    written to Redis (and published) once ``min_interval`` seconds have passed *and*
+    progress moved by at least ``min_delta`` percent; anything else is dropped in
+    favour of the next update. Terminal states always go through ``finish``.
+    """
+
+    def __init__(self, file_id, min_interval=PROGRESS_MIN_INTERVAL_SECONDS,
+                 min_delta=PROGRESS_MIN_DELTA, clock=time.monotonic):
+        self.file_id = file_id
+        self.min_interval = min_interval
+        self.min_delta = min_delta
+        self.clock = clock
+        self.last_progress = None
+        self.last_sent_at = None
+        self.sent = 0
+        self.dropped = 0
+
+    def _due(self, progress):
+        """Decide whether an update goes out, and count it as sent or dropped."""
+        now = self.clock()
+        if self.last_progress is not None:
+            delta = abs(progress - self.last_progress)
+            if delta == 0 or delta < self.min_delta or now - self.last_sent_at < self.min_interval:
+                self.dropped += 1
+                return False
+        self.last_progress = progress
+        self.last_sent_at = now
+        self.sent += 1
+        return True
+
+    def _finish_fields(self, extra):
+        print(f"INFO: [ProgressCoalescer] Job {self.file_id}: sent {self.sent} progress update(s), dropped {self.dropped}")
+        fields = {"progress_updates_dropped": self.dropped}
+        if extra:
+            fields.update(extra)
+        return fields
+
+    def update(self, progress, message=None, extra=None):
+        """Publish a processing update if it is due; return True when it was sent."""
+        if not self._due(progress):
+            return False
+        update_job_status(self.file_id, "processing", progress, message, extra=extra)
+        return True
+
+    def finish(self, status, progress, message=None, extra=None):
+        """Always publish a terminal (completed/failed) state, along with the dropped count."""
+        update_job_status(self.file_id, status, progress, message, extra=self._finish_fields(extra))
+
+class AsyncProgressCoalescer(ProgressCoalescer):
+    """ProgressCoalescer for conversions run in the API process, on its asyncio Redis client."""
+
+    def __init__(self, file_id, redis_client, **kwargs):
+        super().__init__(file_id, **kwargs)
+        self.redis_client = redis_client
+
+    async def update(self, progress, message=None, extra=None):
+        if not self._due(progress):
+            return False
+        await update_job_status(self.file_id, "processing", progress, message, extra=extra, client=self.redis_client)
+        return True
+
+    async def finish(self, status, progress, message=None, extra=None):
+        await update_job_status(self.file_id, status, progress, message, extra=self._finish_fields(extra), client=self.redis_client)
 
 def delete_job(file_id):
     """Delete a job and its associated data."""
@@ -85,75 +186,408 @@ def delete_job(file_id):
     deleted_count = redis_client.delete(f"job:{file_id}")
     print(f"DEBUG: [delete_job] Deleted Redis hash job:{file_id} (Count: {deleted_count})")
 
-def schedule_file_deletion(file_path, delay_hours=FILE_RETENTION_HOURS):
-    """Schedule a file for deletion after specified hours."""
+def schedule_file_deletion(file_path, delay_hours=FILE_RETENTION_HOURS, client=None):
+    """Schedule a file for deletion after specified hours (await the result with an asyncio ``client``)."""
     expiry_time = datetime.now() + timedelta(hours=delay_hours)
     print(f"DEBUG: [schedule_file_deletion] Scheduling {file_path} for deletion at {expiry_time} ({expiry_time.timestamp()})")
-    redis_client.zadd("file_expiry", {file_path: expiry_time.timestamp()})
+    return (client or redis_client).zadd("file_expiry", {file_path: expiry_time.timestamp()})
+
+# Containers ffmpeg can demux from a non-seekable pipe
+STREAMABLE_EXTENSIONS = ['.mkv', '.webm', '.flv']
+MP4_EXTENSIONS = ['.mp4', '.m4v', '.mov']
+
+def is_fragmented_mp4(head):
+    """Check the top-level boxes at the start of an MP4 for a fragmented layout.
+
+    Fragmented files carry an ``mvex`` box in ``moov`` (or start with ``moof``) and can be
+    demuxed front to back. A regular file whose ``mdat`` precedes ``moov`` needs seeking.
+    """
+    offset = 0
+    while offset + 8 <= len(head):
+        size, box_type = struct.unpack(">I4s", head[offset:offset + 8])
+        if size == 1:
+            if offset + 16 > len(head):
+                return False
+            size = struct.unpack(">Q", head[offset + 8:offset + 16])[0]
+        elif size == 0:
+            size = len(head) - offset
+        if size < 8:
+            return False
+        
+        if box_type == b"moov":
+            return b"mvex" in head[offset:offset + size]
+        if box_type == b"moof":
+            return True
+        if box_type == b"mdat":
+            return False
+        offset += size
+    return False
 
-def convert_to_mp3(input_path, output_path, file_id):
-    """Convert video to MP3 using FFmpeg with progress tracking."""
+def is_streamable_input(filename, head):
+    """Whether an input can be converted while it is still being received."""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in STREAMABLE_EXTENSIONS:
+        return True
+    if ext in MP4_EXTENSIONS:
+        return is_fragmented_mp4(head)
+    return False
+
+def plan_conversion(probe, output_path, profile_name=None, allow_copy=True):
+    """Decide how to produce the audio output from an ffmpeg.probe result.
+
+    A compatible source audio stream is remuxed with stream copy when the encode profile
+    allows it (and ``allow_copy``, False when the audio goes through a filter); anything
+    else is encoded with the profile. Returns None when the input has no audio stream.
+    """
+    profile = get_profile(profile_name)
+    audio_streams = [s for s in probe.get("streams", []) if s.get("codec_type") == "audio"]
+    if not audio_streams:
+        return None
+    
+    # Prefer the stream flagged as default, like ffmpeg's own stream selection would
+    stream = next((s for s in audio_streams if s.get("disposition", {}).get("default")), audio_streams[0])
+    codec = stream.get("codec_name", "")
+    base_path = os.path.splitext(output_path)[0]
+    
+    if allow_copy and profile["stream_copy"] and codec in STREAM_COPY_CODECS and codec in STREAM_COPY_CONTAINERS:
+        output_format, extension = STREAM_COPY_CONTAINERS[codec]
+        return {
+            "mode": "copy",
+            "source_codec": codec,
+            "stream_index": stream["index"],
+            "format": output_format,
+            "output_path": base_path + extension,
+            "output_args": {"map": f"0:{stream['index']}", "vn": None, "acodec": "copy"},
+            "sample_rate": None,
+            "bitrate": None,
+        }
+    
+    return {
+        "mode": "encode",
+        "source_codec": codec,
+        "stream_index": stream["index"],
+        "format": profile["format"],
+        "output_path": base_path + profile["extension"],
+        "output_args": {"map": f"0:{stream['index']}", "vn": None, **encode_args(profile)},
+        "sample_rate": profile["sample_rate"],
+        "bitrate": profile["bitrate"],
+    }
+
+def clip_ranges_within(clip_ranges, duration=None):
+    """Clamp requested ``[start, end]`` ranges (end None: to the end) to the input's duration.
+
+    Ranges past the end are dropped; without a known duration, open-ended ranges stay open.
+    """
+    clips = []
+    for start, end in clip_ranges:
+        if duration is not None:
+            end = duration if end is None else min(end, duration)
+        if end is None or end > start:
+            clips.append((start, end))
+    return clips
+
+def clip_duration(clips):
+    """Total length of clamped clip ranges, or None when one of them is open-ended."""
+    if any(end is None for _, end in clips):
+        return None
+    return sum(end - start for start, end in clips)
+
+def audio_sources(input_path, stream_index, clips=None, count=1):
+    """Stream handles for ``count`` outputs of the input's audio track, and whether outputs must ``map`` it.
+
+    Clips are read with input-side seeking (``-ss``/``-t`` before ``-i``), so ffmpeg only
+    demuxes and decodes the requested regions. Several clips are joined with the concat
+    filter, whose result is split once per output.
+    """
+    if not clips:
+        return [ffmpeg.input(input_path)] * count, True
+    inputs = []
+    for start, end in clips:
+        input_args = {"ss": f"{start:.6f}"}
+        if end is not None:
+            input_args["t"] = f"{end - start:.6f}"
+        inputs.append(ffmpeg.input(input_path, **input_args))
+    if len(inputs) == 1:
+        return inputs * count, True
+    audio = ffmpeg.concat(*[clip[str(stream_index)] for clip in inputs], v=0, a=1)
+    if count == 1:
+        return [audio], False
+    split = audio.filter_multi_output('asplit', count)
+    return [split[i] for i in range(count)], False
+
+async def run_ffmpeg(args, file_id, on_progress=None, pass_fds=()):
+    """Run an ffmpeg command that writes ``-progress -`` to stdout, under supervision.
+
+    ``on_progress`` is called with the output time in seconds for every progress line.
+    ``pass_fds`` are inherited by ffmpeg (e.g. ``pipe:N`` outputs) and closed here once it started.
+    Returns the exit code and the tail of ffmpeg's stderr output. Raises
+    ``supervisor.FFmpegKilled`` when ffmpeg stalls or exceeds its time limit.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            pass_fds=pass_fds,
+            preexec_fn=supervisor.memory_limit(),
+        )
+    finally:
+        # Only ffmpeg may hold the write ends, so readers see EOF when it exits
+        for fd in pass_fds:
+            os.close(fd)
+    print(f"DEBUG: [run_ffmpeg] FFmpeg process started for job {file_id} (PID: {process.pid})")
+    # Drain stderr alongside stdout, so a full stderr pipe can never block ffmpeg
+    stderr_ring = supervisor.StderrRing()
+    stderr_task = asyncio.create_task(supervisor.drain(process.stderr, stderr_ring))
+    watchdog = supervisor.Watchdog()
+    
+    try:
+        # Process FFmpeg output for progress updates
+        while True:
+            try:
+                raw_line = await asyncio.wait_for(process.stdout.readline(), watchdog.remaining())
+            except asyncio.TimeoutError:
+                raw_line = None
+            if raw_line == b"":
+                break
+            line = raw_line.decode('utf-8', errors='ignore').strip() if raw_line else ""
+            
+            # Parse progress information
+            if line.startswith('out_time_ms=') and line != 'out_time_ms=N/A':
+                try:
+                    seconds = int(line.split('=')[1]) / 1000000
+                    watchdog.progress(seconds)
+                    if on_progress is not None:
+                        on_progress(seconds)
+                except (ValueError, ZeroDivisionError) as parse_err:
+                    print(f"WARNING: [run_ffmpeg] Failed to parse progress line '{line}': {parse_err}")
+            
+            reason = watchdog.check()
+            if reason:
+                print(f"ERROR: [run_ffmpeg] Killing FFmpeg (PID: {process.pid}): {reason} (Job: {file_id})")
+                process.kill()
+                await process.wait()
+                await stderr_task
+                raise supervisor.FFmpegKilled(reason, stderr_ring.text())
+        
+        # Wait for process to complete
+        return_code = await process.wait()
+        await stderr_task
+    finally:
+        # Cancelled (or failed) while ffmpeg still runs: do not leave it behind
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        stderr_task.cancel()
+    print(f"DEBUG: [run_ffmpeg] FFmpeg process finished with return code {return_code} (Job: {file_id})")
+    return return_code, stderr_ring.text()
+
+def get_split_sample_rate(probe, plan, duration):
+    """Return the sample rate to split an encode at, or None when a single pass is used.
+
+    Only constant-bitrate MP3 is split: the joined segments carry no Xing/LAME header,
+    which a VBR file needs for its duration and seeking to be right.
+    """
+    if plan["mode"] != "encode" or plan["format"] != "mp3" or not plan["bitrate"]:
+        return None
+    if SPLIT_SEGMENTS < 2 or duration < SPLIT_MIN_DURATION_SECONDS:
+        return None
+    # The profile may resample; otherwise the output keeps the source rate
+    stream = next((s for s in probe.get("streams", []) if s.get("index") == plan["stream_index"]), {})
+    try:
+        sample_rate = plan["sample_rate"] or int(stream.get("sample_rate", 0))
+    except ValueError:
+        return None
+    return sample_rate if sample_rate in SPLIT_SAMPLE_RATES else None
+
+async def encode_split_mp3(input_path, output_path, file_id, duration, sample_rate, output_args,
+                           count=SPLIT_SEGMENTS, on_progress=None):
+    """Encode time segments of the input in parallel and join them into one MP3.
+
+    Returns the exit code (0 on success) and the stderr of the first failing segment.
+    """
+    segments = plan_segments(duration, sample_rate, count)
+    if segments is None:
+        return None, "Input too short to split"
+    
+    segment_paths = [f"{output_path}.part{segment['index']}" for segment in segments]
+    # Progress is aggregated over everything the segments encode (pre-roll included)
+    lengths = [segment["length"] if segment["length"] is not None else duration - segment["seek"] for segment in segments]
+    encoded = [0.0] * len(segments)
+    
+    def segment_progress(index):
+        def update(seconds):
+            encoded[index] = min(seconds, lengths[index])
+            if on_progress is not None:
+                on_progress(sum(encoded) / sum(lengths) * duration)
+        return update
+    
+    segment_args = dict(output_args, ar=sample_rate, reservoir=0, write_xing=0, id3v2_version=0, write_id3v1=0)
+    jobs = []
+    for segment, path in zip(segments, segment_paths):
+        input_args = {"ss": f"{segment['seek']:.6f}"}
+        if segment["length"] is not None:
+            input_args["t"] = f"{segment['length']:.6f}"
+        args = (
+            ffmpeg
+            .input(input_path, **input_args)
+            .output(path, format='mp3', **segment_args)
+            .global_args('-progress', '-', '-nostats', '-y')
+            .compile(cmd=FFMPEG_PATH)
+        )
+        jobs.append(run_ffmpeg(args, file_id, segment_progress(segment["index"])))
+    
+    print(f"INFO: [encode_split_mp3] Encoding {len(segments)} segments in parallel for job {file_id}")
+    tasks = [asyncio.ensure_future(job) for job in jobs]
+    try:
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # One segment was killed: stop the others before their files are removed
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        for return_code, stderr_output in results:
+            if return_code != 0:
+                return return_code, stderr_output
+        frames = await asyncio.to_thread(join_mp3_segments, segment_paths, segments, output_path)
+        print(f"INFO: [encode_split_mp3] Joined {frames} frames from {len(segments)} segments (Job: {file_id})")
+        return 0, ""
+    finally:
+        remove_segment_files(segment_paths)
+
+async def convert_to_mp3(input_path, output_path, file_id, profile_name=None, extra_outputs=None, clip_ranges=None):
+    """Convert video to audio (MP3 by default, per the job's encode profile) using FFmpeg with progress tracking.
+
+    ``extra_outputs`` maps further profile names to output paths; they are written by the
+    same ffmpeg process, so the input is demuxed and decoded once for all outputs.
+    ``clip_ranges`` (``[start, end]`` seconds, end None for the rest) limits the output
+    to those regions of the input, joined in order.
+    """
     print(f"INFO: [convert_to_mp3] Starting conversion for job {file_id}")
     print(f"DEBUG: [convert_to_mp3] Input: {input_path}, Output: {output_path}")
     try:
-        # Get video duration for progress calculation
+        # Get video duration for progress calculation (ffprobe is blocking, keep it off the loop)
         print(f"DEBUG: [convert_to_mp3] Probing video duration for {input_path}")
-        probe = ffmpeg.probe(input_path)
+        probe = await asyncio.to_thread(ffmpeg.probe, input_path)
         duration = float(probe['format']['duration'])
         print(f"DEBUG: [convert_to_mp3] Video duration: {duration} seconds")
         
         # Update job status to processing
-        update_job_status(file_id, "processing", 0, "Starting conversion")
+        reporter = ProgressCoalescer(file_id)
+        
+        # Progress is measured against the clipped length: output timestamps start at the first clip
+        clips = clip_ranges_within(clip_ranges, duration) if clip_ranges else None
+        if clip_ranges:
+            if not clips:
+                error_message = f"Conversion failed: Clip ranges are outside the input ({duration:.1f}s)"
+                print(f"ERROR: [convert_to_mp3] {error_message} (Job: {file_id})")
+                reporter.finish("failed", 0, error_message)
+                return False
+            duration = clip_duration(clips)
+            print(f"DEBUG: [convert_to_mp3] Clipping job {file_id} to {clips} ({duration} seconds)")
+        
+        # Stream-copy a compatible audio track, re-encode only when required (several clips are joined by a filter)
+        allow_copy = not clips or len(clips) == 1
+        plan = plan_conversion(probe, output_path, profile_name, allow_copy)
+        if plan is None:
+            error_message = "Conversion failed: Input has no audio stream"
+            print(f"ERROR: [convert_to_mp3] {error_message} (Job: {file_id})")
+            reporter.finish("failed", 0, error_message)
+            return False
+        print(f"INFO: [convert_to_mp3] Job {file_id}: {plan['mode']} path for {plan['source_codec']} audio -> {plan['output_path']}")
+        extra_plans = {name: plan_conversion(probe, path, name, allow_copy) for name, path in (extra_outputs or {}).items()}
         
-        # Set up FFmpeg command with progress output
+        # Expiry was scheduled for each profile's output path at upload time
+        for planned, requested in zip([plan, *extra_plans.values()], [output_path, *(extra_outputs or {}).values()]):
+            if planned["output_path"] != requested:
+                redis_client.zrem("file_expiry", requested)
+                schedule_file_deletion(planned["output_path"])
+        output_path = plan["output_path"]
+        plan_fields = {
+            "conversion_mode": plan["mode"],
+            "source_audio_codec": plan["source_codec"],
+            "output_format": plan["format"],
+            "output_path": output_path,
+            "profile": profile_name or DEFAULT_ENCODE_PROFILE,
+        }
+        if extra_plans:
+            outputs = {plan_fields["profile"]: output_path}
+            outputs.update({name: extra["output_path"] for name, extra in extra_plans.items()})
+            plan_fields["outputs"] = json.dumps(outputs)
+        # Segmented encoding covers single-output, unclipped jobs only
+        split_sample_rate = None if extra_plans or clips else get_split_sample_rate(probe, plan, duration)
+        if split_sample_rate:
+            plan_fields.update({"conversion_mode": "encode-split", "segments": SPLIT_SEGMENTS})
+        reporter.update(0, "Starting conversion", extra=plan_fields)
+        
+        # Set up FFmpeg command with progress output: one input, one output per profile
         print(f"DEBUG: [convert_to_mp3] Setting up FFmpeg command for job {file_id}")
-        process = (
+        plans = [plan] + list(extra_plans.values())
+        # Waveform peaks from the same decode (segmented encodes have no single decode to tap)
+        peak_tap = None
+        if peaks.PEAKS_ENABLED and not split_sample_rate:
+            peak_tap = peaks.PeakTap(peaks.peaks_path_for(output_path))
+        sources, mapped = audio_sources(input_path, plan["stream_index"], clips, len(plans) + (1 if peak_tap else 0))
+        output_streams = []
+        for source, planned in zip(sources, plans):
+            # A filtered (concatenated) stream is mapped by its label instead of the input stream index
+            output_args = planned["output_args"] if mapped else {k: v for k, v in planned["output_args"].items() if k != "map"}
+            output_streams.append(source.output(planned["output_path"], format=planned["format"], **output_args))
+        if peak_tap:
+            output_streams.append(peak_tap.output(sources[-1], f"0:{plan['stream_index']}" if mapped else None))
+        args = (
             ffmpeg
-            .input(input_path)
-            .output(output_path, format='mp3', audio_bitrate='192k', acodec='libmp3lame')
+            .merge_outputs(*output_streams)
             .global_args('-progress', '-', '-nostats')
-            .run_async(pipe_stdout=True, pipe_stderr=True)
+            .compile(cmd=FFMPEG_PATH)
         )
-        print(f"DEBUG: [convert_to_mp3] FFmpeg process started for job {file_id} (PID: {process.pid})")
         
-        # Process FFmpeg output for progress updates
-        print(f"DEBUG: [convert_to_mp3] Reading FFmpeg stdout for progress (Job: {file_id})")
-        while True:
-            line = process.stdout.readline().decode('utf-8', errors='ignore').strip()
-            if not line:
-                break
-                
-            # Parse progress information
-            if line.startswith('out_time_ms='):
-                try:
-                    time_ms = int(line.split('=')[1])
-                    progress = min(100, (time_ms / 1000000) / duration * 100)
-                    update_job_status(file_id, "processing", progress, f"Converting: {progress:.1f}%")
-                except (ValueError, ZeroDivisionError) as parse_err:
-                    print(f"WARNING: [convert_to_mp3] Failed to parse progress line '{line}': {parse_err}")
+        def on_progress(seconds):
+            progress = min(100, seconds / duration * 100)
+            reporter.update(progress, f"Converting: {progress:.1f}%")
         
-        print(f"DEBUG: [convert_to_mp3] Finished reading FFmpeg stdout for job {file_id}")
+        return_code = None
+        if split_sample_rate:
+            return_code, stderr_output = await encode_split_mp3(
+                input_path, output_path, file_id, duration, split_sample_rate, plan["output_args"], on_progress=on_progress
+            )
+        if return_code is None and peak_tap is not None:
+            peaks_reader = asyncio.create_task(asyncio.to_thread(peak_tap.read))
+            try:
+                return_code, stderr_output = await run_ffmpeg(args, file_id, on_progress, pass_fds=(peak_tap.write_fd,))
+            finally:
+                # ffmpeg has exited (or was killed) either way, so the tap is at EOF
+                peak_count = await peaks_reader
+                if return_code == 0 and peak_count is not None:
+                    schedule_file_deletion(peak_tap.path)
+                    plan_fields.update({"peaks_path": peak_tap.path, "peaks_per_second": peak_tap.peaks_per_second})
+                    print(f"INFO: [convert_to_mp3] Wrote {peak_count} waveform peaks to {peak_tap.path} (Job: {file_id})")
+                else:
+                    peak_tap.discard()
+        if return_code is None:
+            return_code, stderr_output = await run_ffmpeg(args, file_id, on_progress)
         
-        # Wait for process to complete
-        print(f"DEBUG: [convert_to_mp3] Waiting for FFmpeg process to complete (Job: {file_id})")
-        return_code = process.wait()
-        print(f"DEBUG: [convert_to_mp3] FFmpeg process finished with return code {return_code} (Job: {file_id})")
-        
-        stderr_output = process.stderr.read().decode('utf-8', errors='ignore')
         if return_code != 0:
             print(f"WARNING: [convert_to_mp3] FFmpeg stderr output (Job {file_id}):\n{stderr_output}")
         
         # Check if conversion was successful
-        if os.path.exists(output_path) and os.path.getsize(output_path) > 0 and return_code == 0:
-            print(f"INFO: [convert_to_mp3] Conversion successful for job {file_id}")
-            update_job_status(file_id, "completed", 100, "Conversion completed")
+        all_outputs = [output_path] + [extra["output_path"] for extra in extra_plans.values()]
+        if all(os.path.exists(path) and os.path.getsize(path) > 0 for path in all_outputs) and return_code == 0:
+            print(f"INFO: [convert_to_mp3] Conversion successful for job {file_id} ({len(all_outputs)} output(s))")
+            reporter.finish("completed", 100, "Conversion completed", extra={k: v for k, v in plan_fields.items() if k.startswith("peaks_")})
             return True
         else:
             error_message = f"Conversion failed: Output file missing or empty, or FFmpeg error (Code: {return_code})"
             print(f"ERROR: [convert_to_mp3] {error_message} (Job: {file_id})")
-            update_job_status(file_id, "failed", 0, error_message)
+            reporter.finish("failed", 0, error_message)
             return False
             
+    except supervisor.FFmpegKilled as e:
+        print(f"ERROR: [convert_to_mp3] {e} (Job: {file_id})\nStderr: {e.stderr}")
+        reporter.finish("failed", 0, f"Conversion failed: {e}")
+        return False
     except ffmpeg.Error as e:
         stderr = e.stderr.decode('utf-8', errors='ignore') if e.stderr else 'N/A'
         error_message = f"ffmpeg.Error during conversion: {str(e)}\nStderr: {stderr}"
@@ -166,3 +600,103 @@ def convert_to_mp3(input_path, output_path, file_id):
         print(f"ERROR: [convert_to_mp3] {error_message} (Job: {file_id})")
         update_job_status(file_id, "failed", 0, f"Conversion failed: {str(e)}")
         return False
+
+async def convert_stream_to_mp3(redis_client, chunks, output_path, file_id, total_bytes=None, profile_name=None, extra_outputs=None):
+    """Convert an input that is still arriving by feeding it to ffmpeg's stdin.
+
+    Runs in the API process: job updates go through its asyncio ``redis_client``.
+
+    ``chunks`` is an async iterator of bytes. Progress is based on the bytes received
+    out of ``total_bytes`` (when known), since the duration cannot be probed up front.
+    ``extra_outputs`` (profile name -> path) are written by the same ffmpeg process.
+    """
+    print(f"INFO: [convert_stream_to_mp3] Starting streaming conversion for job {file_id}")
+    reporter = AsyncProgressCoalescer(file_id, redis_client)
+    await reporter.update(0, "Receiving and converting")
+    
+    outputs = {profile_name: output_path}
+    outputs.update(extra_outputs or {})
+    source = ffmpeg.input('pipe:0')
+    output_streams = [
+        source.output(path, format=get_profile(name)["format"], vn=None, **encode_args(get_profile(name)))
+        for name, path in outputs.items()
+    ]
+    peak_tap = None
+    if peaks.PEAKS_ENABLED:
+        peak_tap = peaks.PeakTap(peaks.peaks_path_for(output_path))
+        output_streams.append(peak_tap.output(source, '0:a:0'))
+    args = (
+        ffmpeg
+        .merge_outputs(*output_streams)
+        .global_args('-nostats', '-loglevel', 'error')
+        .compile(cmd=FFMPEG_PATH)
+    )
+    pass_fds = (peak_tap.write_fd,) if peak_tap else ()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            pass_fds=pass_fds,
+            preexec_fn=supervisor.memory_limit(),
+        )
+    finally:
+        for fd in pass_fds:
+            os.close(fd)
+    print(f"DEBUG: [convert_stream_to_mp3] FFmpeg process started for job {file_id} (PID: {process.pid})")
+    # Drain stderr (and the PCM tap) while we write stdin, so no pipe can block another
+    stderr_ring = supervisor.StderrRing()
+    stderr_task = asyncio.create_task(supervisor.drain(process.stderr, stderr_ring))
+    peaks_reader = asyncio.create_task(asyncio.to_thread(peak_tap.read)) if peak_tap else None
+    
+    received = 0
+    try:
+        async for content in chunks:
+            if not content:
+                continue
+            process.stdin.write(content)
+            await process.stdin.drain()
+            received += len(content)
+            if total_bytes:
+                progress = min(99.9, received / total_bytes * 100)
+                await reporter.update(progress, f"Converting: {progress:.1f}% received")
+        process.stdin.close()
+    except (BrokenPipeError, ConnectionResetError):
+        print(f"WARNING: [convert_stream_to_mp3] FFmpeg closed its input early (Job: {file_id}, {received} bytes sent)")
+    except Exception as e:
+        # Upload aborted: stop ffmpeg and fail the job
+        process.kill()
+        await process.wait()
+        stderr_task.cancel()
+        if peaks_reader:
+            await peaks_reader
+            peak_tap.discard()
+        print(f"ERROR: [convert_stream_to_mp3] Input stream failed after {received} bytes: {str(e)} (Job: {file_id})")
+        await reporter.finish("failed", 0, f"Conversion failed: upload interrupted ({str(e) or type(e).__name__})")
+        return False
+    
+    return_code = await process.wait()
+    await stderr_task
+    stderr_output = stderr_ring.text()
+    print(f"DEBUG: [convert_stream_to_mp3] FFmpeg process finished with return code {return_code} (Job: {file_id})")
+    if return_code != 0:
+        print(f"WARNING: [convert_stream_to_mp3] FFmpeg stderr output (Job {file_id}):\n{stderr_output}")
+    
+    peak_fields = {}
+    if peaks_reader:
+        if await peaks_reader is not None and return_code == 0:
+            await schedule_file_deletion(peak_tap.path, client=redis_client)
+            peak_fields = {"peaks_path": peak_tap.path, "peaks_per_second": peak_tap.peaks_per_second}
+        else:
+            peak_tap.discard()
+    
+    if all(os.path.exists(path) and os.path.getsize(path) > 0 for path in outputs.values()) and return_code == 0:
+        print(f"INFO: [convert_stream_to_mp3] Conversion successful for job {file_id} ({received} bytes streamed)")
+        await reporter.finish("completed", 100, "Conversion completed", extra=peak_fields)
+        return True
+    
+    error_message = f"Conversion failed: Output file missing or empty, or FFmpeg error (Code: {return_code})"
+    print(f"ERROR: [convert_stream_to_mp3] {error_message} (Job: {file_id})")
+    await reporter.finish("failed", 0, error_message)
+    return False
@@ -0,0 +1,205 @@
+import json
+import hashlib
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+
+import aiofiles
+import anyio
+from starlette.responses import Response
+
+CHUNK_SIZE = 1024 * 1024  # 1MB
+
+
+class RangeNotSatisfiable(Exception):
+    """The Range header does not overlap the file."""
+
+
+def make_etag(stat_result):
+    """Strong validator derived from the file's size and modification time."""
+    digest = hashlib.md5(f"{stat_result.st_mtime_ns}-{stat_result.st_size}".encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(header_value, etag):
+    """Check an If-None-Match / If-Range header value against our ETag."""
+    if not header_value:
+        return False
+    candidates = [tag.strip() for tag in header_value.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def not_modified_since(header_value, mtime):
+    """Check an If-Modified-Since header against the file's modification time."""
+    try:
+        return int(mtime) <= parsedate_to_datetime(header_value).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def parse_range(header_value, size):
+    """Parse a single ``bytes=`` range into an inclusive (start, end) tuple.
+
+    Returns None when the header should be ignored (absent, malformed, other units or
+    several ranges), in which case the whole file is served.
+    """
+    if not header_value:
+        return None
+    unit, _, spec = header_value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_str, sep, end_str = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if start_str == "":
+            # Suffix range: the last N bytes
+            length = int(end_str)
+            if length <= 0:
+                raise RangeNotSatisfiable()
+            return max(0, size - length), size - 1
+        start = int(start_str)
+        end = int(end_str) if end_str else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+def content_disposition(filename, disposition="attachment"):
+    """Content-Disposition header (``attachment`` or ``inline``) that survives non-ASCII filenames."""
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"{disposition}; filename*=utf-8''{quoted}"
+    return f'{disposition}; filename="{filename}"'
+
+
+def file_headers(path, stat_result, media_type, filename):
+    """Headers shared by every response for a file (200, 206, 304 and HEAD)."""
+    return {
+        "accept-ranges": "bytes",
+        "content-type": media_type,
+        "content-disposition": content_disposition(filename),
+        "etag": make_etag(stat_result),
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+    }
+
+
+class FileRangeResponse(Response):
+    """Send ``[start, end]`` of a file, with zero-copy sendfile when the server supports it.
+
+    ``on_complete(start, end)`` is awaited only when the last byte of the range was handed
+    to the server before the client disconnected, so callers can tell a finished transfer
+    from an aborted one.
+    """
+
+    def __init__(self, path, start, end, status_code=200, headers=None, send_body=True, on_complete=None):
+        super().__init__(status_code=status_code, headers=headers)
+        self.path = path
+        self.start = start
+        self.end = end
+        self.send_body = send_body
+        self.on_complete = on_complete
+        self.last_byte_sent = False
+        # HEAD responses advertise the length a GET would send
+        self.raw_headers = [(k, v) for k, v in self.raw_headers if k != b"content-length"]
+        self.raw_headers.append((b"content-length", str(self.length).encode()))
+
+    @property
+    def length(self):
+        return self.end - self.start + 1
+
+    async def _send_file(self, scope, send):
+        if "http.response.zerocopy" in scope.get("extensions", {}):
+            with open(self.path, "rb") as f:
+                await send({
+                    "type": "http.response.zerocopy",
+                    "file": f,
+                    "offset": self.start,
+                    "count": self.length,
+                    "more_body": False,
+                })
+            self.last_byte_sent = True
+            return
+
+        remaining = self.length
+        async with aiofiles.open(self.path, "rb") as f:
+            await f.seek(self.start)
+            while remaining > 0:
+                content = await f.read(min(CHUNK_SIZE, remaining))
+                if not content:
+                    break
+                remaining -= len(content)
+                # The client may report its disconnect as soon as the final chunk is out
+                self.last_byte_sent = remaining == 0
+                await send({"type": "http.response.body", "body": content, "more_body": remaining > 0})
+        if remaining > 0:
+            raise OSError(f"{self.path} shrank while sending ({remaining} bytes short)")
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body or self.length == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        async def listen_for_disconnect(task_group):
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    task_group.cancel_scope.cancel()
+                    return
+
+        async def send_file(task_group):
+            await self._send_file(scope, send)
+            task_group.cancel_scope.cancel()
+
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(listen_for_disconnect, task_group)
+            task_group.start_soon(send_file, task_group)
+
+        if self.last_byte_sent and self.on_complete is not None:
+            await self.on_complete(self.start, self.end)
+
+
+def merge_ranges(ranges):
+    """Merge inclusive [start, end] byte ranges that overlap or touch."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+async def record_delivered_range(redis_client, file_id, start, end, size, field="delivered_ranges", channel=None):
+    """Add a fully sent byte range to the job and report whether the whole file was delivered.
+
+    ``field`` names the job hash field of the output being downloaded (jobs may have several).
+    The change bumps the job's version; with ``channel``, it is also announced there as a
+    progress event carrying the job's current status.
+    """
+    key = f"job:{file_id}"
+    fully_delivered = False
+
+    async def update(pipe):
+        nonlocal fully_delivered
+        if not await pipe.exists(key):
+            return
+        raw, status, progress, message = await pipe.hmget(key, field, "status", "progress", "message")
+        ranges = json.loads(raw) if raw else []
+        ranges = merge_ranges(ranges + [[start, end]])
+        fully_delivered = ranges == [[0, size - 1]]
+        pipe.multi()
+        pipe.hset(key, field, json.dumps(ranges))
+        pipe.hincrby(key, "version", 1)
+        if channel:
+            pipe.publish(channel, json.dumps({
+                "file_id": file_id,
+                "status": status.decode("utf-8") if status else None,
+                "progress": float(progress) if progress else 0,
+                "message": message.decode("utf-8") if message else None,
+            }))
+
+    await redis_client.transaction(update, key)
+    return fully_delivered
@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import socket
+from datetime import datetime
+
+# Load environment variables
+PROGRESS_CHANNEL = os.getenv("PROGRESS_CHANNEL", "job_progress")
+# A worker whose lease is not renewed within this many seconds is considered dead
+WORKER_LEASE_SECONDS = int(os.getenv("WORKER_LEASE_SECONDS", 30))
+# Jobs are moved to the dead-letter list after this many lost attempts
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+# Shortest job first with aging: a job is ordered as if it had been queued later by its media
+# duration times the weight, capped so long jobs wait at most the cap longer than under FIFO
+QUEUE_COST_WEIGHT = float(os.getenv("QUEUE_COST_WEIGHT", 1.0))
+QUEUE_MAX_PENALTY_SECONDS = float(os.getenv("QUEUE_MAX_PENALTY_SECONDS", 3600))
+# Each job a client already has queued or running pushes its next job back by this much
+QUEUE_CLIENT_PENALTY_SECONDS = float(os.getenv("QUEUE_CLIENT_PENALTY_SECONDS", 300))
+# Seconds between claim attempts while the queue is empty
+QUEUE_POLL_INTERVAL_SECONDS = float(os.getenv("QUEUE_POLL_INTERVAL_SECONDS", 0.5))
+# Media seconds encoded per wall-clock second per slot, until workers have measured it
+DEFAULT_ENCODE_SPEED = float(os.getenv("DEFAULT_ENCODE_SPEED", 20))
+
+# Redis keys
+QUEUE_KEY = "conversion_queue"              # sorted set: jobs waiting for a worker, lowest score first
+DEAD_LETTER_KEY = "conversion_dead_letter"  # list: jobs that kept losing their worker
+WORKERS_KEY = "workers"                     # set: ids of workers that may own claimed jobs
+WORKER_SLOTS_KEY = "worker_slots"           # hash: worker id -> concurrent conversions
+CLIENT_JOBS_KEY = "client_jobs"             # hash: client id -> jobs queued or running
+ENCODE_SPEED_KEY = "encode_speed"           # moving average of media seconds encoded per second
+QUEUED_WORK_KEY = "queued_work"             # hash: media seconds and count of queued jobs of known duration
+
+def get_worker_id():
+    """Identify this worker process across the cluster."""
+    return os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+def queue_entry(file_id):
+    """The queue member for a job (kept byte-identical so it can be looked up by rank)."""
+    return json.dumps({"file_id": file_id})
+
+def job_cost(duration):
+    """Ordering penalty, in seconds, of a job with the given media duration (None if unknown)."""
+    if duration is None:
+        return QUEUE_MAX_PENALTY_SECONDS
+    return min(duration * QUEUE_COST_WEIGHT, QUEUE_MAX_PENALTY_SECONDS)
+
+def job_score(duration=None, backlog=0):
+    """Queue score of a job: when it was queued, pushed back by its cost and its client's backlog."""
+    return time.time() + job_cost(duration) + backlog * QUEUE_CLIENT_PENALTY_SECONDS
+
+def add_to_queue(pipe, file_id, score, client_id=None, duration=None):
+    """Queue a job on a pipeline that has already written (or is writing) its hash.
+
+    ``duration`` must match the job hash's ``duration`` field, which claims subtract again.
+    """
+    pipe.hset(f"job:{file_id}", "queue_score", repr(score))
+    if client_id:
+        pipe.hincrby(CLIENT_JOBS_KEY, client_id, 1)
+    if duration is not None:
+        pipe.hincrbyfloat(QUEUED_WORK_KEY, "seconds", duration)
+        pipe.hincrby(QUEUED_WORK_KEY, "jobs", 1)
+    pipe.zadd(QUEUE_KEY, {queue_entry(file_id): score})
+
+def enqueue_job(redis_client, file_id, duration=None, client_id=None):
+    """Queue a job whose hash already exists, ordered by estimated cost, age and client backlog."""
+    backlog = int(redis_client.hget(CLIENT_JOBS_KEY, client_id) or 0) if client_id else 0
+    score = job_score(duration, backlog)
+    pipe = redis_client.pipeline(transaction=True)
+    add_to_queue(pipe, file_id, score, client_id, duration)
+    pipe.execute()
+    return score
+
+def release_client_slot(redis_client, client_id):
+    """Count a client's job as no longer queued or running."""
+    if client_id and redis_client.hincrby(CLIENT_JOBS_KEY, client_id, -1) <= 0:
+        redis_client.hdel(CLIENT_JOBS_KEY, client_id)
+
+def get_encode_speed(redis_client):
+    speed = redis_client.get(ENCODE_SPEED_KEY)
+    return float(speed) if speed else DEFAULT_ENCODE_SPEED
+
+def record_encode_speed(redis_client, duration, elapsed, smoothing=0.2):
+    """Fold one finished conversion into the moving average used for start-time estimates."""
+    if not duration or elapsed <= 0:
+        return
+    speed = get_encode_speed(redis_client) * (1 - smoothing) + duration / elapsed * smoothing
+    redis_client.set(ENCODE_SPEED_KEY, speed)
+
+async def get_queue_position(redis_client, file_id):
+    """1-based position of a queued job and its estimated start time (None when unknown).
+
+    The estimate spreads the media duration of every job ahead over the slots of the live
+    workers at the measured encode speed. Takes the API's asyncio Redis client.
+    """
+    return (await get_queue_positions(redis_client, [file_id])).get(file_id, (None, None))
+
+async def get_queue_positions(redis_client, file_ids):
+    """``get_queue_position`` for several jobs, in a constant number of Redis commands per job.
+
+    Returns ``{file_id: (position, estimated_start)}`` for the jobs that are still queued.
+    The work ahead of a job is its rank times the average duration of the queued jobs,
+    taken from the running total in QUEUED_WORK_KEY instead of reading every job ahead.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for file_id in file_ids:
+        pipe.zrank(QUEUE_KEY, queue_entry(file_id))
+    pipe.hmget(QUEUED_WORK_KEY, "seconds", "jobs")
+    pipe.hvals(WORKER_SLOTS_KEY)
+    pipe.get(ENCODE_SPEED_KEY)
+    *ranks, (seconds, jobs), slots, speed = await pipe.execute()
+    ranks = {file_id: rank for file_id, rank in zip(file_ids, ranks) if rank is not None}
+
+    total_slots = sum(int(n) for n in slots)
+    if not total_slots:
+        return {file_id: (rank + 1, None) for file_id, rank in ranks.items()}
+    speed = float(speed) if speed else DEFAULT_ENCODE_SPEED
+    # Jobs that could not be probed count as an average job
+    jobs = int(jobs or 0)
+    average = max(float(seconds or 0), 0.0) / jobs if jobs > 0 else 0
+    now = time.time()
+    return {
+        file_id: (rank + 1, datetime.fromtimestamp(now + rank * average / speed / total_slots))
+        for file_id, rank in ranks.items()
+    }
+
+def processing_key(worker_id):
+    return f"processing:{worker_id}"
+
+def lease_key(worker_id):
+    return f"worker_lease:{worker_id}"
+
+# Return every job of a dead worker's processing list (KEYS[1]) to the queue (KEYS[2]) at its
+# original position, or to the dead-letter list (KEYS[3]) once it has been attempted ARGV[1] times;
+# a requeued job's duration is added back to the queued work total (KEYS[5])
+RECOVER_SCRIPT = """
+local requeued, dead = 0, 0
+while true do
+    local item = redis.call('RPOP', KEYS[1])
+    if not item then break end
+    local ok, job = pcall(cjson.decode, item)
+    local key = ok and ('job:' .. tostring(job['file_id'])) or nil
+    if key and redis.call('EXISTS', key) == 1 then
+        local attempts = tonumber(redis.call('HGET', key, 'attempts') or '0')
+        if attempts >= tonumber(ARGV[1]) then
+            local message = 'Conversion abandoned after ' .. attempts .. ' lost attempt(s)'
+            redis.call('HSET', key, 'status', 'failed', 'message', message)
+            redis.call('HINCRBY', key, 'version', 1)
+            redis.call('LPUSH', KEYS[3], item)
+            redis.call('PUBLISH', ARGV[2], cjson.encode({file_id = job['file_id'], status = 'failed', progress = 0, message = message}))
+            local client_id = redis.call('HGET', key, 'client_id')
+            if client_id and redis.call('HINCRBY', KEYS[4], client_id, -1) <= 0 then
+                redis.call('HDEL', KEYS[4], client_id)
+            end
+            dead = dead + 1
+        else
+            redis.call('HSET', key, 'status', 'queued', 'progress', '0', 'message', 'Requeued after its worker was lost')
+            redis.call('HINCRBY', key, 'version', 1)
+            redis.call('PUBLISH', ARGV[2], cjson.encode({file_id = job['file_id'], status = 'queued', progress = 0, message = 'Requeued after its worker was lost'}))
+            local score = redis.call('HGET', key, 'queue_score') or ARGV[3]
+            if redis.call('ZADD', KEYS[2], score, item) == 1 then
+                local duration = redis.call('HGET', key, 'duration')
+                if duration then
+                    redis.call('HINCRBYFLOAT', KEYS[5], 'seconds', duration)
+                    redis.call('HINCRBY', KEYS[5], 'jobs', 1)
+                end
+            end
+            requeued = requeued + 1
+        end
+    end
+end
+return {requeued, dead}
+"""
+
+# Move the lowest-scored job of the queue (KEYS[1]) onto a processing list (KEYS[2]) and take
+# its duration off the queued work total (KEYS[3]), which is reset whenever the queue empties
+CLAIM_SCRIPT = """
+local item = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+if not item then return false end
+redis.call('ZREM', KEYS[1], item)
+redis.call('LPUSH', KEYS[2], item)
+if redis.call('ZCARD', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[3])
+else
+    local ok, job = pcall(cjson.decode, item)
+    local duration = ok and redis.call('HGET', 'job:' .. tostring(job['file_id']), 'duration')
+    if duration then
+        redis.call('HINCRBYFLOAT', KEYS[3], 'seconds', '-' .. duration)
+        redis.call('HINCRBY', KEYS[3], 'jobs', -1)
+    end
+end
+return item
+"""
+
+def migrate_list_queue(redis_client):
+    """Convert a FIFO list queue left by an older deployment into the sorted set, keeping its order."""
+    if redis_client.type(QUEUE_KEY) != b"list":
+        return
+    entries = redis_client.lrange(QUEUE_KEY, 0, -1)
+    now = time.time()
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.delete(QUEUE_KEY)
+    if entries:
+        # The oldest entry sits at the right end of the list
+        pipe.zadd(QUEUE_KEY, {entry: now + i * 0.001 for i, entry in enumerate(reversed(entries))})
+    pipe.execute()
+    print(f"INFO: [jobqueue] Migrated {len(entries)} job(s) from the list queue to the sorted set")
+
+def register_worker(redis_client, worker_id, concurrency=1):
+    """Take the worker lease; jobs left over by a previous process with the same id are requeued."""
+    migrate_list_queue(redis_client)
+    recover_worker(redis_client, worker_id)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.sadd(WORKERS_KEY, worker_id)
+    pipe.hset(WORKER_SLOTS_KEY, worker_id, concurrency)
+    pipe.set(lease_key(worker_id), 1, ex=WORKER_LEASE_SECONDS)
+    pipe.execute()
+    print(f"INFO: [jobqueue] Registered worker {worker_id} (lease {WORKER_LEASE_SECONDS}s)")
+
+def renew_lease(redis_client, worker_id):
+    """Heartbeat: keep the jobs claimed by this worker from being requeued."""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.sadd(WORKERS_KEY, worker_id)
+    pipe.set(lease_key(worker_id), 1, ex=WORKER_LEASE_SECONDS)
+    pipe.execute()
+
+def claim_job(redis_client, worker_id, timeout=5):
+    """Wait until a job is available and atomically move it onto this worker's processing list.
+
+    Returns the raw queue entry (needed to acknowledge it) or None on timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        raw_job = redis_client.eval(CLAIM_SCRIPT, 3, QUEUE_KEY, processing_key(worker_id), QUEUED_WORK_KEY)
+        if raw_job or time.monotonic() >= deadline:
+            return raw_job
+        time.sleep(QUEUE_POLL_INTERVAL_SECONDS)
+
+def ack_job(redis_client, worker_id, raw_job):
+    """Drop a finished (completed or failed) job from this worker's processing list."""
+    if redis_client.lrem(processing_key(worker_id), 1, raw_job):
+        try:
+            client_id = redis_client.hget(f"job:{json.loads(raw_job)['file_id']}", "client_id")
+        except (ValueError, KeyError, TypeError):
+            return
+        release_client_slot(redis_client, client_id)
+
+def recover_worker(redis_client, worker_id):
+    """Requeue (or dead-letter) every job claimed by a worker and forget the worker."""
+    requeued, dead = redis_client.eval(
+        RECOVER_SCRIPT, 5, processing_key(worker_id), QUEUE_KEY, DEAD_LETTER_KEY, CLIENT_JOBS_KEY, QUEUED_WORK_KEY,
+        JOB_MAX_ATTEMPTS, PROGRESS_CHANNEL, repr(time.time()),
+    )
+    if requeued or dead:
+        print(f"WARNING: [jobqueue] Recovered jobs of worker {worker_id}: {requeued} requeued, {dead} dead-lettered")
+    return requeued, dead
+
+def recover_expired_workers(redis_client, worker_id=None):
+    """Requeue the jobs of every registered worker whose lease has run out."""
+    recovered = 0
+    for member in redis_client.smembers(WORKERS_KEY):
+        other = member.decode('utf-8')
+        if other == worker_id or redis_client.exists(lease_key(other)):
+            continue
+        print(f"WARNING: [jobqueue] Lease of worker {other} expired, recovering its jobs")
+        requeued, dead = recover_worker(redis_client, other)
+        # Only forget the worker if it did not come back meanwhile
+        if not redis_client.exists(lease_key(other)):
+            redis_client.srem(WORKERS_KEY, other)
+            redis_client.hdel(WORKER_SLOTS_KEY, other)
+        recovered += requeued + dead
+    return recovered
@@ -1,17 +1,37 @@
 import os
+import math
 import uuid
 import shutil
+import hashlib
+import secrets
+from urllib.parse import quote
+from email.utils import formatdate
 import aiofiles
-import redis
 import json
 from datetime import datetime, timedelta
 import asyncio
 import logging
+from typing import Optional
+from contextlib import asynccontextmanager
+import redis.asyncio as aioredis
+import ffmpeg
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, WebSocket, WebSocketDisconnect, APIRouter
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, WebSocket, WebSocketDisconnect, APIRouter, Request, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from pydantic import ValidationError
+
+from .websocket import manager, status_waiters, relay_progress_events
+from . import cache, jobqueue
+from .profiles import ENCODE_PROFILES, DEFAULT_ENCODE_PROFILE, get_profile
+from .downloads import (
+    FileRangeResponse, RangeNotSatisfiable, parse_range, file_headers, etag_matches,
+    not_modified_since, record_delivered_range, make_etag, content_disposition,
+)
+from .validation import UnsupportedMedia, NoAudioStream, FileTooLarge, check_head, check_probe, SNIFF_BYTES
+from .conversion import is_streamable_input, convert_stream_to_mp3, clip_ranges_within, clip_duration
+from .schemas import UploadSessionRequest, UploadSessionResponse, StatusResponse, StatusBatchRequest, StatusBatchItem, StatusBatchResponse
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -28,16 +48,81 @@ MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", 2147483648))  # 2GB default
 FILE_RETENTION_HOURS = int(os.getenv("FILE_RETENTION_HOURS", 24))
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+# Connections in the API's Redis pool; requests wait for a free one beyond that
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+PROGRESS_CHANNEL = os.getenv("PROGRESS_CHANNEL", "job_progress")
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 8388608))  # 8MB default
+MAX_UPLOAD_CHUNK_SIZE = int(os.getenv("MAX_UPLOAD_CHUNK_SIZE", 67108864))  # 64MB default
+# Convert streamable uploads while they arrive (in this process); others fall back to the queue
+STREAMING_CONVERSION = os.getenv("STREAMING_CONVERSION", "true").lower() == "true"
+STREAMING_CONVERSION_SLOTS = int(os.getenv("STREAMING_CONVERSION_SLOTS", 2))
+# Outputs (encode profiles) one job may request; they are all written by a single ffmpeg run
+MAX_OUTPUTS_PER_JOB = int(os.getenv("MAX_OUTPUTS_PER_JOB", 4))
+# Time ranges one upload may cut out of its input
+MAX_CLIP_RANGES = int(os.getenv("MAX_CLIP_RANGES", 20))
+STREAM_SNIFF_BYTES = 65536
+# Raw-body uploads are collected into writes of this size (ASGI servers deliver ~64KB pieces)
+RAW_UPLOAD_WRITE_SIZE = int(os.getenv("RAW_UPLOAD_WRITE_SIZE", 1048576))  # 1MB default
+# "complete": delete output and job once every byte was delivered; "never": keep until expiry
+DELETE_AFTER_DOWNLOAD = os.getenv("DELETE_AFTER_DOWNLOAD", "complete").lower()
+# "direct": stream downloads from this process; "x-accel": let nginx send the file (X-Accel-Redirect)
+DOWNLOAD_MODE = os.getenv("DOWNLOAD_MODE", "direct").lower()
+ACCEL_REDIRECT_PREFIX = os.getenv("ACCEL_REDIRECT_PREFIX", "/internal-downloads")
+DOWNLOAD_TICKET_TTL_SECONDS = int(os.getenv("DOWNLOAD_TICKET_TTL_SECONDS", 21600))
+# Sent by nginx with its download-complete callbacks; the backend port is reachable without nginx
+DOWNLOAD_CALLBACK_SECRET = os.getenv("DOWNLOAD_CALLBACK_SECRET", "")
+if DOWNLOAD_MODE == "x-accel" and not DOWNLOAD_CALLBACK_SECRET:
+    raise ValueError("DOWNLOAD_MODE=x-accel requires DOWNLOAD_CALLBACK_SECRET (shared with nginx)")
+# Progressive output streaming: how often to look for new bytes, and when to give up on a stalled job
+STREAM_POLL_INTERVAL_SECONDS = float(os.getenv("STREAM_POLL_INTERVAL_SECONDS", 0.5))
+STREAM_IDLE_TIMEOUT_SECONDS = float(os.getenv("STREAM_IDLE_TIMEOUT_SECONDS", 300))
+# Longest a status request may be held open waiting for a change (``?wait=``)
+STATUS_MAX_WAIT_SECONDS = float(os.getenv("STATUS_MAX_WAIT_SECONDS", 30))
+# Most jobs one POST /api/status/batch may ask for
+MAX_STATUS_BATCH = int(os.getenv("MAX_STATUS_BATCH", 500))
+
+# MIME types of the output containers the worker can produce
+OUTPUT_MEDIA_TYPES = {
+    ".mp3": "audio/mpeg",
+    ".m4a": "audio/mp4",
+    ".opus": "audio/ogg",
+    ".wav": "audio/wav",
+}
+# Outputs that can be followed while ffmpeg is still writing them (no header rewrite at the end)
+PROGRESSIVE_EXTENSIONS = (".mp3", ".opus")
 
 # Create storage directory if it doesn't exist
 logger.info(f"Ensuring storage path exists: {STORAGE_PATH}")
 os.makedirs(STORAGE_PATH, exist_ok=True)
 
+# Async Redis client over one connection pool, opened and closed by the app lifespan
+redis_client: Optional[aioredis.Redis] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the Redis pool and bridge worker progress events from pub/sub to this process's WebSockets."""
+    global redis_client
+    logger.info(f"Connecting to Redis at {REDIS_HOST}:{REDIS_PORT} (pool of {REDIS_MAX_CONNECTIONS})")
+    pool = aioredis.BlockingConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=0, max_connections=REDIS_MAX_CONNECTIONS)
+    redis_client = aioredis.Redis(connection_pool=pool)
+    relay_task = asyncio.create_task(relay_progress_events(redis_client, PROGRESS_CHANNEL))
+    try:
+        yield
+    finally:
+        relay_task.cancel()
+        try:
+            await relay_task
+        except asyncio.CancelledError:
+            pass
+        await redis_client.aclose()
+        await pool.disconnect()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Video to MP3 Converter",
     description="Convert video files to MP3 audio format",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 # Add CORS middleware
@@ -47,37 +132,11 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Peaks-Per-Second", "X-Peaks-Format", "ETag"],
 )
 
-# Initialize Redis client
-logger.info(f"Connecting to Redis at {REDIS_HOST}:{REDIS_PORT}")
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
-
-# WebSocket connection manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections = {}
-
-    async def connect(self, websocket: WebSocket, client_id: str):
-        await websocket.accept()
-        self.active_connections[client_id] = websocket
-        logger.info(f"WebSocket connected: {client_id} (Total: {len(self.active_connections)})")
-
-    def disconnect(self, client_id: str):
-        if client_id in self.active_connections:
-            del self.active_connections[client_id]
-            logger.info(f"WebSocket disconnected: {client_id} (Total: {len(self.active_connections)})")
-        else:
-            logger.warning(f"Attempted to disconnect WebSocket for unknown client_id: {client_id}")
-
-    async def send_progress(self, client_id: str, data: dict):
-        if client_id in self.active_connections:
-            logger.debug(f"Sending WebSocket progress to {client_id}: {data}")
-            await self.active_connections[client_id].send_json(data)
-        else:
-            logger.warning(f"Attempted to send WebSocket progress to unknown client_id: {client_id}")
-
-manager = ConnectionManager()
+# Limits concurrent ffmpeg processes fed by upload streams in this API process
+streaming_slots = asyncio.Semaphore(STREAMING_CONVERSION_SLOTS)
 
 # Helper functions
 def is_valid_video_format(filename):
@@ -89,14 +148,275 @@ def get_file_path(file_id, extension):
     """Generate file path based on ID and extension."""
     return os.path.join(STORAGE_PATH, f"{file_id}{extension}")
 
-def get_output_path(file_id):
-    """Generate output MP3 path based on ID."""
-    return os.path.join(STORAGE_PATH, f"{file_id}.mp3")
+def get_output_path(file_id, profile_name=None):
+    """Generate output path based on ID and the encode profile's container (MP3 by default)."""
+    return os.path.join(STORAGE_PATH, f"{file_id}{get_profile(profile_name)['extension']}")
+
+def get_output_paths(file_id, profiles):
+    """Output path per requested profile: the first (primary) one as usual, the others named after their profile."""
+    paths = {profiles[0]: get_output_path(file_id, profiles[0])}
+    for profile_name in profiles[1:]:
+        paths[profile_name] = os.path.join(STORAGE_PATH, f"{file_id}.{profile_name}{get_profile(profile_name)['extension']}")
+    return paths
+
+def resolve_profiles(profile_param):
+    """Validate a comma-separated list of encode profiles, returning their names (the default when not given).
+
+    The first profile is the job's primary output; duplicates are dropped.
+    """
+    profiles = []
+    for profile_name in (profile_param or "").split(","):
+        profile_name = profile_name.strip()
+        if not profile_name or profile_name in profiles:
+            continue
+        if profile_name not in ENCODE_PROFILES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown encode profile '{profile_name}' (available: {', '.join(ENCODE_PROFILES)})",
+            )
+        profiles.append(profile_name)
+    if len(profiles) > MAX_OUTPUTS_PER_JOB:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_OUTPUTS_PER_JOB} profiles may be requested per job")
+    return profiles or [DEFAULT_ENCODE_PROFILE]
 
-def schedule_file_deletion(file_path, delay_hours=FILE_RETENTION_HOURS):
-    """Schedule a file for deletion after specified hours."""
+def parse_clip_ranges(start=None, end=None, ranges=None):
+    """Validate the requested clip: ``start``/``end`` seconds, or ``ranges`` like ``"30-90,120-"``.
+
+    Returns a list of ``[start, end]`` (end None: to the end of the input), or None for the whole input.
+    """
+    if ranges and (start is not None or end is not None):
+        raise HTTPException(status_code=400, detail="Use either start/end or ranges, not both")
+    if ranges:
+        clip_ranges = []
+        for part in ranges.split(","):
+            range_start, sep, range_end = part.strip().partition("-")
+            try:
+                if not sep:
+                    raise ValueError(part)
+                clip_ranges.append([float(range_start), float(range_end) if range_end.strip() else None])
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid clip range '{part.strip()}' (expected start-end in seconds)")
+    elif start is not None or end is not None:
+        clip_ranges = [[start or 0.0, end]]
+    else:
+        return None
+    
+    if len(clip_ranges) > MAX_CLIP_RANGES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_CLIP_RANGES} clip ranges may be requested")
+    previous_end = 0.0
+    for index, (range_start, range_end) in enumerate(clip_ranges):
+        if not math.isfinite(range_start) or (range_end is not None and not math.isfinite(range_end)):
+            raise HTTPException(status_code=400, detail="Clip times must be finite numbers of seconds")
+        if range_start < previous_end or (range_end is not None and range_end <= range_start):
+            raise HTTPException(status_code=400, detail="Clip ranges must be increasing, non-overlapping and non-empty")
+        if range_end is None and index != len(clip_ranges) - 1:
+            raise HTTPException(status_code=400, detail="Only the last clip range may be open-ended")
+        previous_end = range_end if range_end is not None else range_start
+    return clip_ranges
+
+def get_media_type(path):
+    """Return the MIME type for a converted output file."""
+    return OUTPUT_MEDIA_TYPES.get(os.path.splitext(path)[1].lower(), "application/octet-stream")
+
+def schedule_file_deletion(pipe, file_path, delay_hours=FILE_RETENTION_HOURS):
+    """Schedule a file for deletion after specified hours (queued on a Redis pipeline)."""
     expiry_time = datetime.now() + timedelta(hours=delay_hours)
-    redis_client.zadd("file_expiry", {file_path: expiry_time.timestamp()})
+    pipe.zadd("file_expiry", {file_path: expiry_time.timestamp()})
+
+def publish_progress(pipe, file_id, status, progress=0, message=None):
+    """Announce a job's new version on a pipeline, like the worker's update_job_status."""
+    event = {"file_id": file_id, "status": status, "progress": float(progress), "message": message}
+    pipe.publish(PROGRESS_CHANNEL, json.dumps(event))
+
+def get_client_id(request):
+    """Identify the uploader for queue fairness (first X-Forwarded-For hop behind nginx)."""
+    forwarded_for = request.headers.get("x-forwarded-for")
+    if forwarded_for:
+        return forwarded_for.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+def media_error(e):
+    """HTTP error for an upload rejected by content validation."""
+    return HTTPException(status_code=422 if isinstance(e, NoAudioStream) else 415, detail=str(e))
+
+def file_too_large():
+    return HTTPException(status_code=413, detail=f"File exceeds maximum size of {MAX_FILE_SIZE} bytes")
+
+def check_declared_size(size):
+    """Reject an upload whose announced size is over MAX_FILE_SIZE before reading it."""
+    if size is not None and size > MAX_FILE_SIZE:
+        raise file_too_large()
+
+def get_content_length(request):
+    content_length = request.headers.get("content-length")
+    return int(content_length) if content_length and content_length.isdigit() else None
+
+async def probe_upload(input_path):
+    """Quick ffprobe of a received upload, checked for a decodable audio stream.
+
+    Returns the probe result, or None when ffprobe itself is unavailable (the worker then
+    finds out). Raises UnsupportedMedia when the file cannot be converted.
+    """
+    try:
+        probe = await asyncio.to_thread(ffmpeg.probe, input_path)
+    except ffmpeg.Error as e:
+        logger.warning(f"Probe of {input_path} failed: {e.stderr.decode('utf-8', errors='ignore').strip() if e.stderr else e}")
+        raise UnsupportedMedia("The file could not be read as video")
+    except OSError as e:
+        logger.warning(f"Could not probe {input_path}: {e}")
+        return None
+    check_probe(probe)
+    return probe
+
+def probe_duration(probe):
+    """Media duration in seconds from a probe result, or None when unknown."""
+    try:
+        return float(probe["format"]["duration"])
+    except (TypeError, KeyError, ValueError):
+        return None
+
+async def submit_job(file_id, input_path, original_filename, content_hash, client_id=None, profiles=(DEFAULT_ENCODE_PROFILE,),
+                     clip_ranges=None):
+    """Register a fully received upload: serve it from the cache or queue it for conversion."""
+    profile_name = profiles[0]
+    output_paths = get_output_paths(file_id, profiles)
+    output_path = output_paths[profile_name]
+    # The output cache holds single outputs; multi-output jobs are always converted
+    cache_key = cache.make_cache_key(content_hash, cache.get_encode_settings(profile_name, clip_ranges)) if len(profiles) == 1 else None
+    
+    # Same content already converted with the same settings: complete without queueing
+    cached = cache_key and await cache.lookup(redis_client, cache_key, os.path.splitext(output_path)[0])
+    if cached:
+        logger.info(f"Cache hit for job {file_id} ({cache_key}), skipping the queue")
+        os.remove(input_path)
+        job_data = {
+            "file_id": file_id,
+            "original_filename": original_filename,
+            "status": "completed",
+            "progress": 100,
+            "message": "Conversion completed (cached)",
+            "created_at": datetime.now().isoformat(),
+            "cache_key": cache_key,
+            "cache_hit": "true",
+            "profile": profile_name,
+            **cached,
+        }
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(f"job:{file_id}", mapping={k: str(v) for k, v in job_data.items()})
+            pipe.hincrby(f"job:{file_id}", "version", 1)
+            publish_progress(pipe, file_id, "completed", 100, job_data["message"])
+            schedule_file_deletion(pipe, cached["output_path"])
+            await pipe.execute()
+        return {
+            "file_id": file_id,
+            "status": "completed",
+            "message": "File matched a previous conversion and is ready for download"
+        }
+    
+    # Quick probe before the job takes a queue slot: it must have audio we can decode
+    try:
+        probe = await probe_upload(input_path)
+    except UnsupportedMedia as e:
+        logger.warning(f"Rejecting upload {file_id} ({original_filename}): {e}")
+        os.remove(input_path)
+        raise media_error(e)
+    
+    # Add conversion job to Redis queue, ordered by its duration (shortest job first)
+    duration = probe_duration(probe)
+    if clip_ranges:
+        # Only the clipped regions are decoded, so they are what the job costs
+        clips = clip_ranges_within(clip_ranges, duration)
+        if not clips:
+            os.remove(input_path)
+            raise HTTPException(status_code=400, detail=f"Clip ranges are outside the input ({duration:.1f}s)")
+        duration = clip_duration(clips)
+    job_data = {
+        "file_id": file_id,
+        "input_path": input_path,
+        "output_path": output_path,
+        "original_filename": original_filename,
+        "status": "queued",
+        "created_at": datetime.now().isoformat(),
+        "profile": profile_name,
+    }
+    if cache_key:
+        job_data["cache_key"] = cache_key
+    if len(output_paths) > 1:
+        job_data["outputs"] = json.dumps(output_paths)
+    if clip_ranges:
+        job_data["clip_ranges"] = json.dumps(clip_ranges)
+    if duration is not None:
+        job_data["duration"] = str(duration)
+    if client_id:
+        job_data["client_id"] = client_id
+    
+    backlog = int(await redis_client.hget(jobqueue.CLIENT_JOBS_KEY, client_id) or 0) if client_id else 0
+    score = jobqueue.job_score(duration, backlog)
+    
+    # One MULTI: the hash is written before the job becomes visible on the queue
+    logger.info(f"Adding job {file_id} to Redis queue (duration: {duration}, client: {client_id})")
+    logger.info(f"Scheduling deletion for {input_path} and {', '.join(output_paths.values())} (Job: {file_id})")
+    async with redis_client.pipeline(transaction=True) as pipe:
+        # Store full job details in the hash
+        pipe.hset(f"job:{file_id}", mapping=job_data)
+        pipe.hincrby(f"job:{file_id}", "version", 1)
+        publish_progress(pipe, file_id, "queued")
+        # Queue only the file_id, worker fetches details via hash
+        jobqueue.add_to_queue(pipe, file_id, score, client_id, duration)
+        schedule_file_deletion(pipe, input_path)
+        for path in output_paths.values():
+            schedule_file_deletion(pipe, path)
+        await pipe.execute()
+    
+    logger.info(f"Upload successful for job {file_id}, returning response.")
+    return {
+        "file_id": file_id,
+        "status": "queued",
+        "message": "File uploaded successfully and queued for conversion"
+    }
+
+async def get_upload_session(upload_id):
+    """Load a chunked upload session from Redis, or raise 404."""
+    session = await redis_client.hgetall(f"upload:{upload_id}")
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    session = {k.decode('utf-8'): v.decode('utf-8') for k, v in session.items()}
+    for key in ("size", "chunk_size", "total_chunks"):
+        session[key] = int(session[key])
+    return session
+
+async def describe_upload_session(upload_id, session):
+    """Build the UploadSessionResponse for a session, merging received chunks into byte ranges."""
+    received = sorted(int(i) for i in await redis_client.smembers(f"upload:{upload_id}:chunks"))
+    size, chunk_size = session["size"], session["chunk_size"]
+    
+    ranges = []
+    for index in received:
+        start, end = index * chunk_size, min(size, (index + 1) * chunk_size)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    
+    received_set = set(received)
+    return UploadSessionResponse(
+        upload_id=upload_id,
+        filename=session["filename"],
+        size=size,
+        chunk_size=chunk_size,
+        total_chunks=session["total_chunks"],
+        received_chunks=len(received),
+        received_ranges=ranges,
+        missing_chunks=[i for i in range(session["total_chunks"]) if i not in received_set],
+    )
+
+def hash_file(path):
+    """SHA-256 of a file on disk, read in 1MB chunks."""
+    content_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while content := f.read(1024 * 1024):
+            content_hash.update(content)
+    return content_hash.hexdigest()
 
 # Create API router
 api_router = APIRouter()
@@ -107,13 +427,25 @@ async def root():
     logger.info("Root endpoint / accessed")
     return {"message": "Video to MP3 Converter API"}
 
+@api_router.get("/profiles")
+async def list_profiles():
+    """List the encode profiles an upload can select."""
+    return {"default": DEFAULT_ENCODE_PROFILE, "profiles": ENCODE_PROFILES}
+
 @api_router.post("/upload/")
-async def upload_video(file: UploadFile = File(...)):
-    """Upload a video file for conversion."""
+async def upload_video(request: Request, file: UploadFile = File(...), profile: Optional[str] = Form(None),
+                       start: Optional[float] = Form(None), end: Optional[float] = Form(None), ranges: Optional[str] = Form(None)):
+    """Upload a video file for conversion (optionally with named encode profiles, comma-separated).
+
+    ``start``/``end`` (seconds) or ``ranges`` (``"30-90,120-180"``) convert only those parts of the input.
+    """
     logger.info(f"Upload request received for file: {file.filename}")
     if not is_valid_video_format(file.filename):
         logger.warning(f"Upload failed: Invalid video format for {file.filename}")
         raise HTTPException(status_code=400, detail="Invalid video format")
+    profiles = resolve_profiles(profile)
+    clip_ranges = parse_clip_ranges(start, end, ranges)
+    check_declared_size(file.size)
     
     # Generate unique ID for this conversion
     file_id = str(uuid.uuid4())
@@ -124,125 +456,775 @@ async def upload_video(file: UploadFile = File(...)):
     
     # Create file paths
     input_path = get_file_path(file_id, ext)
-    output_path = get_output_path(file_id)
+    
+    # Look at the content before anything is written
+    content = await file.read(1024 * 1024)  # 1MB chunks
+    try:
+        check_head(content, file.filename)
+    except UnsupportedMedia as e:
+        logger.warning(f"Upload failed: {e}")
+        raise media_error(e)
     
     # Save uploaded file
     try:
         logger.info(f"Saving uploaded file {file.filename} to {input_path}")
+        content_hash = hashlib.sha256()
+        received = 0
         async with aiofiles.open(input_path, 'wb') as out_file:
             # Read and write in chunks to handle large files
-            while content := await file.read(1024 * 1024):  # 1MB chunks
+            while content:
+                received += len(content)
+                if received > MAX_FILE_SIZE:
+                    raise FileTooLarge(f"File exceeds maximum size of {MAX_FILE_SIZE} bytes")
+                content_hash.update(content)
                 await out_file.write(content)
+                content = await file.read(1024 * 1024)
         logger.info(f"Successfully saved file {file.filename} to {input_path}")
+    except FileTooLarge:
+        logger.warning(f"Upload failed: {file.filename} exceeds {MAX_FILE_SIZE} bytes")
+        os.remove(input_path)
+        raise file_too_large()
     except Exception as e:
         logger.error(f"Failed to save file {file.filename} to {input_path}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
     
-    # Add conversion job to Redis queue
-    job_data = {
+    return await submit_job(file_id, input_path, file.filename, content_hash.hexdigest(), get_client_id(request), profiles, clip_ranges)
+
+@api_router.put("/upload/raw")
+async def upload_video_raw(request: Request, filename: str, profile: Optional[str] = None,
+                           start: Optional[float] = None, end: Optional[float] = None, ranges: Optional[str] = None):
+    """Upload a video as the raw request body (``application/octet-stream``) and queue it like ``/upload/``.
+
+    The body goes straight from the socket to the job's input path: there is no multipart
+    spool file, so every byte is written to disk once. Takes the same options as ``/upload/``
+    as query parameters.
+    """
+    logger.info(f"Raw upload request received for file: {filename}")
+    if not is_valid_video_format(filename):
+        logger.warning(f"Upload failed: Invalid video format for {filename}")
+        raise HTTPException(status_code=400, detail="Invalid video format")
+    if request.headers.get("content-type", "").startswith("multipart/"):
+        raise HTTPException(status_code=415, detail="Send the file itself as the body; use /api/upload/ for multipart forms")
+    profiles = resolve_profiles(profile)
+    clip_ranges = parse_clip_ranges(start, end, ranges)
+    declared_size = get_content_length(request)
+    check_declared_size(declared_size)
+    
+    file_id = str(uuid.uuid4())
+    _, ext = os.path.splitext(filename)
+    input_path = get_file_path(file_id, ext)
+    logger.info(f"Saving raw upload {filename} to {input_path} (Job: {file_id})")
+    
+    content_hash = hashlib.sha256()
+    received = 0
+    buffer = bytearray()
+    out_file = None
+    saved = False
+    try:
+        async for content in request.stream():
+            received += len(content)
+            if received > MAX_FILE_SIZE:
+                raise FileTooLarge(f"File exceeds maximum size of {MAX_FILE_SIZE} bytes")
+            content_hash.update(content)
+            buffer += content
+            if out_file is None:
+                # Nothing touches the disk until the content looks like video
+                if len(buffer) < SNIFF_BYTES:
+                    continue
+                check_head(bytes(buffer[:SNIFF_BYTES]), filename)
+                out_file = await aiofiles.open(input_path, 'wb')
+            if len(buffer) >= RAW_UPLOAD_WRITE_SIZE:
+                await out_file.write(buffer)
+                buffer.clear()
+        if out_file is None:
+            check_head(bytes(buffer), filename)
+            out_file = await aiofiles.open(input_path, 'wb')
+        await out_file.write(buffer)
+        saved = True
+    except UnsupportedMedia as e:
+        logger.warning(f"Upload failed: {e}")
+        raise media_error(e)
+    except FileTooLarge:
+        logger.warning(f"Upload failed: {filename} exceeds {MAX_FILE_SIZE} bytes")
+        raise file_too_large()
+    except Exception as e:
+        logger.error(f"Failed to save raw upload {filename} to {input_path}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
+    finally:
+        if out_file is not None:
+            await out_file.close()
+            # No partial inputs are left behind
+            if not saved:
+                os.remove(input_path)
+    
+    if declared_size is not None and received != declared_size:
+        os.remove(input_path)
+        raise HTTPException(status_code=400, detail=f"Upload incomplete: received {received} of {declared_size} bytes")
+    logger.info(f"Successfully saved raw upload {filename} ({received} bytes) to {input_path}")
+    return await submit_job(file_id, input_path, filename, content_hash.hexdigest(), get_client_id(request), profiles, clip_ranges)
+
+@api_router.post("/upload/stream")
+async def upload_video_stream(request: Request, filename: str, file_id: Optional[str] = None, profile: Optional[str] = None,
+                              start: Optional[float] = None, end: Optional[float] = None, ranges: Optional[str] = None):
+    """Upload a video as the raw request body, converting it while it arrives when possible.
+
+    Streamable containers (mkv, webm, flv, fragmented mp4) are piped into ffmpeg as the
+    bytes come in and the response is sent once the output is ready. Other inputs, or all
+    inputs when streaming is disabled or busy, are saved and queued like ``/upload/``, as are
+    clips (``start``/``end``/``ranges``), which need input-side seeking.
+    Clients may pass their own ``file_id`` (UUID) to follow progress on the WebSocket.
+    """
+    logger.info(f"Streaming upload request received for file: {filename}")
+    if not is_valid_video_format(filename):
+        logger.warning(f"Upload failed: Invalid video format for {filename}")
+        raise HTTPException(status_code=400, detail="Invalid video format")
+    profiles = resolve_profiles(profile)
+    clip_ranges = parse_clip_ranges(start, end, ranges)
+    
+    if file_id is not None:
+        try:
+            file_id = str(uuid.UUID(file_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="file_id must be a UUID")
+        if await redis_client.exists(f"job:{file_id}"):
+            raise HTTPException(status_code=409, detail="file_id already in use")
+    else:
+        file_id = str(uuid.uuid4())
+    
+    total_bytes = get_content_length(request)
+    check_declared_size(total_bytes)
+    
+    # Buffer just enough of the body to tell whether the container can be read from a pipe
+    chunks = request.stream().__aiter__()
+    head = b""
+    try:
+        while len(head) < STREAM_SNIFF_BYTES:
+            head += await chunks.__anext__()
+    except StopAsyncIteration:
+        pass
+    try:
+        check_head(head, filename)
+    except UnsupportedMedia as e:
+        logger.warning(f"Upload failed: {e}")
+        raise media_error(e)
+    
+    received = len(head)
+    
+    async def body(digest=None):
+        nonlocal received
+        if digest:
+            digest.update(head)
+        yield head
+        async for content in chunks:
+            # Bodies without (or with a wrong) Content-Length are limited as they arrive
+            received += len(content)
+            if received > MAX_FILE_SIZE:
+                raise FileTooLarge(f"File exceeds maximum size of {MAX_FILE_SIZE} bytes")
+            if digest:
+                digest.update(content)
+            yield content
+    
+    _, ext = os.path.splitext(filename)
+    streamable = STREAMING_CONVERSION and not clip_ranges and is_streamable_input(filename, head)
+    if not streamable or streaming_slots.locked():
+        # Needs seeking (or no free slot): store the input and use the queue
+        logger.info(f"Job {file_id}: {'no free streaming slot' if streamable else 'input not streamable'}, falling back to queued conversion")
+        input_path = get_file_path(file_id, ext)
+        content_hash = hashlib.sha256()
+        try:
+            async with aiofiles.open(input_path, 'wb') as out_file:
+                async for content in body(content_hash):
+                    await out_file.write(content)
+        except FileTooLarge:
+            logger.warning(f"Upload failed: {filename} exceeds {MAX_FILE_SIZE} bytes")
+            os.remove(input_path)
+            raise file_too_large()
+        except Exception as e:
+            logger.error(f"Failed to save file {filename} to {input_path}: {e}", exc_info=True)
+            raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
+        return await submit_job(file_id, input_path, filename, content_hash.hexdigest(), get_client_id(request), profiles, clip_ranges)
+    
+    async with streaming_slots:
+        output_paths = get_output_paths(file_id, profiles)
+        output_path = output_paths.pop(profiles[0])
+        job_data = {
+            "file_id": file_id,
+            "output_path": output_path,
+            "original_filename": filename,
+            "status": "processing",
+            "progress": 0,
+            "conversion_mode": "stream",
+            "output_format": get_profile(profiles[0])["format"],
+            "profile": profiles[0],
+            "created_at": datetime.now().isoformat(),
+        }
+        if output_paths:
+            job_data["outputs"] = json.dumps({profiles[0]: output_path, **output_paths})
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(f"job:{file_id}", mapping={k: str(v) for k, v in job_data.items()})
+            pipe.hincrby(f"job:{file_id}", "version", 1)
+            publish_progress(pipe, file_id, "processing")
+            schedule_file_deletion(pipe, output_path)
+            for path in output_paths.values():
+                schedule_file_deletion(pipe, path)
+            await pipe.execute()
+        
+        logger.info(f"Job {file_id}: converting {filename} while it uploads")
+        success = await convert_stream_to_mp3(redis_client, body(), output_path, file_id, total_bytes, profiles[0], output_paths)
+    
+    if not success:
+        if received > MAX_FILE_SIZE:
+            raise file_too_large()
+        raise HTTPException(status_code=422, detail="Conversion failed")
+    return {
         "file_id": file_id,
+        "status": "completed",
+        "message": "File converted while uploading"
+    }
+
+@api_router.post("/uploads/", response_model=UploadSessionResponse)
+async def create_upload_session(request: UploadSessionRequest):
+    """Start a resumable upload whose chunks can be sent separately and in parallel."""
+    logger.info(f"Chunked upload session requested for {request.filename} ({request.size} bytes)")
+    if not is_valid_video_format(request.filename):
+        raise HTTPException(status_code=400, detail="Invalid video format")
+    profiles = resolve_profiles(request.profile)
+    clip_ranges = parse_clip_ranges(request.start, request.end, request.ranges)
+    if request.size <= 0:
+        raise HTTPException(status_code=400, detail="Upload size must be positive")
+    if request.size > MAX_FILE_SIZE:
+        raise HTTPException(status_code=413, detail=f"File exceeds maximum size of {MAX_FILE_SIZE} bytes")
+    
+    chunk_size = min(request.chunk_size or UPLOAD_CHUNK_SIZE, MAX_UPLOAD_CHUNK_SIZE)
+    if chunk_size <= 0:
+        raise HTTPException(status_code=400, detail="Chunk size must be positive")
+    total_chunks = -(-request.size // chunk_size)
+    
+    # The upload id doubles as the job's file_id once finalized
+    upload_id = str(uuid.uuid4())
+    _, ext = os.path.splitext(request.filename)
+    input_path = get_file_path(upload_id, ext)
+    
+    # Allocate the target file so chunks can be written in place at their offsets
+    with open(input_path, 'wb') as f:
+        f.truncate(request.size)
+    
+    session = {
+        "filename": request.filename,
+        "size": request.size,
+        "chunk_size": chunk_size,
+        "total_chunks": total_chunks,
         "input_path": input_path,
-        "output_path": output_path,
-        "original_filename": file.filename,
-        "status": "queued",
+        "profile": ",".join(profiles),
         "created_at": datetime.now().isoformat(),
     }
+    if clip_ranges:
+        session["clip_ranges"] = json.dumps(clip_ranges)
+    ttl = FILE_RETENTION_HOURS * 3600
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(f"upload:{upload_id}", mapping={k: str(v) for k, v in session.items()})
+        pipe.expire(f"upload:{upload_id}", ttl)
+        schedule_file_deletion(pipe, input_path)
+        await pipe.execute()
     
-    logger.info(f"Adding job {file_id} to Redis queue")
-    # Push only the file_id to the queue, worker fetches details via hash
-    redis_client.lpush("conversion_queue", json.dumps({"file_id": file_id}))
-    # Store full job details in the hash
-    redis_client.hset(f"job:{file_id}", mapping=job_data)
+    logger.info(f"Created upload session {upload_id}: {total_chunks} chunk(s) of {chunk_size} bytes")
+    return await describe_upload_session(upload_id, await get_upload_session(upload_id))
+
+async def discard_upload_session(upload_id, session):
+    """Drop a chunked upload session and its partially received file."""
+    if os.path.exists(session["input_path"]):
+        os.remove(session["input_path"])
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.delete(f"upload:{upload_id}", f"upload:{upload_id}:chunks")
+        pipe.zrem("file_expiry", session["input_path"])
+        await pipe.execute()
+
+async def check_upload_session_head(upload_id, session, head):
+    """Sniff the first chunk of a chunked upload; a file that is not video ends the session."""
+    try:
+        check_head(head, session["filename"])
+    except UnsupportedMedia as e:
+        logger.warning(f"Discarding upload session {upload_id}: {e}")
+        await discard_upload_session(upload_id, session)
+        raise media_error(e)
+
+@api_router.put("/uploads/{upload_id}/chunks/{index}")
+async def upload_chunk(upload_id: str, index: int, request: Request):
+    """Receive one chunk (raw request body) and write it at its offset in the target file."""
+    session = await get_upload_session(upload_id)
+    if session.get("finalized"):
+        raise HTTPException(status_code=409, detail="Upload already finalized")
+    if index < 0 or index >= session["total_chunks"]:
+        raise HTTPException(status_code=400, detail=f"Chunk index must be between 0 and {session['total_chunks'] - 1}")
     
-    # Schedule file deletion
-    logger.info(f"Scheduling deletion for {input_path} and {output_path} (Job: {file_id})")
-    schedule_file_deletion(input_path)
-    schedule_file_deletion(output_path)
+    offset = index * session["chunk_size"]
+    expected = min(session["chunk_size"], session["size"] - offset)
     
-    logger.info(f"Upload successful for job {file_id}, returning response.")
-    return {
-        "file_id": file_id,
-        "status": "queued",
-        "message": "File uploaded successfully and queued for conversion"
+    # The first chunk is sniffed before any of it is written
+    head = b"" if index == 0 else None
+    written = 0
+    async with aiofiles.open(session["input_path"], 'r+b') as out_file:
+        await out_file.seek(offset)
+        async for content in request.stream():
+            written += len(content)
+            if written > expected:
+                raise HTTPException(status_code=400, detail=f"Chunk {index} exceeds its expected length of {expected} bytes")
+            if head is not None:
+                head += content
+                if len(head) < min(SNIFF_BYTES, expected):
+                    continue
+                await check_upload_session_head(upload_id, session, head)
+                content, head = head, None
+            await out_file.write(content)
+        if head:
+            await check_upload_session_head(upload_id, session, head)
+            await out_file.write(head)
+    
+    if written != expected:
+        raise HTTPException(status_code=400, detail=f"Chunk {index} is incomplete: received {written} of {expected} bytes")
+    
+    async with redis_client.pipeline() as pipe:
+        pipe.sadd(f"upload:{upload_id}:chunks", index)
+        pipe.expire(f"upload:{upload_id}:chunks", FILE_RETENTION_HOURS * 3600)
+        await pipe.execute()
+    logger.debug(f"Stored chunk {index} of upload {upload_id} ({written} bytes at offset {offset})")
+    return {"upload_id": upload_id, "index": index, "received": written}
+
+@api_router.get("/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def get_upload_session_status(upload_id: str):
+    """Report which byte ranges of a chunked upload have been received."""
+    return await describe_upload_session(upload_id, await get_upload_session(upload_id))
+
+@api_router.post("/uploads/{upload_id}/complete")
+async def complete_upload_session(upload_id: str, request: Request):
+    """Finalize a chunked upload and hand it to the conversion pipeline."""
+    session = await get_upload_session(upload_id)
+    state = await describe_upload_session(upload_id, session)
+    if state.missing_chunks:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Upload incomplete: {len(state.missing_chunks)} chunk(s) missing",
+        )
+    
+    # Only one finalize request may submit the job
+    if not await redis_client.hsetnx(f"upload:{upload_id}", "finalized", datetime.now().isoformat()):
+        raise HTTPException(status_code=409, detail="Upload already finalized")
+    
+    logger.info(f"Finalizing chunked upload {upload_id} ({session['size']} bytes)")
+    content_hash = await asyncio.to_thread(hash_file, session["input_path"])
+    try:
+        response = await submit_job(
+            upload_id, session["input_path"], session["filename"], content_hash, get_client_id(request),
+            session.get("profile", DEFAULT_ENCODE_PROFILE).split(","),
+            json.loads(session["clip_ranges"]) if session.get("clip_ranges") else None,
+        )
+    except HTTPException:
+        # Rejected by the upload probe: the session cannot be completed any more
+        await discard_upload_session(upload_id, session)
+        raise
+    await redis_client.delete(f"upload:{upload_id}", f"upload:{upload_id}:chunks")
+    return response
+
+async def build_statuses(jobs):
+    """Status responses of jobs from their raw Redis hashes (``{file_id: hash}``)."""
+    # Convert bytes to string for JSON response
+    results = {
+        file_id: {k.decode('utf-8'): v.decode('utf-8') for k, v in job_data.items()}
+        for file_id, job_data in jobs.items()
     }
+    for file_id, result in results.items():
+        if "outputs" in result:
+            # Every output of a multi-output job has its own download URL
+            result["outputs"] = {name: f"/api/download/{file_id}/{name}" for name in json.loads(result["outputs"])}
+    queued = [file_id for file_id, result in results.items() if result.get("status") == "queued"]
+    if queued:
+        positions = await jobqueue.get_queue_positions(redis_client, queued)
+        for file_id, (position, estimated_start) in positions.items():
+            results[file_id]["queue_position"] = position
+            results[file_id]["estimated_start"] = estimated_start.isoformat() if estimated_start else None
+    return results
+
+def status_etag(result):
+    """ETag of a status response: the job's version, plus its queue position while queued.
+
+    The estimated start is left out: it is recomputed from the clock on every request.
+    """
+    version = result.get("version")
+    if version is None:
+        return None  # job written before versioning
+    if "queue_position" in result:
+        return f'"{version}-q{result["queue_position"]}"'
+    return f'"{version}"'
+
+async def wait_for_change(file_id, since, timeout):
+    """Hold a long-poll until the job's version differs from ``since`` or ``timeout`` expires.
+
+    Woken by the job's progress events on PROGRESS_CHANNEL (relayed by this process), so a
+    parked request costs one HGET per change instead of one HGETALL per client poll.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        # Watch before reading, so a change published in between still wakes us
+        with status_waiters.watch(file_id) as changed:
+            version = await redis_client.hget(f"job:{file_id}", "version")
+            if version is None or int(version) != since:
+                return
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(changed, remaining)
+            except asyncio.TimeoutError:
+                return
+
+@api_router.post("/status/batch", response_model=StatusBatchResponse)
+async def get_conversion_status_batch(batch: StatusBatchRequest):
+    """Status of several jobs from one pipelined read of their hashes.
+
+    Unknown jobs (and jobs whose state does not fit StatusResponse) are reported per item
+    instead of failing the request.
+    """
+    file_ids = list(dict.fromkeys(batch.file_ids))
+    if len(file_ids) > MAX_STATUS_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_STATUS_BATCH} file_ids per request")
+    logger.debug(f"Batch status request for {len(file_ids)} job(s)")
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for file_id in file_ids:
+            pipe.hgetall(f"job:{file_id}")
+        hashes = await pipe.execute()
+    results = await build_statuses({file_id: job_data for file_id, job_data in zip(file_ids, hashes) if job_data})
+    
+    items = []
+    for file_id in file_ids:
+        if file_id not in results:
+            items.append(StatusBatchItem(file_id=file_id, error="Job not found"))
+            continue
+        try:
+            items.append(StatusBatchItem(file_id=file_id, job=StatusResponse.model_validate(results[file_id])))
+        except ValidationError as e:
+            logger.warning(f"Job {file_id} does not fit StatusResponse: {e}")
+            items.append(StatusBatchItem(file_id=file_id, error="Invalid job state"))
+    return StatusBatchResponse(items=items)
 
 @api_router.get("/status/{file_id}")
-async def get_conversion_status(file_id: str):
-    """Get the status of a conversion job."""
-    logger.info(f"Status request received for job {file_id}")
-    job_data = redis_client.hgetall(f"job:{file_id}")
+async def get_conversion_status(file_id: str, request: Request, wait: float = Query(0, ge=0), since: Optional[int] = None):
+    """Get the status of a conversion job.
+
+    Responses carry the job's ``version`` and an ``ETag``; ``If-None-Match`` is answered with
+    304 while nothing changed. With ``?since=<version>&wait=<seconds>`` the request is held
+    until the version differs from ``since`` or ``wait`` (capped at STATUS_MAX_WAIT_SECONDS) expires.
+    """
+    logger.debug(f"Status request received for job {file_id} (since={since}, wait={wait})")
+    if since is not None and wait > 0:
+        await wait_for_change(file_id, since, min(wait, STATUS_MAX_WAIT_SECONDS))
+    job_data = await redis_client.hgetall(f"job:{file_id}")
     
     if not job_data:
         logger.warning(f"Status request failed: Job {file_id} not found")
         raise HTTPException(status_code=404, detail="Job not found")
     
-    # Convert bytes to string for JSON response
-    result = {k.decode('utf-8'): v.decode('utf-8') for k, v in job_data.items()}
-    logger.info(f"Returning status for job {file_id}: {result}")
-    return result
-
-@api_router.get("/download/{file_id}")
-async def download_mp3(file_id: str, background_tasks: BackgroundTasks):
-    """Download the converted MP3 file."""
-    logger.info(f"Download request received for job {file_id}")
-    output_path = get_output_path(file_id)
-    
-    # Check if file exists
-    if not os.path.exists(output_path):
-        logger.warning(f"Download failed: Output file not found for job {file_id} at {output_path}")
-        raise HTTPException(status_code=404, detail="File not found or conversion not completed")
+    result = (await build_statuses({file_id: job_data}))[file_id]
+    headers = {"cache-control": "no-cache"}
+    etag = status_etag(result)
+    if etag:
+        headers["etag"] = etag
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+    logger.debug(f"Returning status for job {file_id}: {result}")
+    return JSONResponse(result, headers=headers)
+
+async def delete_downloaded_output(file_id, output_path):
+    """Remove a fully downloaded output, and the job once none of its outputs is left."""
+    try:
+        logger.info(f"Performing deletion after download for job {file_id}, file {output_path}")
+        # Delete the file immediately
+        if os.path.exists(output_path):
+            os.remove(output_path)
+            logger.info(f"Deleted file {output_path} after download (Job: {file_id})")
+        outputs = await redis_client.hget(f"job:{file_id}", "outputs")
+        remaining = [path for path in json.loads(outputs or "{}").values() if os.path.exists(path)]
+        # Remove from scheduled deletion and delete the job data
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.zrem("file_expiry", output_path)
+            if not remaining:
+                pipe.delete(f"job:{file_id}")
+            await pipe.execute()
+        if remaining:
+            logger.info(f"Kept Redis job data for job {file_id}: {len(remaining)} output(s) not downloaded yet")
+        else:
+            logger.info(f"Deleted Redis job data for job {file_id}")
+    except Exception as e:
+        logger.error(f"Error during deletion after download for job {file_id}: {e}", exc_info=True)
+
+def delivered_ranges_field(profile_name=None):
+    """Job hash field tracking the delivered bytes of an output (the primary one when no profile is given)."""
+    return f"delivered_ranges:{profile_name}" if profile_name else "delivered_ranges"
+
+async def finish_download(file_id, output_path, start, end, size, profile_name=None):
+    """Record a fully sent byte range and apply the delete-after-download policy."""
+    # Only delete once the whole file has reached the client, possibly over several ranges
+    if DELETE_AFTER_DOWNLOAD != "complete":
+        return
+    if await record_delivered_range(redis_client, file_id, start, end, size, delivered_ranges_field(profile_name), PROGRESS_CHANNEL):
+        await delete_downloaded_output(file_id, output_path)
+
+async def accel_redirect_response(file_id, output_path, start, end, size, headers, profile_name=None):
+    """Hand the transfer to nginx, keeping a ticket so it can report back when done."""
+    ticket = secrets.token_urlsafe(24)
+    async with redis_client.pipeline() as pipe:
+        pipe.hset(f"download_ticket:{ticket}", mapping={
+            "file_id": file_id,
+            "output_path": output_path,
+            "profile": profile_name or "",
+            "start": start,
+            "end": end,
+            "size": size,
+        })
+        pipe.expire(f"download_ticket:{ticket}", DOWNLOAD_TICKET_TTL_SECONDS)
+        await pipe.execute()
     
-    # Get original filename from Redis
-    job_data = redis_client.hgetall(f"job:{file_id}")
+    relative_path = os.path.relpath(output_path, STORAGE_PATH)
+    # nginx re-applies Range/conditional handling itself; we only pass the headers it keeps
+    logger.info(f"Redirecting download of {output_path} to nginx (Job: {file_id})")
+    return Response(headers={
+        "X-Accel-Redirect": f"{ACCEL_REDIRECT_PREFIX}/{quote(relative_path)}?ticket={ticket}",
+        "Content-Type": headers["content-type"],
+        "Content-Disposition": headers["content-disposition"],
+        "Accept-Ranges": "bytes",
+    })
+
+@api_router.api_route("/download/{file_id}", methods=["GET", "HEAD"])
+async def download_mp3(file_id: str, request: Request):
+    """Download the converted MP3 file (supports Range, HEAD and conditional requests)."""
+    logger.info(f"Download request received for job {file_id} ({request.method}, Range: {request.headers.get('range')})")
+    return await serve_output(file_id, request)
+
+@api_router.api_route("/download/{file_id}/{profile}", methods=["GET", "HEAD"])
+async def download_output(file_id: str, profile: str, request: Request):
+    """Download one output of a job by its encode profile (same semantics as ``/download/{file_id}``)."""
+    logger.info(f"Download request received for job {file_id}, profile {profile} ({request.method}, Range: {request.headers.get('range')})")
+    return await serve_output(file_id, request, profile)
+
+async def serve_output(file_id, request, profile_name=None):
+    """Send a completed job's output: the primary one, or the output of ``profile_name``."""
+    # Get original filename and actual output path from Redis
+    job_data = await redis_client.hgetall(f"job:{file_id}")
     if not job_data:
         logger.warning(f"Download failed: Job info not found for job {file_id}")
         raise HTTPException(status_code=404, detail="Job information not found")
     
+    # The primary output is tracked as before; only the extra outputs of a job are named by profile
+    if profile_name == job_data.get(b"profile", DEFAULT_ENCODE_PROFILE.encode()).decode('utf-8'):
+        profile_name = None
+    if profile_name:
+        outputs = json.loads(job_data.get(b"outputs", b"{}"))
+        if profile_name not in outputs:
+            logger.warning(f"Download failed: Job {file_id} has no {profile_name} output")
+            raise HTTPException(status_code=404, detail=f"Job has no output for profile '{profile_name}'")
+        output_path = outputs[profile_name]
+    else:
+        # The worker may have stream-copied into a different container (e.g. .m4a)
+        output_path = job_data.get(b"output_path", get_output_path(file_id).encode()).decode('utf-8')
+    
+    # Check if file exists (and the job is done, so we never serve a file ffmpeg is still writing)
+    if job_data.get(b"status") != b"completed" or not os.path.exists(output_path):
+        logger.warning(f"Download failed: Output file not found for job {file_id} at {output_path}")
+        raise HTTPException(status_code=404, detail="File not found or conversion not completed")
+    
     original_filename = job_data.get(b"original_filename", b"download").decode('utf-8')
     filename_base = os.path.splitext(original_filename)[0]
-    download_filename = f"{filename_base}.mp3"
+    output_ext = os.path.splitext(output_path)[1]
+    download_filename = f"{filename_base}{output_ext}"
     
-    # Schedule file for deletion after download
-    def delete_after_download():
-        try:
-            logger.info(f"Performing background deletion for job {file_id}, file {output_path}")
-            # Remove from scheduled deletion
-            redis_client.zrem("file_expiry", output_path)
-            # Delete the file immediately
-            if os.path.exists(output_path):
-                os.remove(output_path)
-                logger.info(f"Deleted file {output_path} after download (Job: {file_id})")
-            # Delete the job data
-            redis_client.delete(f"job:{file_id}")
-            logger.info(f"Deleted Redis job data for job {file_id}")
-        except Exception as e:
-            logger.error(f"Error during background deletion for job {file_id}: {e}", exc_info=True)
-    
-    background_tasks.add_task(delete_after_download)
-    logger.info(f"Sending file {output_path} for download (Job: {file_id})")
-    return FileResponse(
-        path=output_path,
-        filename=download_filename,
-        media_type="audio/mpeg"
+    stat_result = os.stat(output_path)
+    size = stat_result.st_size
+    headers = file_headers(output_path, stat_result, get_media_type(output_path), download_filename)
+    
+    # Conditional requests: the client's copy is current
+    if_none_match = request.headers.get("if-none-match")
+    if etag_matches(if_none_match, headers["etag"]) or (
+        if_none_match is None and not_modified_since(request.headers.get("if-modified-since"), stat_result.st_mtime)
+    ):
+        return Response(status_code=304, headers={k: v for k, v in headers.items() if k in ("etag", "last-modified")})
+    
+    # Honour Range unless If-Range names a different version of the file
+    if_range = request.headers.get("if-range")
+    range_header = request.headers.get("range")
+    if if_range and not (etag_matches(if_range, headers["etag"]) or if_range == headers["last-modified"]):
+        range_header = None
+    try:
+        byte_range = parse_range(range_header, size)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers={"content-range": f"bytes */{size}"})
+    
+    if byte_range:
+        start, end = byte_range
+        status_code = 206
+        headers["content-range"] = f"bytes {start}-{end}/{size}"
+    else:
+        start, end = 0, size - 1
+        status_code = 200
+    
+    if DOWNLOAD_MODE == "x-accel" and request.method == "GET":
+        return await accel_redirect_response(file_id, output_path, start, end, size, headers, profile_name)
+    
+    async def on_complete(start, end):
+        await finish_download(file_id, output_path, start, end, size, profile_name)
+    
+    logger.info(f"Sending bytes {start}-{end}/{size} of {output_path} (Job: {file_id})")
+    return FileRangeResponse(
+        output_path,
+        start,
+        end,
+        status_code=status_code,
+        headers=headers,
+        send_body=request.method != "HEAD",
+        on_complete=on_complete,
     )
 
+@api_router.post("/internal/download-complete")
+async def download_complete(ticket: str, completion: str = "", bytes_sent: int = Query(0, alias="bytes"),
+                            callback_secret: str = Header("", alias="X-Download-Callback-Secret")):
+    """Called by nginx (post_action) after it finished an X-Accel-Redirect download.
+
+    Clients that reach the backend directly see the ticket in ``X-Accel-Redirect``, so the
+    callback must also carry DOWNLOAD_CALLBACK_SECRET, which only nginx sends.
+    """
+    if not DOWNLOAD_CALLBACK_SECRET or not secrets.compare_digest(callback_secret, DOWNLOAD_CALLBACK_SECRET):
+        logger.warning("Rejected download-complete callback without a valid secret")
+        raise HTTPException(status_code=404, detail="Not found")
+    key = f"download_ticket:{ticket}"
+    async with redis_client.pipeline() as pipe:
+        pipe.hgetall(key)
+        pipe.delete(key)
+        download, _ = await pipe.execute()
+    if not download:
+        raise HTTPException(status_code=404, detail="Unknown download ticket")
+    
+    download = {k.decode('utf-8'): v.decode('utf-8') for k, v in download.items()}
+    start, end, size = int(download["start"]), int(download["end"]), int(download["size"])
+    file_id = download["file_id"]
+    logger.info(f"nginx finished download of job {file_id}: completion={completion!r}, {bytes_sent} bytes")
+    
+    # An aborted transfer, or fewer bytes than the range, does not count as delivered
+    delivered = completion == "OK" and bytes_sent >= end - start + 1
+    if delivered:
+        await finish_download(file_id, download["output_path"], start, end, size, download.get("profile"))
+    return {"file_id": file_id, "recorded": delivered}
+
+async def tail_output(file_id):
+    """Yield a job's output as it grows, ending once the job is completed (or failed/gone).
+
+    Only MP3 and Ogg/Opus can be followed while ffmpeg is writing them; other containers (e.g.
+    stream-copied .m4a) are finalized by rewriting their header, so they are sent once the job completes.
+    """
+    loop = asyncio.get_running_loop()
+    last_data_at = loop.time()
+    out_file = None
+    try:
+        while True:
+            # Read the status *before* draining, so "completed" guarantees we reach the real EOF
+            status, output_path = await redis_client.hmget(f"job:{file_id}", "status", "output_path")
+            if status is None or status == b"failed":
+                logger.info(f"Stopping output stream for job {file_id}: status {status}")
+                return
+            status = status.decode('utf-8')
+            output_path = output_path.decode('utf-8') if output_path else get_output_path(file_id)
+            
+            if out_file is None and os.path.exists(output_path) and (status == "completed" or output_path.endswith(PROGRESSIVE_EXTENSIONS)):
+                out_file = await aiofiles.open(output_path, 'rb')
+            elif out_file is None and status == "completed":
+                # Completed, but the output was already deleted (e.g. downloaded): nothing will appear
+                logger.info(f"Stopping output stream for job {file_id}: output {output_path} is gone")
+                return
+            
+            if out_file is not None:
+                while content := await out_file.read(1024 * 1024):
+                    last_data_at = loop.time()
+                    yield content
+                if status == "completed":
+                    return
+            
+            if loop.time() - last_data_at > STREAM_IDLE_TIMEOUT_SECONDS:
+                logger.warning(f"Stopping output stream for job {file_id}: no new data for {STREAM_IDLE_TIMEOUT_SECONDS}s")
+                return
+            await asyncio.sleep(STREAM_POLL_INTERVAL_SECONDS)
+    finally:
+        if out_file is not None:
+            await out_file.close()
+
+@api_router.get("/stream/{file_id}")
+async def stream_output(file_id: str):
+    """Stream the converted audio while the conversion is still running."""
+    logger.info(f"Stream request received for job {file_id}")
+    job_data = await redis_client.hgetall(f"job:{file_id}")
+    if not job_data or job_data.get(b"status") == b"failed":
+        logger.warning(f"Stream failed: Job {file_id} not found or failed")
+        raise HTTPException(status_code=404, detail="Job not found or conversion failed")
+    
+    output_path = job_data.get(b"output_path", get_output_path(file_id).encode()).decode('utf-8')
+    if job_data.get(b"status") == b"completed" and not os.path.exists(output_path):
+        logger.warning(f"Stream failed: Output of job {file_id} no longer exists")
+        raise HTTPException(status_code=404, detail="Output file not found")
+    original_filename = job_data.get(b"original_filename", b"download").decode('utf-8')
+    download_filename = f"{os.path.splitext(original_filename)[0]}{os.path.splitext(output_path)[1]}"
+    
+    # Streaming is a preview of the output: it does not trigger delete-after-download
+    return StreamingResponse(
+        tail_output(file_id),
+        media_type=get_media_type(output_path),
+        headers={
+            "Content-Disposition": content_disposition(download_filename, "inline"),
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+@api_router.get("/peaks/{file_id}")
+async def get_waveform_peaks(file_id: str, request: Request):
+    """Waveform peaks of a completed job: little-endian int16 (min, max) pairs, ``X-Peaks-Per-Second`` pairs per second."""
+    status, peaks_path, peaks_per_second = await redis_client.hmget(f"job:{file_id}", "status", "peaks_path", "peaks_per_second")
+    if status != b"completed" or not peaks_path or not os.path.exists(peaks_path.decode('utf-8')):
+        logger.warning(f"Peaks request failed: No waveform peaks for job {file_id}")
+        raise HTTPException(status_code=404, detail="Waveform peaks not found or conversion not completed")
+    peaks_path = peaks_path.decode('utf-8')
+    
+    stat_result = os.stat(peaks_path)
+    # The peaks of a job never change, so clients may keep them as long as the job's files exist
+    headers = {
+        "content-type": "application/octet-stream",
+        "etag": make_etag(stat_result),
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "cache-control": f"private, max-age={FILE_RETENTION_HOURS * 3600}, immutable",
+        "x-peaks-per-second": peaks_per_second.decode('utf-8'),
+        "x-peaks-format": "int16le-min-max",
+    }
+    if etag_matches(request.headers.get("if-none-match"), headers["etag"]):
+        return Response(status_code=304, headers={k: v for k, v in headers.items() if k in ("etag", "last-modified", "cache-control")})
+    return FileRangeResponse(peaks_path, 0, stat_result.st_size - 1, headers=headers)
+
 # WebSocket endpoint remains on the main app
 @api_router.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    """WebSocket endpoint for real-time conversion progress updates."""
+    """WebSocket endpoint for real-time conversion progress updates.
+
+    The socket starts out following the job whose ``file_id`` is in the path and can follow
+    more (or fewer) by sending ``{"action": "subscribe"|"unsubscribe", "file_ids": [...]}``.
+    """
     logger.info(f"WebSocket connection attempt from client_id: {client_id}")
-    await manager.connect(websocket, client_id)
+    connection = await manager.connect(websocket)
+    manager.subscribe(connection, [client_id])
     try:
         while True:
-            # Keep connection alive by waiting for messages (optional)
-            data = await websocket.receive_text() # Or receive_bytes, receive_json
-            logger.debug(f"Received keep-alive message from WebSocket {client_id}: {data}")
+            data = await websocket.receive_text()
+            await manager.handle_message(connection, data)
     except WebSocketDisconnect:
         logger.info(f"WebSocket client {client_id} initiated disconnect.")
-        manager.disconnect(client_id)
     except Exception as e:
         logger.error(f"WebSocket error for client {client_id}: {e}", exc_info=True)
-        manager.disconnect(client_id) # Ensure disconnection on error
+    finally:
+        manager.disconnect(connection)
 
 # Include the API router with the /api prefix
 app.include_router(api_router, prefix="/api")
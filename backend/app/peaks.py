@@ -0,0 +1,116 @@
+"""Waveform peaks computed from the PCM the conversion already decodes.
+
+The conversion's ffmpeg run gets one more output: the selected audio track as mono
+16-bit PCM at PEAKS_SAMPLE_RATE, written to an inherited pipe. A thread reads that pipe
+in fixed-size chunks and reduces every window of samples to its minimum and maximum with
+NumPy, appending them to the peaks file as it goes, so memory stays constant whatever
+the duration. The file is a flat array of little-endian int16 ``(min, max)`` pairs.
+"""
+import os
+
+import numpy as np
+
+# Rate the PCM tap is resampled to, and how many (min, max) pairs are kept per second
+PEAKS_SAMPLE_RATE = int(os.getenv("PEAKS_SAMPLE_RATE", 8000))
+PEAKS_PER_SECOND = int(os.getenv("PEAKS_PER_SECOND", 50))
+PEAKS_ENABLED = os.getenv("PEAKS_ENABLED", "true").lower() == "true"
+
+READ_SIZE = 65536
+PEAK_DTYPE = np.dtype("<i2")
+
+
+def peaks_path_for(output_path):
+    """Peaks are stored next to the output they describe."""
+    return os.path.splitext(output_path)[0] + ".peaks"
+
+
+class PeakAccumulator:
+    """Reduce a stream of s16le PCM bytes to per-window (min, max) pairs written to ``out``."""
+
+    def __init__(self, out, window):
+        self.out = out
+        self.window = window
+        self.pending = b""  # odd trailing byte of the last chunk
+        self.carry = np.empty(0, dtype=PEAK_DTYPE)  # samples of the unfinished window
+        self.count = 0
+
+    def feed(self, data):
+        data = self.pending + data
+        usable = len(data) - len(data) % PEAK_DTYPE.itemsize
+        self.pending = data[usable:]
+        samples = np.frombuffer(data[:usable], dtype=PEAK_DTYPE)
+        if self.carry.size:
+            samples = np.concatenate((self.carry, samples))
+        full = samples.size - samples.size % self.window
+        if full:
+            self._write(samples[:full].reshape(-1, self.window))
+        self.carry = samples[full:].copy()
+
+    def finish(self):
+        """Flush the last, shorter window."""
+        if self.carry.size:
+            self._write(self.carry.reshape(1, -1))
+            self.carry = np.empty(0, dtype=PEAK_DTYPE)
+        return self.count
+
+    def _write(self, blocks):
+        peaks = np.empty((blocks.shape[0], 2), dtype=PEAK_DTYPE)
+        blocks.min(axis=1, out=peaks[:, 0])
+        blocks.max(axis=1, out=peaks[:, 1])
+        self.out.write(peaks.tobytes())
+        self.count += blocks.shape[0]
+
+
+class PeakTap:
+    """An extra ffmpeg output that feeds decoded PCM to a PeakAccumulator through a pipe.
+
+    Add ``output(source, stream_map)`` to the ffmpeg command, pass ``write_fd`` to the
+    child (run_ffmpeg closes it in this process once ffmpeg has started) and run ``read``
+    in a thread while ffmpeg runs.
+    """
+
+    def __init__(self, path, sample_rate=PEAKS_SAMPLE_RATE, peaks_per_second=PEAKS_PER_SECOND):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.window = max(1, sample_rate // peaks_per_second)
+        self.read_fd, self.write_fd = os.pipe()
+
+    @property
+    def peaks_per_second(self):
+        return self.sample_rate / self.window
+
+    def output(self, source, stream_map=None):
+        """The PCM output node; ``stream_map`` selects the input's audio track (None for a filtered stream)."""
+        map_args = {"map": stream_map} if stream_map else {}
+        return source.output(
+            f"pipe:{self.write_fd}", format="s16le", vn=None,
+            acodec="pcm_s16le", ac=1, ar=self.sample_rate, **map_args,
+        )
+
+    def read(self):
+        """Consume the pipe until ffmpeg closes it; returns the number of peaks written (None on error)."""
+        tmp_path = self.path + ".tmp"
+        try:
+            try:
+                with open(tmp_path, "wb") as out:
+                    accumulator = PeakAccumulator(out, self.window)
+                    while data := os.read(self.read_fd, READ_SIZE):
+                        accumulator.feed(data)
+                    count = accumulator.finish()
+            except OSError as e:
+                # Keep draining: a stalled pipe would block ffmpeg and fail the conversion itself
+                print(f"WARNING: [peaks] Failed to write {tmp_path}: {e}")
+                while os.read(self.read_fd, READ_SIZE):
+                    pass
+                return None
+            os.replace(tmp_path, self.path)
+            return count
+        finally:
+            os.close(self.read_fd)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def discard(self):
+        """Remove the peaks of a failed conversion."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,88 @@
+import os
+
+# Named encode profiles selectable at upload. ``stream_copy`` lets a compatible source track
+# (see STREAM_COPY_CODECS) be remuxed instead of re-encoded; ``quality`` selects VBR (-q:a)
+# instead of a constant ``bitrate``; ``channels``/``sample_rate`` of None keep the source's.
+ENCODE_PROFILES = {
+    "music": {
+        "codec": "libmp3lame",
+        "format": "mp3",
+        "extension": ".mp3",
+        "bitrate": "192k",
+        "quality": None,
+        "channels": None,
+        "sample_rate": None,
+        "stream_copy": True,
+    },
+    "music-vbr": {
+        "codec": "libmp3lame",
+        "format": "mp3",
+        "extension": ".mp3",
+        "bitrate": None,
+        "quality": 2,  # LAME V2, ~190 kbit/s
+        "channels": None,
+        "sample_rate": None,
+        "stream_copy": False,
+    },
+    "speech": {
+        "codec": "libmp3lame",
+        "format": "mp3",
+        "extension": ".mp3",
+        "bitrate": "64k",
+        "quality": None,
+        "channels": 1,
+        "sample_rate": 44100,
+        "stream_copy": False,
+    },
+    "speech-opus": {
+        "codec": "libopus",
+        "format": "ogg",
+        "extension": ".opus",
+        "bitrate": "32k",
+        "quality": None,
+        "channels": 1,
+        "sample_rate": 48000,
+        "stream_copy": False,
+        "extra_args": {"application": "voip"},
+    },
+    # Uncompressed low-rate preview, e.g. for waveform rendering or quick in-browser scrubbing
+    "preview-wav": {
+        "codec": "pcm_s16le",
+        "format": "wav",
+        "extension": ".wav",
+        "bitrate": None,
+        "quality": None,
+        "channels": 1,
+        "sample_rate": 22050,
+        "stream_copy": False,
+    },
+}
+
+DEFAULT_ENCODE_PROFILE = os.getenv("DEFAULT_ENCODE_PROFILE", "music")
+if DEFAULT_ENCODE_PROFILE not in ENCODE_PROFILES:
+    raise ValueError(f"DEFAULT_ENCODE_PROFILE must be one of {', '.join(ENCODE_PROFILES)}")
+
+def get_profile(name=None):
+    """Return the profile dict for ``name`` (default profile when None), or None if unknown."""
+    return ENCODE_PROFILES.get(name or DEFAULT_ENCODE_PROFILE)
+
+def encode_args(profile):
+    """ffmpeg-python output arguments that encode with a profile."""
+    args = {"acodec": profile["codec"]}
+    if profile["quality"] is not None:
+        args["q:a"] = profile["quality"]
+    elif profile["bitrate"]:
+        args["audio_bitrate"] = profile["bitrate"]
+    if profile["channels"]:
+        args["ac"] = profile["channels"]
+    if profile["sample_rate"]:
+        args["ar"] = profile["sample_rate"]
+    args.update(profile.get("extra_args", {}))
+    return args
+
+def describe_profile(name):
+    """Canonical description of a profile's encode parameters (part of the cache key)."""
+    profile = get_profile(name)
+    fields = [f"{key}={profile[key]}" for key in sorted(profile) if key != "extra_args"]
+    fields += [f"{key}={value}" for key, value in sorted(profile.get("extra_args", {}).items())]
+    return ";".join(fields)
@@ -0,0 +1,167 @@
+import os
+import shutil
+import asyncio
+from datetime import datetime
+from . import cache
+
+# Load environment variables
+STORAGE_PATH = os.getenv("STORAGE_PATH", "/tmp/uploads")
+REAPER_BATCH_SIZE = int(os.getenv("REAPER_BATCH_SIZE", 100))
+# A claimed entry reappears for other reapers if its claimant dies before removing it
+REAPER_LEASE_SECONDS = int(os.getenv("REAPER_LEASE_SECONDS", 300))
+# Start evicting outputs when the storage volume is this full, and stop at the low-water mark
+STORAGE_HIGH_WATERMARK_PERCENT = float(os.getenv("STORAGE_HIGH_WATERMARK_PERCENT", 90))
+STORAGE_LOW_WATERMARK_PERCENT = float(os.getenv("STORAGE_LOW_WATERMARK_PERCENT", 80))
+
+EXPIRY_KEY = "file_expiry"
+
+# Claim up to ARGV[2] entries due at ARGV[1] by pushing their score to the lease deadline ARGV[3]
+CLAIM_DUE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, member in ipairs(due) do
+    redis.call('ZADD', KEYS[1], 'XX', ARGV[3], member)
+end
+return due
+"""
+
+# Claim the given members (ARGV[2..]) only if their score is still ARGV[i+1], i.e. nobody else
+# claimed or rescheduled them since they were read
+CLAIM_IF_UNCHANGED_SCRIPT = """
+local claimed = {}
+for i = 2, #ARGV, 2 do
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if score and tonumber(score) == tonumber(ARGV[i + 1]) then
+        redis.call('ZADD', KEYS[1], 'XX', ARGV[1], ARGV[i])
+        table.insert(claimed, ARGV[i])
+    end
+end
+return claimed
+"""
+
+def _lease_deadline(now):
+    return now + REAPER_LEASE_SECONDS
+
+def claim_expired(redis_client, batch_size=None, now=None):
+    """Atomically lease a batch of expired paths so concurrent reapers never share work."""
+    now = datetime.now().timestamp() if now is None else now
+    batch_size = batch_size or REAPER_BATCH_SIZE
+    claimed = redis_client.eval(CLAIM_DUE_SCRIPT, 1, EXPIRY_KEY, now, batch_size, _lease_deadline(now))
+    return [path.decode('utf-8') for path in claimed]
+
+def claim_oldest(redis_client, batch_size=None, now=None):
+    """Lease the earliest-expiring paths that no queued or running job, or live upload, still needs."""
+    now = datetime.now().timestamp() if now is None else now
+    batch_size = batch_size or REAPER_BATCH_SIZE
+    # Read a few extra entries: some belong to jobs that are still in flight
+    candidates = redis_client.zrange(EXPIRY_KEY, 0, batch_size * 2 - 1, withscores=True)
+    if not candidates:
+        return []
+
+    pipe = redis_client.pipeline(transaction=False)
+    for path_bytes, _ in candidates:
+        file_id = job_id_for_path(path_bytes.decode('utf-8'))
+        pipe.hget(f"job:{file_id}", "status")
+        # A chunked upload's input file exists before its job does (upload_id becomes the file_id)
+        pipe.exists(f"upload:{file_id}")
+    results = pipe.execute()
+
+    args = []
+    for (path_bytes, score), status, uploading in zip(candidates, results[0::2], results[1::2]):
+        if status in (b"queued", b"processing") or uploading:
+            continue
+        args.extend([path_bytes, repr(score)])
+        if len(args) == batch_size * 2:
+            break
+    if not args:
+        return []
+    claimed = redis_client.eval(CLAIM_IF_UNCHANGED_SCRIPT, 1, EXPIRY_KEY, _lease_deadline(now), *args)
+    return [path.decode('utf-8') for path in claimed]
+
+def job_id_for_path(path):
+    """Job files are stored as ``<file_id><extension>`` directly under STORAGE_PATH."""
+    return os.path.basename(path).split(".", 1)[0]
+
+def delete_files(paths):
+    """Remove files from disk, returning the paths that are gone and the bytes freed."""
+    removed = []
+    freed = 0
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            freed += size
+            print(f"INFO: [reaper] Deleted {path} ({size} bytes)")
+        except FileNotFoundError:
+            print(f"WARNING: [reaper] File not found, removing record anyway: {path}")
+        except OSError as e:
+            # Keep the record: the lease runs out and a later pass retries
+            print(f"ERROR: [reaper] Failed to delete {path}: {e}")
+            continue
+        removed.append(path)
+    return removed, freed
+
+def forget(redis_client, paths):
+    """Drop the expiry records of deleted files, and the cache entries they backed, in one round trip."""
+    cache_sizes = {}
+    cache_paths = [path for path in paths if os.path.dirname(path) == cache.CACHE_DIR]
+    if cache_paths:
+        pipe = redis_client.pipeline(transaction=False)
+        for path in cache_paths:
+            pipe.hget(f"cache:{cache_key_for_path(path)}", "size")
+        cache_sizes = dict(zip(cache_paths, pipe.execute()))
+
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zrem(EXPIRY_KEY, *paths)
+    for path, size in cache_sizes.items():
+        cache_key = cache_key_for_path(path)
+        pipe.delete(f"cache:{cache_key}")
+        pipe.zrem(cache.CACHE_LRU_KEY, cache_key)
+        if size:
+            pipe.decrby(cache.CACHE_BYTES_KEY, int(size))
+    pipe.execute()
+
+def cache_key_for_path(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+async def reap(redis_client, paths):
+    """Delete claimed files off the event loop, then forget the ones that are gone."""
+    removed, freed = await asyncio.to_thread(delete_files, paths)
+    if removed:
+        forget(redis_client, removed)
+    return removed, freed
+
+async def reap_expired(redis_client, batch_size=None):
+    """Delete every file past its retention time, one leased batch at a time."""
+    batch_size = batch_size or REAPER_BATCH_SIZE
+    total = 0
+    while True:
+        paths = claim_expired(redis_client, batch_size)
+        if not paths:
+            break
+        removed, _ = await reap(redis_client, paths)
+        total += len(removed)
+        if len(paths) < batch_size:
+            break
+    if total:
+        print(f"INFO: [reaper] Reaped {total} expired file(s)")
+    return total
+
+def storage_usage_percent(path=None):
+    usage = shutil.disk_usage(path or STORAGE_PATH)
+    return usage.used * 100 / usage.total
+
+async def relieve_disk_pressure(redis_client, batch_size=None, usage=storage_usage_percent):
+    """Evict the oldest outputs ahead of their expiry while the volume is above the high-water mark."""
+    if usage() < STORAGE_HIGH_WATERMARK_PERCENT:
+        return 0
+    print(f"WARNING: [reaper] Storage at {usage():.1f}%, evicting oldest files down to {STORAGE_LOW_WATERMARK_PERCENT}%")
+    total = 0
+    while usage() > STORAGE_LOW_WATERMARK_PERCENT:
+        paths = claim_oldest(redis_client, batch_size)
+        if not paths:
+            print(f"WARNING: [reaper] Nothing left to evict, storage still at {usage():.1f}%")
+            break
+        removed, freed = await reap(redis_client, paths)
+        total += len(removed)
+        print(f"INFO: [reaper] Evicted {len(removed)} file(s), freed {freed} bytes")
+    return total
@@ -17,6 +17,27 @@ class StatusResponse(BaseModel):
     created_at: str
     progress: Optional[float] = 0
     message: Optional[str] = None
+    queue_position: Optional[int] = None
+    estimated_start: Optional[str] = None
+    outputs: Optional[Dict[str, str]] = None
+    version: Optional[int] = None
+
+
+class StatusBatchRequest(BaseModel):
+    """Request model for the status of several jobs"""
+    file_ids: List[str]
+
+
+class StatusBatchItem(BaseModel):
+    """Status of one requested job, or why it has none"""
+    file_id: str
+    job: Optional[StatusResponse] = None
+    error: Optional[str] = None
+
+
+class StatusBatchResponse(BaseModel):
+    """Response model for a batch status request, in request order"""
+    items: List[StatusBatchItem]
 
 
 class WebSocketMessage(BaseModel):
@@ -25,3 +46,26 @@ class WebSocketMessage(BaseModel):
     status: str
     progress: float
     message: Optional[str] = None
+
+
+class UploadSessionRequest(BaseModel):
+    """Request model for creating a resumable chunked upload"""
+    filename: str
+    size: int
+    chunk_size: Optional[int] = None
+    profile: Optional[str] = None
+    start: Optional[float] = None
+    end: Optional[float] = None
+    ranges: Optional[str] = None
+
+
+class UploadSessionResponse(BaseModel):
+    """State of a resumable chunked upload"""
+    upload_id: str
+    filename: str
+    size: int
+    chunk_size: int
+    total_chunks: int
+    received_chunks: int = 0
+    received_ranges: List[List[int]] = []
+    missing_chunks: List[int] = []
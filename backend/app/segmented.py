@@ -0,0 +1,137 @@
+"""Helpers for encoding long inputs as parallel time segments joined into one MP3.
+
+Segment boundaries sit on the MPEG-1 Layer III frame grid (1152 samples) and every
+segment but the first starts a few frames early. Because each encode then places its
+frames on the same grid as a single-pass encode would, the joined file is built by
+taking frame ``j`` of the timeline from the segment that owns it: the result has the
+same frame count and duration as a single pass, with no gaps at the joins. Segments are
+encoded without the bit reservoir so every frame decodes on its own.
+"""
+import os
+
+MP3_FRAME_SAMPLES = 1152
+# MPEG-1 Layer III only: the frame size above does not hold for MPEG-2/2.5 rates
+SPLIT_SAMPLE_RATES = (32000, 44100, 48000)
+
+MPEG1_L3_BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+MPEG1_SAMPLE_RATES = [44100, 48000, 32000]
+
+
+def plan_segments(duration, sample_rate, count, preroll_frames=8):
+    """Split ``duration`` seconds into ``count`` frame-aligned segments.
+
+    Each segment dict holds the seek position and length (seconds) to encode, and the
+    range of its output frames to keep (``keep_to`` is None for the last segment, which
+    keeps everything up to the encoder's final frame).
+    """
+    total_frames = int(duration * sample_rate) // MP3_FRAME_SAMPLES
+    frames_per_segment = total_frames // count
+    if count < 2 or frames_per_segment <= preroll_frames:
+        return None
+
+    boundaries = [i * frames_per_segment for i in range(count)] + [None]
+    segments = []
+    for i in range(count):
+        start_frame, end_frame = boundaries[i], boundaries[i + 1]
+        encode_start = max(0, start_frame - preroll_frames)
+        segment = {
+            "index": i,
+            "seek": encode_start * MP3_FRAME_SAMPLES / sample_rate,
+            "length": None,
+            "keep_from": start_frame - encode_start,
+            "keep_to": None,
+        }
+        if end_frame is not None:
+            # Encode a little past the boundary so the last kept frames are not end-of-stream frames
+            segment["length"] = (end_frame + preroll_frames - encode_start) * MP3_FRAME_SAMPLES / sample_rate
+            segment["keep_to"] = end_frame - encode_start
+        segments.append(segment)
+    return segments
+
+
+def _syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def iter_mp3_frames(f):
+    """Yield the raw MPEG-1 Layer III frames of an open binary file, skipping ID3v2 tags."""
+    header = f.read(10)
+    if header[:3] == b"ID3" and len(header) == 10:
+        f.seek(10 + _syncsafe(header[6:10]))
+    else:
+        f.seek(0)
+
+    buffer = b""
+    while True:
+        if len(buffer) < 4:
+            buffer += f.read(4 - len(buffer))
+            if len(buffer) < 4:
+                return
+        value = int.from_bytes(buffer[:4], "big")
+        version = (value >> 19) & 0x3
+        layer = (value >> 17) & 0x3
+        bitrate_index = (value >> 12) & 0xF
+        rate_index = (value >> 10) & 0x3
+        if (value >> 21) != 0x7FF or version != 3 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+            # Not a frame header (e.g. a trailing ID3v1 tag): resynchronise byte by byte
+            buffer = buffer[1:]
+            continue
+        padding = (value >> 9) & 0x1
+        length = 144 * MPEG1_L3_BITRATES[bitrate_index] * 1000 // MPEG1_SAMPLE_RATES[rate_index] + padding
+        frame = buffer + f.read(length - 4)
+        if len(frame) < length:
+            return
+        buffer = b""
+        yield frame
+
+
+def is_info_frame(frame):
+    """Whether a frame is the Xing/Info (LAME) header frame rather than audio."""
+    return b"Xing" in frame[:64] or b"Info" in frame[:64]
+
+
+def iter_audio_frames(f):
+    """Like iter_mp3_frames, but without a leading Xing/Info header frame."""
+    for index, frame in enumerate(iter_mp3_frames(f)):
+        if index == 0 and is_info_frame(frame):
+            continue
+        yield frame
+
+
+def join_mp3_segments(segment_paths, segments, output_path):
+    """Concatenate the kept frames of each segment encode into ``output_path``."""
+    frames_written = 0
+    with open(output_path, "wb") as out:
+        for path, segment in zip(segment_paths, segments):
+            with open(path, "rb") as f:
+                for index, frame in enumerate(iter_audio_frames(f)):
+                    if index < segment["keep_from"]:
+                        continue
+                    if segment["keep_to"] is not None and index >= segment["keep_to"]:
+                        break
+                    out.write(frame)
+                    frames_written += 1
+    return frames_written
+
+
+def mp3_frame_stats(path):
+    """Count the audio frames of an MP3 file and derive its duration in seconds."""
+    frames = 0
+    sample_rate = None
+    with open(path, "rb") as f:
+        for frame in iter_audio_frames(f):
+            if sample_rate is None:
+                sample_rate = MPEG1_SAMPLE_RATES[(frame[2] >> 2) & 0x3]
+            frames += 1
+    duration = frames * MP3_FRAME_SAMPLES / sample_rate if sample_rate else 0.0
+    return {"frames": frames, "sample_rate": sample_rate, "duration": duration}
+
+
+def remove_segment_files(paths):
+    """Best-effort cleanup of temporary segment encodes."""
+    for path in paths:
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            print(f"WARNING: [segmented] Failed to remove segment file {path}: {e}")
@@ -0,0 +1,116 @@
+"""Limits that keep one bad input from hanging or exhausting a worker.
+
+Every ffmpeg run is supervised: its stderr is drained concurrently into a bounded ring
+buffer (so a chatty or damaged input can neither fill the pipe and block ffmpeg nor
+grow the worker's memory), a watchdog kills it when its ``-progress`` output time stops
+advancing or it exceeds a wall-clock budget, and its address space is capped with
+RLIMIT_AS so a runaway decode fails on its own instead of taking the container with it.
+"""
+import os
+import time
+import resource
+
+# Bytes of ffmpeg's stderr kept per process; only the most recent output is kept
+FFMPEG_STDERR_MAX_BYTES = int(os.getenv("FFMPEG_STDERR_MAX_BYTES", 65536))
+# Seconds ffmpeg may run without its output time advancing before it is killed (0 disables)
+FFMPEG_STALL_TIMEOUT_SECONDS = float(os.getenv("FFMPEG_STALL_TIMEOUT_SECONDS", 120))
+# Seconds a single ffmpeg run may take in total (0 disables)
+FFMPEG_MAX_RUNTIME_SECONDS = float(os.getenv("FFMPEG_MAX_RUNTIME_SECONDS", 4 * 3600))
+# Address space (RLIMIT_AS) of each ffmpeg process in MB (0 disables). A worker runs up to
+# WORKER_CONCURRENCY x SPLIT_SEGMENTS ffmpeg processes at once; only when that many times
+# this limit fits in the worker container's memory does one job fail on its own
+FFMPEG_MEMORY_LIMIT_MB = int(os.getenv("FFMPEG_MEMORY_LIMIT_MB", 1024))
+
+READ_SIZE = 4096
+
+
+class FFmpegKilled(Exception):
+    """ffmpeg was stopped by the supervisor; the message says why."""
+
+    def __init__(self, reason, stderr=""):
+        super().__init__(reason)
+        self.stderr = stderr
+
+
+class StderrRing:
+    """Keep the last ``limit`` bytes written to it."""
+
+    def __init__(self, limit=None):
+        self.limit = FFMPEG_STDERR_MAX_BYTES if limit is None else limit
+        self.buffer = bytearray()
+        self.dropped = 0
+
+    def feed(self, data):
+        self.buffer += data
+        excess = len(self.buffer) - self.limit
+        if excess > 0:
+            del self.buffer[:excess]
+            self.dropped += excess
+
+    def text(self):
+        text = self.buffer.decode('utf-8', errors='ignore')
+        if self.dropped:
+            text = f"[{self.dropped} earlier bytes of output dropped]\n" + text
+        return text
+
+
+async def drain(stream, ring):
+    """Copy an asyncio stream into a StderrRing until EOF."""
+    while data := await stream.read(READ_SIZE):
+        ring.feed(data)
+
+
+class Watchdog:
+    """Decide when a running ffmpeg has stalled or run out of time."""
+
+    def __init__(self, stall_timeout=None, max_runtime=None):
+        self.stall_timeout = FFMPEG_STALL_TIMEOUT_SECONDS if stall_timeout is None else stall_timeout
+        self.max_runtime = FFMPEG_MAX_RUNTIME_SECONDS if max_runtime is None else max_runtime
+        self.started = self.advanced = time.monotonic()
+        self.position = None
+
+    def progress(self, seconds):
+        """Record an output time; only a larger one counts as progress."""
+        if self.position is None or seconds > self.position:
+            self.position = seconds
+            self.advanced = time.monotonic()
+
+    def remaining(self):
+        """Seconds until the nearest deadline (None when both limits are disabled)."""
+        deadlines = []
+        if self.stall_timeout:
+            deadlines.append(self.advanced + self.stall_timeout)
+        if self.max_runtime:
+            deadlines.append(self.started + self.max_runtime)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def check(self):
+        """Return why ffmpeg must be stopped, or None while it is within its limits."""
+        now = time.monotonic()
+        if self.max_runtime and now - self.started >= self.max_runtime:
+            return f"ffmpeg exceeded the {self.max_runtime:g}s time limit"
+        if self.stall_timeout and now - self.advanced >= self.stall_timeout:
+            return f"ffmpeg made no progress for {self.stall_timeout:g}s"
+        return None
+
+
+def memory_limit(limit_mb=None):
+    """Return a ``preexec_fn`` capping the child's address space before it execs (None: no cap).
+
+    Set between fork and exec, the limit also covers the allocations ffmpeg makes at startup.
+    """
+    limit_mb = FFMPEG_MEMORY_LIMIT_MB if limit_mb is None else limit_mb
+    if not limit_mb:
+        return None
+    limit = limit_mb * 1024 * 1024
+    
+    def apply():
+        # Runs in the forked child: keep going uncapped rather than fail the spawn
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (OSError, ValueError):
+            pass
+    
+    return apply
@@ -0,0 +1,57 @@
+"""Cheap checks that reject unusable uploads before they are stored or queued.
+
+The first bytes of an upload are matched against the signatures of the containers we
+accept, so a renamed document is refused on its first chunk. Once an upload is complete,
+the ffprobe result the API reads anyway (for the job's duration) is checked for a
+decodable audio stream, so inputs that can only fail never reach a worker.
+"""
+
+# Bytes needed to recognise every container below
+SNIFF_BYTES = 16
+
+ASF_GUID = bytes.fromhex("3026b2758e66cf11a6d900aa0062ce6c")
+# ISO base media (MP4/MOV/M4V) files start with one of these top-level boxes
+ISO_BOX_TYPES = (b"ftyp", b"moov", b"mdat", b"free", b"wide", b"skip", b"pnot")
+
+
+class UnsupportedMedia(Exception):
+    """The upload is not a media file we can convert."""
+
+
+class NoAudioStream(UnsupportedMedia):
+    """The upload is media, but has nothing to convert."""
+
+
+class FileTooLarge(Exception):
+    """More bytes arrived than MAX_FILE_SIZE allows."""
+
+
+def sniff_container(head):
+    """Name the container family of a file from its first bytes, or None if unrecognised."""
+    if head[4:8] in ISO_BOX_TYPES:
+        return "mp4"
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "matroska"  # also WebM
+    if head[:4] == b"RIFF" and head[8:12] == b"AVI ":
+        return "avi"
+    if head[:16] == ASF_GUID:
+        return "asf"  # WMV
+    if head[:3] == b"FLV":
+        return "flv"
+    return None
+
+
+def check_head(head, filename):
+    """Raise UnsupportedMedia unless the first bytes of an upload look like a video container."""
+    if sniff_container(head[:SNIFF_BYTES]) is None:
+        raise UnsupportedMedia(f"{filename} is not a supported video file (unrecognised content)")
+
+
+def check_probe(probe):
+    """Raise unless an ffprobe result has an audio stream ffmpeg can decode."""
+    audio_streams = [s for s in probe.get("streams", []) if s.get("codec_type") == "audio"]
+    if not audio_streams:
+        raise NoAudioStream("The file has no audio stream to convert")
+    if all(s.get("codec_name") in (None, "", "none", "unknown") for s in audio_streams):
+        codecs = ", ".join(s.get("codec_tag_string") or "unknown" for s in audio_streams)
+        raise UnsupportedMedia(f"Unsupported audio codec ({codecs})")
@@ -1,28 +1,241 @@
 from fastapi import WebSocket
-from typing import Dict
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Dict, Set
+import asyncio
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Most jobs a single socket may follow at once (this also bounds its send queue)
+WS_MAX_SUBSCRIPTIONS = int(os.getenv("WS_MAX_SUBSCRIPTIONS", 1000))
+# A socket whose send takes longer than this is considered dead and closed
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", 30))
+# Replies to a socket's own messages that may wait unsent before its messages stop being read
+WS_MAX_PENDING_REPLIES = int(os.getenv("WS_MAX_PENDING_REPLIES", 64))
+
+
+class Connection:
+    """One socket, the jobs it follows and its send queue.
+
+    The queue holds at most one message per job: a newer state replaces an undelivered
+    older one, so it never grows beyond the socket's subscriptions, and a slow consumer
+    skips intermediate progress instead of holding up the fan-out to everyone else.
+    Replies to the client's own messages are never coalesced; they queue separately and
+    are sent first. Only the connection's sender task writes to the socket.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.file_ids: Set[str] = set()
+        self.pending: "OrderedDict[str, dict]" = OrderedDict()
+        self.replies = deque()
+        self.replies_drained = asyncio.Event()
+        self.replies_drained.set()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.sender = None
+
+    def offer(self, key, data: dict):
+        """Queue ``data`` as the latest state for ``key``, replacing one not sent yet."""
+        if key in self.pending:
+            self.dropped += 1
+        self.pending[key] = data
+        self.ready.set()
+
+    async def reply(self, data: dict, max_pending=WS_MAX_PENDING_REPLIES):
+        """Queue a reply; waits while ``max_pending`` replies are still unsent."""
+        while len(self.replies) >= max_pending:
+            self.replies_drained.clear()
+            await self.replies_drained.wait()
+        self.replies.append(data)
+        self.ready.set()
+
+    async def send_pending(self, send_timeout=WS_SEND_TIMEOUT_SECONDS):
+        """Send queued replies, then job states oldest job first, until both queues are empty."""
+        while self.replies or self.pending:
+            if self.replies:
+                data = self.replies.popleft()
+                self.replies_drained.set()
+            else:
+                _, data = self.pending.popitem(last=False)
+            await asyncio.wait_for(self.websocket.send_json(data), send_timeout)
+
+    async def run_sender(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            await self.send_pending()
 
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
+    """Fan progress events out to every socket that follows a job.
+
+    A socket follows any number of jobs (subscribe/unsubscribe messages) and any number of
+    sockets may follow the same job. ``publish`` only queues; each socket is written by its
+    own sender task, so a slow client never delays the others.
+    """
 
-    async def connect(self, websocket: WebSocket, client_id: str):
+    def __init__(self, max_subscriptions=WS_MAX_SUBSCRIPTIONS):
+        self.max_subscriptions = max_subscriptions
+        self.connections: Set[Connection] = set()
+        self.subscribers: Dict[str, Set[Connection]] = {}
+
+    async def connect(self, websocket: WebSocket) -> Connection:
         await websocket.accept()
-        self.active_connections[client_id] = websocket
+        connection = Connection(websocket)
+        connection.sender = asyncio.create_task(self._send(connection))
+        self.connections.add(connection)
+        logger.info(f"WebSocket connected (Total: {len(self.connections)})")
+        return connection
+
+    async def _send(self, connection: Connection):
+        try:
+            await connection.run_sender()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Dropping WebSocket after failed send: {e!r}")
+            self.disconnect(connection)
+            try:
+                await connection.websocket.close()
+            except Exception:
+                pass
+
+    def disconnect(self, connection: Connection):
+        if connection not in self.connections:
+            return
+        self.connections.discard(connection)
+        self.unsubscribe(connection, list(connection.file_ids))
+        connection.replies_drained.set()  # release a reader waiting for reply space
+        if connection.sender is not None and connection.sender is not asyncio.current_task():
+            connection.sender.cancel()
+        logger.info(f"WebSocket disconnected (Total: {len(self.connections)}, {connection.dropped} superseded updates skipped)")
 
-    def disconnect(self, client_id: str):
-        if client_id in self.active_connections:
-            del self.active_connections[client_id]
+    def subscribe(self, connection: Connection, file_ids):
+        """Follow ``file_ids``; returns those refused because the socket is at its limit."""
+        refused = []
+        for file_id in file_ids:
+            if file_id in connection.file_ids:
+                continue
+            if len(connection.file_ids) >= self.max_subscriptions:
+                refused.append(file_id)
+                continue
+            connection.file_ids.add(file_id)
+            self.subscribers.setdefault(file_id, set()).add(connection)
+        return refused
 
-    async def send_progress(self, client_id: str, data: dict):
-        if client_id in self.active_connections:
-            await self.active_connections[client_id].send_json(data)
+    def unsubscribe(self, connection: Connection, file_ids):
+        for file_id in file_ids:
+            connection.file_ids.discard(file_id)
+            subscribers = self.subscribers.get(file_id)
+            if subscribers is not None:
+                subscribers.discard(connection)
+                if not subscribers:
+                    del self.subscribers[file_id]
+                connection.pending.pop(file_id, None)
 
-    async def broadcast(self, data: dict):
-        """Send message to all connected clients"""
-        for connection in self.active_connections.values():
-            await connection.send_json(data)
+    async def handle_message(self, connection: Connection, text: str):
+        """Apply a client message: ``{"action": "subscribe"|"unsubscribe", "file_ids": [...]}``.
+
+        Text that is not JSON is a keep-alive. Changes are acknowledged with the socket's
+        current subscriptions; any other JSON gets an error reply.
+        """
+        try:
+            message = json.loads(text)
+        except ValueError:
+            logger.debug(f"Received keep-alive message from WebSocket: {text}")
+            return
+        action = message.get("action") if isinstance(message, dict) else None
+        file_ids = message.get("file_ids") if isinstance(message, dict) else None
+        if action not in ("subscribe", "unsubscribe") or not isinstance(file_ids, list) or not all(isinstance(f, str) for f in file_ids):
+            await connection.reply({"type": "error", "message": "Expected {\"action\": \"subscribe\"|\"unsubscribe\", \"file_ids\": [...]}"})
+            return
+        reply = {"type": "subscriptions"}
+        if action == "subscribe":
+            refused = self.subscribe(connection, file_ids)
+            if refused:
+                reply["refused"] = refused
+                reply["message"] = f"A socket may follow at most {self.max_subscriptions} jobs"
+        else:
+            self.unsubscribe(connection, file_ids)
+        reply["file_ids"] = sorted(connection.file_ids)
+        await connection.reply(reply)
+
+    def publish(self, file_id: str, data: dict):
+        """Queue a job's new state for every socket that follows it."""
+        for connection in self.subscribers.get(file_id, ()):
+            connection.offer(file_id, data)
+
+    def broadcast(self, data: dict):
+        """Queue a message for all connected clients"""
+        for connection in self.connections:
+            connection.offer(data.get("file_id"), data)
 
 
 # Create a global connection manager instance
 manager = ConnectionManager()
+
+
+class StatusWaiters:
+    """Long-poll requests parked until the job they watch publishes a change."""
+
+    def __init__(self):
+        self.waiters: Dict[str, Set[asyncio.Future]] = {}
+
+    @contextmanager
+    def watch(self, file_id: str):
+        """Yield a future that resolves on the job's next event.
+
+        Register before reading the job's state, so a change in between is not missed.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(file_id, set()).add(future)
+        try:
+            yield future
+        finally:
+            waiters = self.waiters.get(file_id)
+            if waiters is not None:
+                waiters.discard(future)
+                if not waiters:
+                    del self.waiters[file_id]
+
+    def notify(self, file_id: str):
+        for future in self.waiters.get(file_id, ()):
+            if not future.done():
+                future.set_result(None)
+
+
+status_waiters = StatusWaiters()
+
+
+async def relay_progress_events(redis_client, channel: str, retry_delay: float = 1.0):
+    """Subscribe to worker progress events and fan them out to connected sockets and long-polls.
+
+    Workers publish on ``channel``; each API process holds a single subscription,
+    so every replica delivers events for the sockets it owns.
+    """
+    while True:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(channel)
+            logger.info(f"Relaying progress events from Redis channel '{channel}'")
+            async for message in pubsub.listen():
+                try:
+                    data = json.loads(message["data"])
+                    manager.publish(data["file_id"], data)
+                    status_waiters.notify(data["file_id"])
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning(f"Ignoring malformed progress event {message.get('data')!r}: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Progress relay lost its Redis subscription: {e}; retrying in {retry_delay}s")
+            await asyncio.sleep(retry_delay)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
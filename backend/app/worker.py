@@ -1,112 +1,203 @@
 import os
 import time
 import json
-import redis
-from datetime import datetime
 import asyncio
-from .conversion import get_job_status, update_job_status, convert_to_mp3
+from .conversion import redis_client, get_job_status, update_job_status, convert_to_mp3
+from . import cache, reaper, jobqueue
 
 # Load environment variables
-REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
-REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 STORAGE_PATH = os.getenv("STORAGE_PATH", "/tmp/uploads")
 
-# Initialize Redis client
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+# Number of conversions a single worker runs at once (0 = one per CPU visible to the container).
+# A long input runs SPLIT_SEGMENTS ffmpeg processes, each capped at FFMPEG_MEMORY_LIMIT_MB:
+# size this so concurrency x segments x that limit fits in the container's memory
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 0))
+# Seconds between lease renewals (and checks for workers whose lease expired)
+HEARTBEAT_INTERVAL_SECONDS = float(os.getenv("HEARTBEAT_INTERVAL_SECONDS", jobqueue.WORKER_LEASE_SECONDS / 3))
+# Seconds between expiry cleanup and disk-pressure passes
+CLEANUP_INTERVAL_SECONDS = int(os.getenv("CLEANUP_INTERVAL_SECONDS", 5))
 
-async def process_conversion_queue():
-    """Worker process that monitors the conversion queue and processes jobs."""
-    print("INFO: Starting conversion worker...")
+def get_cpu_count():
+    """Return the number of CPUs available to this container, honouring cgroup quotas."""
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return max(1, int(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    
+    # cgroup v1
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return max(1, quota // period)
+    except (OSError, ValueError):
+        pass
+    
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+async def process_job(file_id):
+    """Run a single conversion job fetched from the queue."""
+    # Get full job details
+    # Redis calls here are synchronous, so they run off the event loop like claim_job
+    print(f"DEBUG: Fetching full job details for {file_id} from Redis")
+    job_details = await asyncio.to_thread(get_job_status, file_id)
+    print(f"DEBUG: Fetched job details: {job_details}")
     
+    if job_details and job_details.get("status") == "queued":
+        print(f"INFO: Processing job {file_id}")
+        
+        # Update job status to 'processing' and count the attempt (bounded by JOB_MAX_ATTEMPTS)
+        print(f"DEBUG: Updating job {file_id} status to 'processing'")
+        await asyncio.to_thread(redis_client.hincrby, f"job:{file_id}", "attempts", 1)
+        await asyncio.to_thread(update_job_status, file_id, status="processing", progress=0)
+        print(f"DEBUG: Job {file_id} status updated to 'processing'")
+        
+        input_path = job_details.get("input_path")
+        output_path = job_details.get("output_path")
+        # Further outputs requested with the primary one share its ffmpeg run
+        extra_outputs = json.loads(job_details.get("outputs") or "{}")
+        extra_outputs.pop(job_details.get("profile"), None)
+        print(f"DEBUG: Job {file_id} - Input: {input_path}, Output: {output_path}, Extra outputs: {extra_outputs}")
+        
+        # Perform the conversion
+        print(f"INFO: Starting conversion for job {file_id}")
+        started_at = time.monotonic()
+        clip_ranges = json.loads(job_details["clip_ranges"]) if job_details.get("clip_ranges") else None
+        success = await convert_to_mp3(input_path, output_path, file_id, job_details.get("profile"), extra_outputs, clip_ranges)
+        print(f"INFO: Conversion finished for job {file_id}. Success: {success}")
+        
+        # Measured speed feeds the queue's start-time estimates
+        if success and job_details.get("duration"):
+            await asyncio.to_thread(jobqueue.record_encode_speed, redis_client, float(job_details["duration"]), time.monotonic() - started_at)
+        
+        # Keep the finished output for re-uploads of the same content
+        if success and job_details.get("cache_key"):
+            try:
+                await asyncio.to_thread(cache_output, file_id, job_details["cache_key"], output_path)
+            except Exception as e:
+                print(f"WARNING: Failed to cache output of job {file_id}: {str(e)}")
+        
+        # Clean up input file after successful conversion
+        if success and os.path.exists(input_path):
+            print(f"INFO: Cleaning up input file: {input_path} (Job: {file_id})")
+            os.remove(input_path)
+            print(f"INFO: Input file {input_path} deleted.")
+        elif not success:
+            print(f"WARNING: Conversion failed for job {file_id}. Input file {input_path} not deleted.")
+    elif not job_details:
+        print(f"WARNING: Could not retrieve details for job {file_id} from Redis hash. Skipping.")
+    else:
+        print(f"WARNING: Job {file_id} has unexpected status '{job_details.get('status')}'. Skipping.")
+
+def cache_output(file_id, cache_key, output_path):
+    """Store a finished job's output in the conversion cache (blocking: copies the file)."""
+    finished = get_job_status(file_id) or {}
+    metadata = {k: finished[k] for k in ("conversion_mode", "source_audio_codec", "output_format", "profile") if k in finished}
+    cache.store(redis_client, cache_key, finished.get("output_path", output_path), metadata)
+
+async def run_job(file_id, raw_job, worker_id, slots):
+    """Process a job, then acknowledge it and release its concurrency slot."""
+    try:
+        await process_job(file_id)
+    except Exception as e:
+        print(f"ERROR: Unhandled exception while processing job {file_id}: {str(e)}")
+        import traceback
+        traceback.print_exc()
+    finally:
+        try:
+            await asyncio.to_thread(jobqueue.ack_job, redis_client, worker_id, raw_job)
+        except Exception as e:
+            print(f"ERROR: Failed to acknowledge job {file_id}: {str(e)}")
+        slots.release()
+
+async def run_heartbeat(worker_id):
+    """Renew this worker's lease and requeue the jobs of workers that stopped renewing theirs."""
+    while True:
+        try:
+            await asyncio.to_thread(jobqueue.renew_lease, redis_client, worker_id)
+            await asyncio.to_thread(jobqueue.recover_expired_workers, redis_client, worker_id)
+        except Exception as e:
+            print(f"ERROR: Heartbeat failed: {str(e)}")
+        await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+
+async def run_expiry_cleanup():
+    """Periodically reap expired files, independently of the conversions in flight."""
     while True:
         try:
-            # Check for expired files and delete them
-            # print("DEBUG: Checking for expired files...")
             await cleanup_expired_files()
-            
-            # Get the next job from the queue
-            print("INFO: Waiting for job on 'conversion_queue'...")
-            job_data = redis_client.brpop("conversion_queue", timeout=5) # Increased timeout slightly
-            
-            if job_data:
-                print(f"DEBUG: Received raw job data: {job_data}")
-                # Extract job information
-                _, job_json = job_data
-                job = json.loads(job_json)
-                file_id = job["file_id"]
-                print(f"INFO: Received job ID: {file_id}")
-                
-                # Get full job details
-                print(f"DEBUG: Fetching full job details for {file_id} from Redis")
-                job_details = get_job_status(file_id)
-                print(f"DEBUG: Fetched job details: {job_details}")
+        except Exception as e:
+            print(f"ERROR: Expiry cleanup failed: {str(e)}")
+        await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
+
+async def process_conversion_queue():
+    """Worker process that monitors the conversion queue and processes jobs concurrently."""
+    concurrency = WORKER_CONCURRENCY or get_cpu_count()
+    worker_id = jobqueue.get_worker_id()
+    print(f"INFO: Starting conversion worker {worker_id} with {concurrency} concurrent slot(s)...")
+    
+    jobqueue.register_worker(redis_client, worker_id, concurrency)
+    slots = asyncio.Semaphore(concurrency)
+    in_flight = set()
+    # Lease renewal and file cleanup run beside the claim loop until the worker stops
+    background = {
+        asyncio.create_task(run_heartbeat(worker_id)),
+        asyncio.create_task(run_expiry_cleanup()),
+    }
+    
+    try:
+        while True:
+            # Only take a job off the queue once a slot is free
+            await slots.acquire()
+            job_data = None
+            try:
+                # Claim the next job onto our processing list (blmove blocks, so run it off the event loop)
+                print("INFO: Waiting for job on 'conversion_queue'...")
+                job_data = await asyncio.to_thread(jobqueue.claim_job, redis_client, worker_id, 5)
                 
-                if job_details and job_details.get("status") == "queued":
-                    print(f"INFO: Processing job {file_id}")
-                    
-                    # Update job status to 'processing'
-                    print(f"DEBUG: Updating job {file_id} status to 'processing'")
-                    update_job_status(file_id, status="processing", progress=0)
-                    print(f"DEBUG: Job {file_id} status updated to 'processing'")
-                    
-                    input_path = job_details.get("input_path")
-                    output_path = job_details.get("output_path")
-                    print(f"DEBUG: Job {file_id} - Input: {input_path}, Output: {output_path}")
-                    
-                    # Perform the conversion
-                    print(f"INFO: Starting conversion for job {file_id}")
-                    success = convert_to_mp3(input_path, output_path, file_id)
-                    print(f"INFO: Conversion finished for job {file_id}. Success: {success}")
+                if job_data:
+                    print(f"DEBUG: Received raw job data: {job_data}")
+                    # Extract job information
+                    job = json.loads(job_data)
+                    file_id = job["file_id"]
+                    print(f"INFO: Received job ID: {file_id} ({len(in_flight) + 1}/{concurrency} slots busy)")
                     
-                    # Clean up input file after successful conversion
-                    if success and os.path.exists(input_path):
-                        print(f"INFO: Cleaning up input file: {input_path} (Job: {file_id})")
-                        os.remove(input_path)
-                        print(f"INFO: Input file {input_path} deleted.")
-                    elif not success:
-                        print(f"WARNING: Conversion failed for job {file_id}. Input file {input_path} not deleted.")
-                elif not job_details:
-                    print(f"WARNING: Could not retrieve details for job {file_id} from Redis hash. Skipping.")
+                    task = asyncio.create_task(run_job(file_id, job_data, worker_id, slots))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
                 else:
-                    print(f"WARNING: Job {file_id} has unexpected status '{job_details.get('status')}'. Skipping.")
-            
-            else:
-                # No jobs in queue, loop continues
-                # print("DEBUG: No job received, looping.")
-                pass # No need to sleep here, brpop handles waiting
-                
-        except json.JSONDecodeError as e:
-            print(f"ERROR: Failed to decode JSON job data: {job_data}. Error: {e}")
-            # Potentially push back to queue or move to dead-letter queue
-        except Exception as e:
-            print(f"ERROR: Unhandled exception in worker process: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            await asyncio.sleep(5)  # Wait before retrying
+                    # No jobs in queue, loop continues (blmove handles waiting)
+                    slots.release()
+                    
+            except json.JSONDecodeError as e:
+                print(f"ERROR: Failed to decode JSON job data: {job_data}. Error: {e}")
+                # Nothing can ever process it: park it on the dead-letter list
+                await asyncio.to_thread(redis_client.lpush, jobqueue.DEAD_LETTER_KEY, job_data)
+                await asyncio.to_thread(jobqueue.ack_job, redis_client, worker_id, job_data)
+                slots.release()
+            except Exception as e:
+                print(f"ERROR: Unhandled exception in worker process: {str(e)}")
+                import traceback
+                traceback.print_exc()
+                slots.release()
+                await asyncio.sleep(5)  # Wait before retrying
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
 
 async def cleanup_expired_files():
-    """Delete files that have passed their expiration time."""
-    current_time = datetime.now().timestamp()
-    # print(f"DEBUG: Cleaning files expired before {current_time}")
-    
-    # Get expired files
-    expired_files = redis_client.zrangebyscore("file_expiry", 0, current_time)
-    # print(f"DEBUG: Found {len(expired_files)} expired file records.")
-    
-    for file_path_bytes in expired_files:
-        path = file_path_bytes.decode('utf-8')
-        try:
-            if os.path.exists(path):
-                print(f"INFO: Deleting expired file: {path}")
-                os.remove(path)
-                print(f"INFO: Deleted expired file successfully: {path}")
-            else:
-                print(f"WARNING: Expired file path not found, removing record anyway: {path}")
-            
-            # Remove from expiry set
-            redis_client.zrem("file_expiry", path)
-        except Exception as e:
-            print(f"ERROR: Failed during deletion of expired file {path}: {str(e)}")
+    """Delete files that have passed their expiration time, then relieve disk pressure."""
+    await reaper.reap_expired(redis_client)
+    await reaper.relieve_disk_pressure(redis_client)
 
 def run_worker():
     """Run the worker process."""
@@ -0,0 +1,100 @@
+"""Compare the multipart upload (POST /api/upload/) with the raw-body upload (PUT /api/upload/raw).
+
+Run it against a live API process and pass that process's PID so its I/O counters can be
+read from /proc/<pid>/io (Linux):
+
+    python benchmarks/upload_paths.py --url http://localhost:8000/api --pid $(pgrep -f "uvicorn app.main") --size-mb 512
+
+For each path it reports the wall time of the request and the bytes the API process wrote:
+``wchar`` counts every write() (page cache included, so it also sees a tmpfs spool
+directory), ``write_bytes`` what reached the block device. Without --file, a video of
+roughly --size-mb is generated with ffmpeg (raw video in AVI, so it is cheap to
+produce). Each upload is queued as a normal job; run without workers to keep conversions
+out of the numbers, or ignore them (they run in other processes).
+"""
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+import httpx
+
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+
+
+def read_io(pid):
+    if pid is None:
+        return {}
+    with open(f"/proc/{pid}/io") as f:
+        return {key: int(value) for key, value in (line.split(": ") for line in f)}
+
+
+def generate_video(path, size_mb):
+    # 320x240 bgr24 at 25 fps is ~5.8 MB per second of video
+    duration = max(1.0, size_mb / 5.76)
+    subprocess.run([
+        FFMPEG_PATH, "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc=d={duration}:s=320x240:r=25",
+        "-f", "lavfi", "-i", f"sine=d={duration}",
+        "-c:v", "rawvideo", "-pix_fmt", "bgr24", "-c:a", "pcm_s16le", path,
+    ], check=True)
+
+
+def upload_multipart(client, url, path):
+    with open(path, "rb") as f:
+        return client.post(f"{url}/upload/", files={"file": (os.path.basename(path), f, "application/octet-stream")})
+
+
+def upload_raw(client, url, path):
+    with open(path, "rb") as f:
+        return client.put(f"{url}/upload/raw", params={"filename": os.path.basename(path)}, content=f,
+                          headers={"content-type": "application/octet-stream"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000/api")
+    parser.add_argument("--pid", type=int, help="PID of the API process (for /proc/<pid>/io)")
+    parser.add_argument("--file", help="Video to upload (default: generate one)")
+    parser.add_argument("--size-mb", type=float, default=256)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    path = args.file
+    if path is None:
+        path = os.path.join(workdir, "bench.avi")
+        generate_video(path, args.size_mb)
+    size = os.path.getsize(path)
+    print(f"Uploading {path} ({size / 2**20:.1f} MiB), {args.runs} run(s) per path")
+
+    results = {"multipart": [], "raw": []}
+    with httpx.Client(timeout=None) as client:
+        for _ in range(args.runs):
+            for name, upload in (("multipart", upload_multipart), ("raw", upload_raw)):
+                before = read_io(args.pid)
+                started = time.perf_counter()
+                response = upload(client, args.url, path)
+                elapsed = time.perf_counter() - started
+                after = read_io(args.pid)
+                response.raise_for_status()
+                results[name].append({
+                    "seconds": elapsed,
+                    **{key: after[key] - before[key] for key in ("wchar", "write_bytes") if key in after},
+                })
+
+    print(f"{'path':<10} {'wall s':>8} {'MiB/s':>8} {'wchar/size':>11} {'disk/size':>10}")
+    for name, runs in results.items():
+        best = min(runs, key=lambda run: run["seconds"])
+        wchar = f"{best['wchar'] / size:.2f}x" if "wchar" in best else "n/a"
+        disk = f"{best['write_bytes'] / size:.2f}x" if "write_bytes" in best else "n/a"
+        print(f"{name:<10} {best['seconds']:>8.2f} {size / 2**20 / best['seconds']:>8.1f} {wchar:>11} {disk:>10}")
+
+    if args.file is None:
+        os.remove(path)
+    os.rmdir(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,17 +4,46 @@ from ..main import app
 import os
 import tempfile
 import shutil
+import asyncio
+import subprocess
+import time
 
 client = TestClient(app)
 
+@pytest.fixture(scope="module", autouse=True)
+def app_lifespan():
+    # Entering the client runs the app lifespan, which opens the Redis pool
+    with client:
+        yield
+
+FFMPEG = os.getenv("FFMPEG_PATH") or shutil.which("ffmpeg") or "/usr/bin/ffmpeg"
+HAS_FFMPEG = shutil.which(FFMPEG) is not None
+
 # Create a test video file
-def create_test_video():
-    # Create a temporary file that simulates a small video file
+def create_test_video(audio=True):
+    # A real one-second clip when ffmpeg is available (uploads are probed), else just an MP4 header
     temp_file = tempfile.NamedTemporaryFile(suffix=".mp4", delete=False)
-    temp_file.write(b"test video content")
     temp_file.close()
+    if HAS_FFMPEG:
+        sources = ["-f", "lavfi", "-i", "testsrc=d=1:s=64x48:r=5"]
+        if audio:
+            sources += ["-f", "lavfi", "-i", "sine=d=1"]
+        # Unique content, so earlier conversions of the same clip are not cache hits
+        subprocess.run([FFMPEG, "-y", "-loglevel", "error", *sources, "-c:v", "mpeg4", "-shortest",
+                        "-metadata", f"comment={os.urandom(8).hex()}", temp_file.name], check=True)
+    else:
+        with open(temp_file.name, "wb") as f:
+            f.write(b"\x00\x00\x00\x18ftypisom\x00\x00\x02\x00isomiso2" + b"test video content")
     return temp_file.name
 
+def read_test_video(audio=True):
+    path = create_test_video(audio)
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.unlink(path)
+
 def test_root_endpoint():
     response = client.get("/api/")
     assert response.status_code == 200
@@ -53,10 +82,791 @@ def test_upload_valid_format():
     finally:
         os.unlink(video_path)
 
+def test_upload_content_is_validated(monkeypatch):
+    from .. import main
+    
+    # A renamed document is refused on its first bytes
+    response = client.post("/api/upload/", files={"file": ("report.mp4", b"%PDF-1.7\n" + b"x" * 100, "video/mp4")})
+    assert response.status_code == 415
+    response = client.post("/api/upload/stream?filename=report.mkv", content=b"%PDF-1.7\n" + b"x" * 100)
+    assert response.status_code == 415
+    
+    session = client.post("/api/uploads/", json={"filename": "report.mp4", "size": 200}).json()
+    assert client.put(f"/api/uploads/{session['upload_id']}/chunks/0", content=b"%PDF" + b"x" * 196).status_code == 415
+    assert client.get(f"/api/uploads/{session['upload_id']}").status_code == 404
+    
+    monkeypatch.setattr(main, "MAX_FILE_SIZE", 16)
+    response = client.post("/api/upload/", files={"file": ("test.mp4", read_test_video(), "video/mp4")})
+    assert response.status_code == 413
+    response = client.post("/api/upload/stream?filename=test.mp4", content=read_test_video())
+    assert response.status_code == 413
+
+def test_raw_upload_is_written_once_to_the_input_path(monkeypatch):
+    from .. import main, jobqueue
+    from ..conversion import redis_client
+    
+    data = read_test_video()
+    response = client.put("/api/upload/raw?filename=test.mp4", content=data,
+                          headers={"content-type": "application/octet-stream"})
+    assert response.status_code == 200
+    file_id = response.json()["file_id"]
+    try:
+        input_path = redis_client.hget(f"job:{file_id}", "input_path").decode()
+        with open(input_path, "rb") as f:
+            assert f.read() == data
+    finally:
+        redis_client.zrem(jobqueue.QUEUE_KEY, jobqueue.queue_entry(file_id))
+        redis_client.delete(f"job:{file_id}")
+    
+    assert client.put("/api/upload/raw?filename=report.mp4", content=b"%PDF-1.7" + b"x" * 100).status_code == 415
+    monkeypatch.setattr(main, "MAX_FILE_SIZE", 16)
+    assert client.put("/api/upload/raw?filename=test.mp4", content=data).status_code == 413
+
+@pytest.mark.skipif(not HAS_FFMPEG, reason="ffmpeg not available")
+def test_upload_without_audio_is_rejected():
+    response = client.post("/api/upload/", files={"file": ("silent.mp4", read_test_video(audio=False), "video/mp4")})
+    assert response.status_code == 422
+    assert "no audio" in response.json()["detail"]
+
 def test_status_nonexistent_job():
     response = client.get("/api/status/nonexistent-id")
     assert response.status_code == 404
 
+def test_status_is_versioned_and_long_polls():
+    import threading
+    import uuid
+    from ..conversion import update_job_status, redis_client
+    file_id = str(uuid.uuid4())
+    update_job_status(file_id, "processing", 10, "Converting: 10.0%")
+    try:
+        response = client.get(f"/api/status/{file_id}")
+        assert response.status_code == 200
+        assert response.json()["version"] == "1"
+        etag = response.headers["etag"]
+        assert client.get(f"/api/status/{file_id}", headers={"If-None-Match": etag}).status_code == 304
+        
+        # Parked until the worker's next update is published, not until the timeout
+        threading.Timer(0.3, update_job_status, (file_id, "processing", 50, "Converting: 50.0%")).start()
+        started = time.monotonic()
+        response = client.get(f"/api/status/{file_id}", params={"since": 1, "wait": 10})
+        assert 0.2 < time.monotonic() - started < 5
+        assert response.json()["version"] == "2" and response.json()["progress"] == "50"
+        assert response.headers["etag"] != etag
+        
+        # Nothing changes: the poll ends after ``wait`` and still honours If-None-Match
+        started = time.monotonic()
+        response = client.get(f"/api/status/{file_id}", params={"since": 2, "wait": 0.3}, headers={"If-None-Match": response.headers["etag"]})
+        assert response.status_code == 304
+        assert time.monotonic() - started >= 0.3
+    finally:
+        redis_client.delete(f"job:{file_id}")
+
+@pytest.mark.skipif(not HAS_FFMPEG, reason="ffmpeg not available")
+def test_every_version_bump_is_published():
+    import json
+    import redis.asyncio as aioredis
+    from .. import conversion, jobqueue
+    from ..conversion import redis_client, PROGRESS_CHANNEL
+    from ..downloads import record_delivered_range
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(PROGRESS_CHANNEL)
+    
+    def next_event(file_id):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=0.1)
+            if message and json.loads(message["data"])["file_id"] == file_id:
+                return json.loads(message["data"])
+        raise AssertionError(f"No progress event for {file_id}")
+    
+    async def deliver(file_id):
+        async_client = aioredis.Redis(host=conversion.REDIS_HOST, port=conversion.REDIS_PORT)
+        try:
+            return await record_delivered_range(async_client, file_id, 0, 9, 100, channel=PROGRESS_CHANNEL)
+        finally:
+            await async_client.aclose()
+    
+    file_id = None
+    try:
+        response = client.post("/api/upload/", files={"file": ("test.mp4", read_test_video(), "video/mp4")})
+        file_id = response.json()["file_id"]
+        assert next_event(file_id)["status"] == "queued"
+        
+        # Bookkeeping of a partial download bumps the version too, so it is announced as well
+        assert asyncio.run(deliver(file_id)) is False
+        assert next_event(file_id)["status"] == "queued"
+        assert redis_client.hget(f"job:{file_id}", "version") == b"2"
+    finally:
+        pubsub.close()
+        if file_id:
+            redis_client.zrem(jobqueue.QUEUE_KEY, jobqueue.queue_entry(file_id))
+            redis_client.delete(f"job:{file_id}")
+
+def test_queued_job_etag_is_stable_between_polls():
+    import uuid
+    from ..conversion import redis_client
+    from .. import jobqueue
+    file_id, worker_id = str(uuid.uuid4()), f"test-{uuid.uuid4()}"
+    redis_client.hset(f"job:{file_id}", mapping={"file_id": file_id, "status": "queued", "progress": 0,
+                                                 "original_filename": "a.mp4", "created_at": "2026-01-01T00:00:00",
+                                                 "duration": 60, "version": 1})
+    redis_client.zadd(jobqueue.QUEUE_KEY, {jobqueue.queue_entry(file_id): 0})
+    redis_client.hset(jobqueue.WORKER_SLOTS_KEY, worker_id, 1)
+    try:
+        response = client.get(f"/api/status/{file_id}")
+        assert response.status_code == 200
+        assert response.json()["queue_position"] == 1 and response.json()["estimated_start"]
+        time.sleep(0.05)
+        # The start estimate moves with the clock, but the job itself has not changed
+        response = client.get(f"/api/status/{file_id}", headers={"If-None-Match": response.headers["etag"]})
+        assert response.status_code == 304
+    finally:
+        redis_client.hdel(jobqueue.WORKER_SLOTS_KEY, worker_id)
+        redis_client.zrem(jobqueue.QUEUE_KEY, jobqueue.queue_entry(file_id))
+        redis_client.delete(f"job:{file_id}")
+
+def test_status_batch_reports_each_job():
+    import json
+    import uuid
+    from ..conversion import redis_client
+    from .. import jobqueue
+    queued, completed, broken, unknown = (str(uuid.uuid4()) for _ in range(4))
+    base = {"original_filename": "a.mp4", "created_at": "2026-01-01T00:00:00", "version": 1}
+    redis_client.hset(f"job:{queued}", mapping={**base, "file_id": queued, "status": "queued", "progress": 0})
+    redis_client.hset(f"job:{completed}", mapping={**base, "file_id": completed, "status": "completed", "progress": 100,
+                                                   "outputs": json.dumps({"music": "/x.mp3", "speech-opus": "/x.opus"})})
+    redis_client.hset(f"job:{broken}", mapping={"status": "processing"})
+    redis_client.zadd(jobqueue.QUEUE_KEY, {jobqueue.queue_entry(queued): 0})
+    try:
+        response = client.post("/api/status/batch", json={"file_ids": [queued, completed, unknown, broken, queued]})
+        assert response.status_code == 200
+        items = response.json()["items"]
+        assert [item["file_id"] for item in items] == [queued, completed, unknown, broken]
+        assert items[0]["job"]["status"] == "queued" and items[0]["job"]["queue_position"] == 1
+        assert items[1]["job"]["progress"] == 100 and items[1]["job"]["version"] == 1
+        assert items[1]["job"]["outputs"]["speech-opus"] == f"/api/download/{completed}/speech-opus"
+        assert items[2] == {"file_id": unknown, "job": None, "error": "Job not found"}
+        assert items[3]["job"] is None and items[3]["error"]
+    finally:
+        redis_client.zrem(jobqueue.QUEUE_KEY, jobqueue.queue_entry(queued))
+        redis_client.delete(*(f"job:{file_id}" for file_id in (queued, completed, broken)))
+
+@pytest.mark.skipif(not HAS_FFMPEG, reason="ffmpeg not available")
+def test_streaming_conversion_reports_through_the_async_client(monkeypatch):
+    from .. import conversion
+    
+    class NoSyncRedis:
+        def __getattr__(self, name):
+            raise AssertionError(f"blocking Redis call {name}() from the API event loop")
+    
+    monkeypatch.setattr(conversion, "FFMPEG_PATH", FFMPEG)
+    monkeypatch.setattr(conversion, "redis_client", NoSyncRedis())
+    workdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(workdir, "source.mkv")
+        subprocess.run([FFMPEG, "-loglevel", "error", "-f", "lavfi", "-i", "sine=d=2", "-metadata", f"comment={os.urandom(8).hex()}",
+                        "-c:a", "aac", source], check=True)
+        with open(source, "rb") as f:
+            response = client.post("/api/upload/stream?filename=source.mkv", content=f.read())
+        assert response.status_code == 200 and response.json()["status"] == "completed"
+        status = client.get(f"/api/status/{response.json()['file_id']}").json()
+        assert status["status"] == "completed" and status["peaks_path"]
+        assert int(status["version"]) >= 2
+    finally:
+        shutil.rmtree(workdir)
+
+def test_stream_follows_output_and_ends_when_it_is_gone(monkeypatch):
+    import threading
+    import uuid
+    from .. import main
+    from ..conversion import redis_client
+    monkeypatch.setattr(main, "STREAM_POLL_INTERVAL_SECONDS", 0.05)
+    growing, deleted = str(uuid.uuid4()), str(uuid.uuid4())
+    workdir = tempfile.mkdtemp()
+    paths = {file_id: os.path.join(workdir, f"{file_id}.mp3") for file_id in (growing, deleted)}
+    for file_id, path in paths.items():
+        redis_client.hset(f"job:{file_id}", mapping={"status": "processing", "output_path": path, "original_filename": "a.mp4"})
+    redis_client.hset(f"job:{growing}", "original_filename", "café.mp4")
+    with open(paths[growing], "wb") as f:
+        f.write(b"first")
+    
+    def finish_growing():
+        with open(paths[growing], "ab") as f:
+            f.write(b"-second")
+        redis_client.hset(f"job:{growing}", "status", "completed")
+    
+    try:
+        # Output removed (e.g. by delete-after-download) while a client was following it
+        threading.Timer(0.3, redis_client.hset, (f"job:{deleted}", "status", "completed")).start()
+        threading.Timer(0.8, finish_growing).start()
+        started = time.monotonic()
+        response = client.get(f"/api/stream/{deleted}")
+        assert response.status_code == 200 and response.content == b""
+        assert time.monotonic() - started < 5
+        response = client.get(f"/api/stream/{growing}")
+        assert response.status_code == 200 and response.content == b"first-second"
+        assert response.headers["content-disposition"] == "inline; filename*=utf-8''caf%C3%A9.mp3"
+        # Already completed without an output: rejected up front
+        assert client.get(f"/api/stream/{deleted}").status_code == 404
+    finally:
+        redis_client.delete(*(f"job:{file_id}" for file_id in paths))
+        shutil.rmtree(workdir)
+
+def test_accel_redirect_ticket_needs_the_callback_secret(monkeypatch):
+    import uuid
+    from urllib.parse import urlsplit, parse_qs
+    from .. import main
+    from ..conversion import redis_client
+    monkeypatch.setattr(main, "DOWNLOAD_MODE", "x-accel")
+    monkeypatch.setattr(main, "DOWNLOAD_CALLBACK_SECRET", "s3cret")
+    file_id = str(uuid.uuid4())
+    output_path = os.path.join(main.STORAGE_PATH, f"{file_id}.mp3")
+    with open(output_path, "wb") as f:
+        f.write(b"x" * 1000)
+    redis_client.hset(f"job:{file_id}", mapping={"status": "completed", "output_path": output_path, "original_filename": "a.mp4", "profile": "music"})
+    try:
+        response = client.get(f"/api/download/{file_id}")
+        assert response.status_code == 200 and response.content == b""
+        redirect = urlsplit(response.headers["x-accel-redirect"])
+        assert redirect.path == f"/internal-downloads/{file_id}.mp3"
+        params = {"ticket": parse_qs(redirect.query)["ticket"][0], "completion": "OK", "bytes": 1000}
+        
+        # A client holding the ticket cannot report the download itself
+        for headers in ({}, {"X-Download-Callback-Secret": "guess"}):
+            assert client.post("/api/internal/download-complete", params=params, headers=headers).status_code == 404
+        assert os.path.exists(output_path)
+        
+        response = client.post("/api/internal/download-complete", params=params, headers={"X-Download-Callback-Secret": "s3cret"})
+        assert response.json() == {"file_id": file_id, "recorded": True}
+        assert not os.path.exists(output_path)
+        # Tickets are single use
+        assert client.post("/api/internal/download-complete", params=params, headers={"X-Download-Callback-Secret": "s3cret"}).status_code == 404
+    finally:
+        redis_client.delete(f"job:{file_id}")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
 def test_download_nonexistent_file():
     response = client.get("/api/download/nonexistent-id")
     assert response.status_code == 404
+
+def test_progress_coalescer_drops_small_and_frequent_updates(monkeypatch):
+    from .. import conversion
+    sent = []
+    monkeypatch.setattr(conversion, "update_job_status", lambda file_id, status, progress=None, message=None, extra=None: sent.append((status, progress, extra)))
+    now = [0.0]
+    reporter = conversion.ProgressCoalescer("job-1", min_interval=1.0, min_delta=1.0, clock=lambda: now[0])
+    
+    assert reporter.update(0)
+    now[0] = 0.5
+    assert not reporter.update(5)      # too soon
+    now[0] = 1.5
+    assert not reporter.update(0.5)    # too small
+    assert reporter.update(6)
+    assert not reporter.update(6)      # unchanged
+    
+    reporter.finish("completed", 100)
+    assert [p for _, p, _ in sent] == [0, 6, 100]
+    assert sent[-1][0] == "completed"
+    assert sent[-1][2]["progress_updates_dropped"] == 3
+
+def test_cache_hit_miss_link_and_lru_eviction(monkeypatch):
+    import uuid
+    import redis.asyncio as aioredis
+    from .. import cache
+    from ..conversion import redis_client, REDIS_HOST, REDIS_PORT
+    prefix = f"test-cache-{uuid.uuid4()}"
+    workdir = tempfile.mkdtemp()
+    monkeypatch.setattr(cache, "CACHE_DIR", os.path.join(workdir, "cache"))
+    monkeypatch.setattr(cache, "CACHE_LRU_KEY", f"{prefix}:lru")
+    monkeypatch.setattr(cache, "CACHE_BYTES_KEY", f"{prefix}:bytes")
+    monkeypatch.setattr(cache, "CACHE_MAX_BYTES", 250)
+    keys = {name: f"{prefix}-{name}" for name in ("a", "b", "c")}
+    
+    def finished_output(name):
+        path = os.path.join(workdir, f"{name}.mp3")
+        with open(path, "wb") as f:
+            f.write(os.urandom(100))
+        cache.store(redis_client, keys[name], path, {"output_format": "mp3"})
+        return path
+    
+    async def lookup(name, job):
+        async_client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+        try:
+            return await cache.lookup(async_client, keys[name], os.path.join(workdir, job))
+        finally:
+            await async_client.aclose()
+    
+    try:
+        finished_output("a")
+        assert asyncio.run(lookup("b", "miss")) is None
+        
+        hit = asyncio.run(lookup("a", "job1"))
+        assert hit["output_path"] == os.path.join(workdir, "job1.mp3") and hit["output_format"] == "mp3"
+        cached_path = redis_client.hget(f"cache:{keys['a']}", "path").decode()
+        assert os.stat(cached_path).st_nlink == 3  # the worker's output, the cache and job1 share one inode
+        # Delete-after-download of the job removes only its own link
+        os.remove(hit["output_path"])
+        assert os.path.exists(cached_path)
+        assert asyncio.run(lookup("a", "job2")) is not None
+        
+        # b is now the least recently used entry and is evicted once c exceeds CACHE_MAX_BYTES
+        finished_output("b")
+        assert asyncio.run(lookup("a", "job3")) is not None
+        finished_output("c")
+        assert not redis_client.exists(f"cache:{keys['b']}")
+        assert not os.path.exists(os.path.join(cache.CACHE_DIR, keys["b"] + ".mp3"))
+        assert redis_client.exists(f"cache:{keys['a']}") and redis_client.exists(f"cache:{keys['c']}")
+        assert int(redis_client.get(cache.CACHE_BYTES_KEY)) == 200
+    finally:
+        for key in keys.values():
+            redis_client.zrem("file_expiry", os.path.join(cache.CACHE_DIR, key + ".mp3"))
+            redis_client.delete(f"cache:{key}")
+        redis_client.delete(cache.CACHE_LRU_KEY, cache.CACHE_BYTES_KEY)
+        shutil.rmtree(workdir)
+
+def test_plan_conversion_stream_copies_compatible_audio():
+    from ..conversion import plan_conversion
+    probe = {"streams": [
+        {"index": 0, "codec_type": "video", "codec_name": "h264"},
+        {"index": 1, "codec_type": "audio", "codec_name": "aac", "disposition": {"default": 1}},
+    ]}
+    plan = plan_conversion(probe, "/tmp/uploads/job.mp3")
+    assert plan["mode"] == "copy"
+    assert plan["output_path"] == "/tmp/uploads/job.m4a"
+    
+    probe["streams"][1]["codec_name"] = "opus"
+    plan = plan_conversion(probe, "/tmp/uploads/job.mp3")
+    assert plan["mode"] == "encode"
+    assert plan["output_path"] == "/tmp/uploads/job.mp3"
+    
+    assert plan_conversion({"streams": probe["streams"][:1]}, "/tmp/uploads/job.mp3") is None
+
+def test_encode_profiles_drive_output_and_cache_key():
+    from ..conversion import plan_conversion
+    from ..cache import make_cache_key, get_encode_settings
+    probe = {"streams": [{"index": 0, "codec_type": "audio", "codec_name": "aac"}]}
+    
+    # Speech profiles re-encode even a copyable track, to mono at a low bitrate
+    plan = plan_conversion(probe, "/tmp/uploads/job.mp3", "speech")
+    assert plan["mode"] == "encode"
+    assert plan["output_args"]["ac"] == 1 and plan["output_args"]["audio_bitrate"] == "64k"
+    
+    plan = plan_conversion(probe, "/tmp/uploads/job.opus", "speech-opus")
+    assert (plan["format"], plan["output_path"], plan["output_args"]["acodec"]) == ("ogg", "/tmp/uploads/job.opus", "libopus")
+    
+    assert make_cache_key("abc", get_encode_settings("speech")) != make_cache_key("abc", get_encode_settings("music"))
+    
+    response = client.post("/api/upload/", files={"file": ("test.mp4", b"test", "video/mp4")}, data={"profile": "nope"})
+    assert response.status_code == 400
+
+def test_multi_output_job_has_a_download_per_profile():
+    from .. import jobqueue
+    from ..conversion import redis_client
+    import json
+    
+    response = client.post("/api/upload/", files={"file": ("test.mp4", read_test_video(), "video/mp4")},
+                           data={"profile": "music, speech-opus,preview-wav,music"})
+    assert response.status_code == 200
+    file_id = response.json()["file_id"]
+    try:
+        outputs = json.loads(redis_client.hget(f"job:{file_id}", "outputs"))
+        assert list(outputs) == ["music", "speech-opus", "preview-wav"]
+        assert outputs["preview-wav"].endswith(f"{file_id}.preview-wav.wav")
+        # Each output expires on its own
+        assert all(redis_client.zscore("file_expiry", path) is not None for path in outputs.values())
+        assert client.get(f"/api/status/{file_id}").json()["outputs"]["speech-opus"] == f"/api/download/{file_id}/speech-opus"
+        
+        # Pretend the worker finished: downloading one output removes only that one
+        redis_client.zrem(jobqueue.QUEUE_KEY, jobqueue.queue_entry(file_id))
+        redis_client.hset(f"job:{file_id}", "status", "completed")
+        for path in outputs.values():
+            with open(path, "wb") as f:
+                f.write(b"audio")
+        response = client.get(f"/api/download/{file_id}/preview-wav")
+        assert response.status_code == 200 and response.headers["content-type"] == "audio/wav"
+        assert not os.path.exists(outputs["preview-wav"]) and os.path.exists(outputs["music"])
+        assert client.get(f"/api/download/{file_id}/speech").status_code == 404
+        assert client.get(f"/api/download/{file_id}").status_code == 200
+        assert client.get(f"/api/download/{file_id}/speech-opus").status_code == 200
+        # The job goes with its last output
+        assert not redis_client.exists(f"job:{file_id}")
+    finally:
+        redis_client.zrem(jobqueue.QUEUE_KEY, jobqueue.queue_entry(file_id))
+        redis_client.delete(f"job:{file_id}")
+    
+    response = client.post("/api/upload/", files={"file": ("test.mp4", b"test", "video/mp4")},
+                           data={"profile": "music,speech,speech-opus,preview-wav,music-vbr"})
+    assert response.status_code == 400
+
+def test_clip_ranges_are_validated_and_clamped():
+    from ..main import parse_clip_ranges
+    from ..conversion import clip_ranges_within, clip_duration
+    from fastapi import HTTPException
+    
+    assert parse_clip_ranges() is None
+    assert parse_clip_ranges(start=30) == [[30, None]]
+    assert parse_clip_ranges(ranges="10-20, 30.5-") == [[10, 20], [30.5, None]]
+    for bad in ("20-10", "10-30,20-40", "10-,20-30", "abc", "nan-5"):
+        with pytest.raises(HTTPException):
+            parse_clip_ranges(ranges=bad)
+    
+    clips = clip_ranges_within([[10, 20], [30.5, None], [90, 100]], duration=60)
+    assert clips == [(10, 20), (30.5, 60)]
+    assert clip_duration(clips) == 39.5
+    assert clip_duration(clip_ranges_within([[10, None]])) is None
+
+def test_clip_sources_seek_each_range():
+    import ffmpeg
+    from ..conversion import audio_sources
+    
+    sources, mapped = audio_sources("in.mkv", 1, [(10, 20), (30, None)], count=2)
+    args = ffmpeg.merge_outputs(*[source.output(f"out{i}.mp3") for i, source in enumerate(sources)]).compile()
+    assert not mapped
+    # Input-side seeking: -ss/-t come before each -i
+    assert args[1:9] == ["-ss", "10.000000", "-t", "10.000000", "-i", "in.mkv", "-ss", "30.000000"]
+    assert "concat=a=1:n=2:v=0" in " ".join(args) and "asplit=2" in " ".join(args)
+
+def test_chunked_upload_out_of_order():
+    data = read_test_video()
+    size = -(-len(data) // 3)
+    response = client.post("/api/uploads/", json={"filename": "test.mp4", "size": len(data), "chunk_size": size})
+    assert response.status_code == 200
+    upload_id = response.json()["upload_id"]
+    assert response.json()["total_chunks"] == 3
+    
+    assert client.put(f"/api/uploads/{upload_id}/chunks/2", content=data[2 * size:]).status_code == 200
+    assert client.put(f"/api/uploads/{upload_id}/chunks/0", content=data[:size]).status_code == 200
+    
+    state = client.get(f"/api/uploads/{upload_id}").json()
+    assert state["received_ranges"] == [[0, size], [2 * size, len(data)]]
+    assert state["missing_chunks"] == [1]
+    assert client.post(f"/api/uploads/{upload_id}/complete").status_code == 409
+    
+    assert client.put(f"/api/uploads/{upload_id}/chunks/1", content=data[size:2 * size]).status_code == 200
+    response = client.post(f"/api/uploads/{upload_id}/complete")
+    assert response.status_code == 200
+    assert response.json()["file_id"] == upload_id
+
+def test_parse_range():
+    from ..downloads import parse_range, RangeNotSatisfiable
+    assert parse_range(None, 100) is None
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=50-500", 100) == (50, 99)
+    assert parse_range("bytes=0-1,5-6", 100) is None
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range("bytes=100-", 100)
+
+def test_plan_segments_tiles_the_frame_grid():
+    from ..segmented import plan_segments, MP3_FRAME_SAMPLES
+    segments = plan_segments(3600, 44100, 4)
+    assert len(segments) == 4
+    # Kept frames of consecutive segments meet exactly on the global frame grid
+    for previous, segment in zip(segments, segments[1:]):
+        previous_end = round(previous["seek"] * 44100 / MP3_FRAME_SAMPLES) + previous["keep_to"]
+        segment_start = round(segment["seek"] * 44100 / MP3_FRAME_SAMPLES) + segment["keep_from"]
+        assert previous_end == segment_start
+    assert segments[-1]["keep_to"] is None
+    assert plan_segments(0.5, 44100, 4) is None
+
+def test_only_constant_bitrate_mp3_is_split(monkeypatch):
+    from .. import conversion
+    from ..conversion import plan_conversion, get_split_sample_rate
+    monkeypatch.setattr(conversion, "SPLIT_SEGMENTS", 4)
+    probe = {"streams": [{"index": 0, "codec_type": "audio", "codec_name": "opus", "sample_rate": "44100"}]}
+    duration = conversion.SPLIT_MIN_DURATION_SECONDS + 1
+    assert get_split_sample_rate(probe, plan_conversion(probe, "/tmp/uploads/job.mp3", "music"), duration) == 44100
+    # Joined VBR segments would lack the Xing header that gives a VBR file its duration
+    assert get_split_sample_rate(probe, plan_conversion(probe, "/tmp/uploads/job.mp3", "music-vbr"), duration) is None
+    assert get_split_sample_rate(probe, plan_conversion(probe, "/tmp/uploads/job.mp3", "speech-opus"), duration) is None
+
+@pytest.mark.skipif(not HAS_FFMPEG, reason="ffmpeg not available")
+def test_split_encode_matches_single_pass(monkeypatch):
+    from .. import conversion
+    from ..conversion import encode_split_mp3
+    from ..segmented import mp3_frame_stats
+    monkeypatch.setattr(conversion, "FFMPEG_PATH", FFMPEG)
+    
+    workdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(workdir, "source.mp4")
+        subprocess.run([FFMPEG, "-loglevel", "error", "-f", "lavfi", "-i", "sine=f=440:d=47.3:sample_rate=44100",
+                        "-c:a", "aac", source], check=True)
+        single = os.path.join(workdir, "single.mp3")
+        subprocess.run([FFMPEG, "-loglevel", "error", "-i", source, "-c:a", "libmp3lame", "-b:a", "192k", single], check=True)
+        
+        joined = os.path.join(workdir, "joined.mp3")
+        output_args = {"map": "0:0", "vn": None, "acodec": "libmp3lame", "audio_bitrate": "192k"}
+        return_code, _ = asyncio.run(encode_split_mp3(source, joined, "test", 47.3, 44100, output_args, count=4))
+        assert return_code == 0
+        
+        joined_stats, single_stats = mp3_frame_stats(joined), mp3_frame_stats(single)
+        assert joined_stats["frames"] == single_stats["frames"]
+        assert joined_stats["duration"] == pytest.approx(single_stats["duration"])
+    finally:
+        shutil.rmtree(workdir)
+
+def test_peak_accumulator_streams_min_max_per_window():
+    import io
+    import numpy as np
+    from ..peaks import PeakAccumulator
+    
+    samples = np.random.default_rng(0).integers(-32768, 32767, size=1000, dtype=np.int16)
+    data = samples.astype("<i2").tobytes()
+    out = io.BytesIO()
+    accumulator = PeakAccumulator(out, window=64)
+    # Chunk boundaries split samples and windows
+    for offset in range(0, len(data), 333):
+        accumulator.feed(data[offset:offset + 333])
+    assert accumulator.finish() == 16
+    
+    peaks = np.frombuffer(out.getvalue(), dtype="<i2").reshape(-1, 2)
+    assert peaks[0].tolist() == [samples[:64].min(), samples[:64].max()]
+    assert peaks[-1].tolist() == [samples[960:].min(), samples[960:].max()]
+
+def test_ffmpeg_supervision_drains_stderr_and_kills_stalls(monkeypatch):
+    from .. import supervisor
+    from ..conversion import run_ffmpeg
+    monkeypatch.setattr(supervisor, "FFMPEG_STDERR_MAX_BYTES", 1000)
+    monkeypatch.setattr(supervisor, "FFMPEG_STALL_TIMEOUT_SECONDS", 0.5)
+    
+    # Far more stderr than a pipe buffer holds, written before any progress line
+    chatty = ["sh", "-c", "head -c 1000000 /dev/zero | tr '\\0' x >&2; echo out_time_ms=1000000; exit 3"]
+    return_code, stderr_output = asyncio.run(run_ffmpeg(chatty, "test"))
+    assert return_code == 3
+    assert stderr_output.endswith("x" * 1000)
+    assert "999000 earlier bytes" in stderr_output
+    
+    stalled = ["sh", "-c", "echo out_time_ms=1000000; echo out_time_ms=1000000; exec sleep 30"]
+    started = time.monotonic()
+    with pytest.raises(supervisor.FFmpegKilled, match="no progress"):
+        asyncio.run(run_ffmpeg(stalled, "test"))
+    assert time.monotonic() - started < 5
+    
+    # The address-space cap is in place from the moment the process starts
+    monkeypatch.setattr(supervisor, "FFMPEG_MEMORY_LIMIT_MB", 256)
+    return_code, stderr_output = asyncio.run(run_ffmpeg(["sh", "-c", "ulimit -v >&2"], "test"))
+    assert return_code == 0 and stderr_output.strip() == str(256 * 1024)
+
+def test_websocket_hub_multiplexes_jobs_and_sockets():
+    import json
+    import uuid
+    import redis
+    from ..websocket import manager
+    from ..main import REDIS_HOST, REDIS_PORT, PROGRESS_CHANNEL
+    publisher = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+    job_a, job_b = str(uuid.uuid4()), str(uuid.uuid4())
+    
+    with client.websocket_connect(f"/api/ws/{job_a}") as first, client.websocket_connect(f"/api/ws/{uuid.uuid4()}") as second:
+        first.send_text("ping")  # keep-alives are still accepted
+        first.send_json({"action": "subscribe", "file_ids": []})
+        assert first.receive_json() == {"type": "subscriptions", "file_ids": [job_a]}
+        second.send_json({"action": "subscribe", "file_ids": [job_a, job_b]})
+        assert set(second.receive_json()["file_ids"]) >= {job_a, job_b}
+        assert len(manager.subscribers[job_a]) == 2
+        
+        for file_id, progress in ((job_a, 10), (job_b, 20)):
+            publisher.publish(PROGRESS_CHANNEL, json.dumps({"file_id": file_id, "status": "processing", "progress": progress, "message": None}))
+        assert first.receive_json()["progress"] == 10
+        assert [second.receive_json()["file_id"] for _ in range(2)] == [job_a, job_b]
+        
+        second.send_json({"action": "unsubscribe", "file_ids": [job_a]})
+        assert job_a not in second.receive_json()["file_ids"]
+        second.send_json({"action": "resubscribe"})
+        second.send_json({"action": "subscribe"})
+        assert [second.receive_json()["type"] for _ in range(2)] == ["error", "error"]
+    # The server notices the closed sockets on its own schedule
+    deadline = time.monotonic() + 2
+    while job_a in manager.subscribers and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert job_a not in manager.subscribers
+
+def test_websocket_send_queue_keeps_latest_state_per_job():
+    from ..websocket import Connection
+    
+    class SlowSocket:
+        sent = []
+        async def send_json(self, data):
+            await asyncio.sleep(0.01)
+            self.sent.append(data)
+    
+    async def scenario():
+        connection = Connection(SlowSocket())
+        for progress in range(100):
+            connection.offer("a", {"file_id": "a", "progress": progress})
+        connection.offer("b", {"file_id": "b", "progress": 5})
+        assert len(connection.pending) == 2
+        # Replies to the client are never coalesced and go out first
+        await connection.reply({"type": "error"})
+        await connection.reply({"type": "subscriptions"})
+        await connection.send_pending()
+        return connection
+    
+    connection = asyncio.run(scenario())
+    assert SlowSocket.sent == [{"type": "error"}, {"type": "subscriptions"}, {"file_id": "a", "progress": 99}, {"file_id": "b", "progress": 5}]
+    assert connection.dropped == 99
+
+def test_reaper_claims_expired_files_in_batches():
+    from ..reaper import claim_expired, reap_expired, relieve_disk_pressure
+    from ..conversion import redis_client
+    
+    workdir = tempfile.mkdtemp()
+    try:
+        expired = [os.path.join(workdir, f"expired-{i}.mp3") for i in range(5)]
+        fresh = os.path.join(workdir, "fresh.mp3")
+        for path in expired + [fresh]:
+            with open(path, "wb") as f:
+                f.write(b"x")
+        redis_client.zadd("file_expiry", {path: 1 for path in expired})
+        redis_client.zadd("file_expiry", {fresh: time.time() + 60})
+        
+        # A claim leases entries, so a second reaper does not see them
+        first = claim_expired(redis_client, batch_size=2, now=2)
+        second = claim_expired(redis_client, batch_size=10, now=2)
+        assert len(first) == 2 and len(second) == 3 and not set(first) & set(second)
+        
+        # Leases that outlive their claimant are picked up again
+        redis_client.zadd("file_expiry", {path: 1 for path in expired})
+        assert asyncio.run(reap_expired(redis_client, batch_size=2)) == 5
+        assert not any(os.path.exists(path) for path in expired)
+        assert redis_client.zscore("file_expiry", expired[0]) is None
+        
+        # Disk pressure evicts files before they expire, oldest first
+        usage = lambda: 95 if os.path.exists(fresh) else 70
+        assert asyncio.run(relieve_disk_pressure(redis_client, batch_size=1, usage=usage)) == 1
+        assert not os.path.exists(fresh)
+    finally:
+        redis_client.zrem("file_expiry", *expired, fresh)
+        shutil.rmtree(workdir)
+
+def test_disk_pressure_spares_files_still_in_use(monkeypatch):
+    import uuid
+    from .. import reaper
+    from ..conversion import redis_client
+    monkeypatch.setattr(reaper, "EXPIRY_KEY", f"test-expiry-{uuid.uuid4()}")
+    
+    uploading, queued, done = (str(uuid.uuid4()) for _ in range(3))
+    paths = {file_id: f"/tmp/uploads/{file_id}.mp4" for file_id in (uploading, queued, done)}
+    redis_client.hset(f"upload:{uploading}", "filename", "a.mp4")
+    redis_client.hset(f"job:{queued}", "status", "queued")
+    # The files still in use expire first, so they are the first candidates
+    redis_client.zadd(reaper.EXPIRY_KEY, {paths[uploading]: 1, paths[queued]: 2, paths[done]: 3})
+    try:
+        assert reaper.claim_oldest(redis_client, batch_size=2, now=0) == [paths[done]]
+    finally:
+        redis_client.delete(reaper.EXPIRY_KEY, f"upload:{uploading}", f"job:{queued}")
+
+def test_lost_worker_jobs_are_requeued_then_dead_lettered():
+    from .. import jobqueue
+    from ..conversion import redis_client
+    import json
+    import uuid
+    
+    file_id = str(uuid.uuid4())
+    raw_job = json.dumps({"file_id": file_id})
+    worker_id = f"test-worker-{file_id}"
+    redis_client.hset(f"job:{file_id}", mapping={"file_id": file_id, "status": "queued"})
+    redis_client.zadd(jobqueue.QUEUE_KEY, {raw_job: 0})
+    try:
+        jobqueue.register_worker(redis_client, worker_id)
+        # Lowest score, so it is claimed first
+        assert jobqueue.claim_job(redis_client, worker_id, timeout=1).decode() == raw_job
+        redis_client.hset(f"job:{file_id}", mapping={"status": "processing", "attempts": 1})
+        
+        # A live worker keeps its jobs
+        assert jobqueue.recover_expired_workers(redis_client) == 0
+        
+        # Once its lease runs out, the job goes back to the queue
+        redis_client.delete(jobqueue.lease_key(worker_id))
+        assert jobqueue.recover_expired_workers(redis_client) >= 1
+        assert redis_client.zscore(jobqueue.QUEUE_KEY, raw_job) is not None
+        assert redis_client.hget(f"job:{file_id}", "status") == b"queued"
+        assert not redis_client.sismember(jobqueue.WORKERS_KEY, worker_id)
+        
+        # After too many lost attempts it is dead-lettered instead
+        redis_client.zrem(jobqueue.QUEUE_KEY, raw_job)
+        redis_client.lpush(jobqueue.processing_key(worker_id), raw_job)
+        redis_client.hset(f"job:{file_id}", "attempts", jobqueue.JOB_MAX_ATTEMPTS)
+        assert jobqueue.recover_worker(redis_client, worker_id) == (0, 1)
+        assert redis_client.lpos(jobqueue.DEAD_LETTER_KEY, raw_job) is not None
+        assert redis_client.hget(f"job:{file_id}", "status") == b"failed"
+    finally:
+        redis_client.zrem(jobqueue.QUEUE_KEY, raw_job)
+        redis_client.lrem(jobqueue.DEAD_LETTER_KEY, 0, raw_job)
+        redis_client.delete(f"job:{file_id}", jobqueue.processing_key(worker_id), jobqueue.lease_key(worker_id))
+        redis_client.srem(jobqueue.WORKERS_KEY, worker_id)
+
+def test_queue_orders_short_jobs_first_with_fairness_and_position():
+    from .. import jobqueue
+    from ..conversion import redis_client
+    import uuid
+    
+    jobs = {name: str(uuid.uuid4()) for name in ("movie", "clip", "second_clip", "other_clip")}
+    client_id = f"test-client-{uuid.uuid4()}"
+    try:
+        for file_id in jobs.values():
+            redis_client.hset(f"job:{file_id}", mapping={"file_id": file_id, "status": "queued"})
+        jobqueue.enqueue_job(redis_client, jobs["movie"], duration=7200)
+        jobqueue.enqueue_job(redis_client, jobs["clip"], duration=30, client_id=client_id)
+        # Same length as the first clip, but the client already has a job waiting
+        jobqueue.enqueue_job(redis_client, jobs["second_clip"], duration=30, client_id=client_id)
+        jobqueue.enqueue_job(redis_client, jobs["other_clip"], duration=30, client_id=f"{client_id}-other")
+        
+        score = lambda name: redis_client.zscore(jobqueue.QUEUE_KEY, jobqueue.queue_entry(jobs[name]))
+        assert score("clip") < score("other_clip") < score("second_clip") < score("movie")
+        # Aging: the long job is never ordered more than the cap behind a new job
+        assert score("movie") - score("clip") <= jobqueue.QUEUE_MAX_PENALTY_SECONDS
+        
+        clip_status = client.get(f"/api/status/{jobs['clip']}").json()
+        movie_status = client.get(f"/api/status/{jobs['movie']}").json()
+        assert clip_status["queue_position"] < movie_status["queue_position"]
+        assert "estimated_start" in clip_status
+    finally:
+        redis_client.zrem(jobqueue.QUEUE_KEY, *[jobqueue.queue_entry(file_id) for file_id in jobs.values()])
+        redis_client.delete(*[f"job:{file_id}" for file_id in jobs.values()])
+        redis_client.hdel(jobqueue.CLIENT_JOBS_KEY, client_id, f"{client_id}-other")
+
+def test_queued_work_total_follows_enqueue_claim_and_recovery(monkeypatch):
+    from .. import jobqueue
+    from ..conversion import redis_client
+    from datetime import datetime
+    import uuid
+    
+    prefix = f"test-{uuid.uuid4()}"
+    for name in ("QUEUE_KEY", "QUEUED_WORK_KEY", "WORKER_SLOTS_KEY", "ENCODE_SPEED_KEY"):
+        monkeypatch.setattr(jobqueue, name, f"{prefix}:{name}")
+    worker_id = f"{prefix}-worker"
+    jobs = {name: str(uuid.uuid4()) for name in ("short", "long", "unknown")}
+    work = lambda: redis_client.hmget(jobqueue.QUEUED_WORK_KEY, "seconds", "jobs")
+    try:
+        for name, duration in (("short", 60), ("long", 120), ("unknown", None)):
+            mapping = {"file_id": jobs[name], "status": "queued", "original_filename": "a.mp4", "created_at": "2026-01-01T00:00:00"}
+            if duration:
+                mapping["duration"] = str(float(duration))
+            redis_client.hset(f"job:{jobs[name]}", mapping=mapping)
+            jobqueue.enqueue_job(redis_client, jobs[name], duration=duration and float(duration))
+        assert work() == [b"180", b"2"]
+        
+        # The unprobed job waits behind two jobs of the average (90s) duration
+        redis_client.hset(jobqueue.WORKER_SLOTS_KEY, worker_id, 1)
+        status = client.get(f"/api/status/{jobs['unknown']}").json()
+        assert status["queue_position"] == 3
+        wait = (datetime.fromisoformat(status["estimated_start"]) - datetime.now()).total_seconds()
+        assert abs(wait - 2 * 90 / jobqueue.DEFAULT_ENCODE_SPEED) < 1
+        
+        raw_job = jobqueue.claim_job(redis_client, worker_id, timeout=0)
+        assert raw_job.decode() == jobqueue.queue_entry(jobs["short"])
+        assert work() == [b"120", b"1"]
+        # A requeued job counts again
+        jobqueue.recover_worker(redis_client, worker_id)
+        assert work() == [b"180", b"2"]
+        
+        # Draining the queue resets the total
+        for _ in jobs:
+            assert jobqueue.claim_job(redis_client, worker_id, timeout=0)
+        assert not redis_client.exists(jobqueue.QUEUED_WORK_KEY)
+    finally:
+        redis_client.delete(jobqueue.QUEUE_KEY, jobqueue.QUEUED_WORK_KEY, jobqueue.WORKER_SLOTS_KEY,
+                            jobqueue.processing_key(worker_id), *[f"job:{file_id}" for file_id in jobs.values()])